@@ -0,0 +1,98 @@
+"""
+Compares the throughput of the JSON response paths of the REST API:
+
+* `default`: a plain list of dicts returned through FastAPI's default path
+  (validation against the return annotation, `jsonable_encoder`, `json.dumps`),
+  i.e. how `smarthouse.api` served responses before.
+* `orjson`: the same list returned as an `ORJSONResponse` (no validation).
+* `columns`: the readings as a `MeasurementSeries` serialized column by column.
+
+Run from the project root:
+
+    python benchmarks/bench_json.py --devices 10000 --readings 100000 --repeat 10
+"""
+import argparse
+import time
+import uuid
+from pathlib import Path
+import sys
+from typing import Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+from fastapi.testclient import TestClient
+from smarthouse.domain import MeasurementSeries
+from smarthouse.schemas import DeviceInfo, ReadingColumns, SensorReading
+
+
+def make_devices(n: int) -> List[dict]:
+    return [{
+        "Device id": str(uuid.UUID(int=i)),
+        "Model Name": f"Model {i % 97}",
+        "Supplier": f"Supplier {i % 13}",
+        "Device In Room": f"Room {i % 41}",
+    } for i in range(n)]
+
+
+def make_series(n: int) -> MeasurementSeries:
+    series = MeasurementSeries()
+    start = 1706313600000
+    series.extend((start + i * 60000, 20.0 + (i % 100) / 10, "°C") for i in range(n))
+    return series
+
+
+def make_app(devices: List[dict], series: MeasurementSeries) -> FastAPI:
+    readings = [{"SensorNavn": "Temp 3000", "Verdi": m.value, "Unit": m.unit, "Tid": m.timestamp} for m in series]
+    app = FastAPI()
+
+    @app.get("/default/devices")
+    def default_devices() -> List[Dict[str, int | str | float]]:
+        return devices
+
+    @app.get("/default/readings")
+    def default_readings() -> List[Dict[str, int | float | str | object]]:
+        return readings
+
+    @app.get("/orjson/devices", response_class=ORJSONResponse)
+    def orjson_devices() -> List[DeviceInfo]:
+        return ORJSONResponse(devices)
+
+    @app.get("/orjson/readings", response_class=ORJSONResponse)
+    def orjson_readings() -> List[SensorReading]:
+        return ORJSONResponse(readings)
+
+    @app.get("/columns/readings", response_class=ORJSONResponse)
+    def columns_readings() -> ReadingColumns:
+        return ORJSONResponse(series.to_columns())
+
+    return app
+
+
+def measure(client: TestClient, path: str, repeat: int) -> tuple:
+    client.get(path)  # oppvarming
+    started = time.perf_counter()
+    size = 0
+    for _ in range(repeat):
+        size = len(client.get(path).content)
+    elapsed = time.perf_counter() - started
+    return elapsed / repeat * 1000, repeat / elapsed, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--readings", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    client = TestClient(make_app(make_devices(args.devices), make_series(args.readings)))
+    print(f"{'path':<20} {'ms/request':>12} {'requests/s':>12} {'bytes':>12}")
+    for path in ["/default/devices", "/orjson/devices", "/default/readings", "/orjson/readings", "/columns/readings"]:
+        ms, rps, size = measure(client, path, args.repeat)
+        print(f"{path:<20} {ms:>12.1f} {rps:>12.1f} {size:>12}")
+
+
+if __name__ == "__main__":
+    main()
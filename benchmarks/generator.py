@@ -0,0 +1,134 @@
+"""
+Builds a synthetic smarthouse database with the schema of `data/db.sql`:
+`floors` floors with `rooms` rooms each, `devices` devices per room and a reading
+every `interval` minutes from every sensor over `days` days. The data is random
+but reproducible (`--seed`). Indexes and rollups are created by the repository's
+migrations after the raw data has been inserted.
+
+    python benchmarks/generator.py /tmp/house.sql --floors 3 --rooms 10 --devices 6 --days 365
+"""
+import argparse
+import math
+import random
+import sqlite3
+import sys
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from smarthouse.persistence import SmartHouseRepository
+
+SCHEMA = """
+CREATE TABLE rooms(
+	id INT NOT NULL,
+	floor INT NOT NULL,
+	area REAL NOT NULL,
+	name TEXT NULL,
+	PRIMARY KEY (id)
+);
+CREATE TABLE devices(
+	id TEXT NOT NULL,
+	room INT NOT NULL,
+	kind TEXT NOT NULL,
+	category TEXT NOT NULL,
+	supplier TEXT NULL,
+	product TEXT NULL,
+	PRIMARY KEY (id),
+	FOREIGN KEY (room) REFERENCES rooms(id)
+);
+CREATE TABLE measurements(
+	device text not null,
+	ts text not null,
+	value float not null,
+	unit text null,
+	foreign key (device) references  devices(id)
+);
+CREATE TABLE states (
+	device TEXT NOT NULL,
+	state REAL,
+	CONSTRAINT states_pk PRIMARY KEY (device),
+	CONSTRAINT states_devices_FK FOREIGN KEY (device) REFERENCES devices(id)
+);
+"""
+
+# (kind, category, unit, gjennomsnitt, døgnvariasjon, støy)
+SENSOR_KINDS = [
+    ("Temperature Sensor", "sensor", "°C", 21.0, 2.0, 0.3),
+    ("Humidity Sensor", "sensor", "%", 45.0, 8.0, 2.0),
+    ("Electricity Meter", "sensor", "kWh", 1.2, 0.8, 0.2),
+    ("CO2 sensor", "sensor", "ppm", 600.0, 200.0, 30.0),
+]
+ACTUATOR_KINDS = ["Light Bulp", "Heat Pump", "Smart Plug", "Smart Lock", "Dehumidifier"]
+ROOM_NAMES = ["Living Room", "Kitchen", "Bedroom", "Bathroom", "Office", "Hall", "Guest Room", "Storage"]
+
+
+def generate(path: str, floors: int = 2, rooms: int = 6, devices: int = 5, days: int = 30,
+             interval: int = 10, start: str = "2024-01-01", seed: int = 0) -> dict:
+    """
+    Writes the synthetic database to `path` (which must not exist) and returns
+    the number of floors, rooms, devices and measurements in it.
+    """
+    if Path(path).exists():
+        raise FileExistsError(path)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+
+    room_rows, device_rows, state_rows, sensors = [], [], [], []
+    for level in range(1, floors + 1):
+        for number in range(rooms):
+            room_id = len(room_rows) + 1
+            room_rows.append((room_id, level, round(rng.uniform(5, 40), 2), f"{ROOM_NAMES[number % len(ROOM_NAMES)]} {level}.{number + 1}"))
+            for index in range(devices):
+                device_id = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+                # Omlag to av tre einingar er sensorar, og kvart rom har ein temperatur- og ein fuktsensor
+                if index < len(SENSOR_KINDS) and (index < 2 or rng.random() < 0.5):
+                    kind = SENSOR_KINDS[index]
+                    device_rows.append((device_id, room_id, kind[0], "sensor", "Synthetic Supplies", f"{kind[0]} {index}"))
+                    sensors.append((device_id, kind))
+                else:
+                    kind = rng.choice(ACTUATOR_KINDS)
+                    device_rows.append((device_id, room_id, kind, "actuator", "Synthetic Supplies", f"{kind} {index}"))
+                    state_rows.append((device_id, rng.choice([None, 1.0, round(rng.uniform(15, 25), 1)])))
+    conn.executemany("INSERT INTO rooms VALUES (?, ?, ?, ?);", room_rows)
+    conn.executemany("INSERT INTO devices VALUES (?, ?, ?, ?, ?, ?);", device_rows)
+    conn.executemany("INSERT INTO states VALUES (?, ?);", state_rows)
+
+    first = datetime.fromisoformat(start)
+    steps = days * 24 * 60 // interval
+
+    def readings():
+        for step in range(steps):
+            ts = first + timedelta(minutes=step * interval)
+            stamp = ts.strftime("%Y-%m-%d %H:%M:%S")
+            daily = math.sin((ts.hour * 60 + ts.minute) / 1440 * 2 * math.pi)
+            for device_id, (_, _, unit, mean, amplitude, noise) in sensors:
+                yield device_id, stamp, round(mean + amplitude * daily + rng.gauss(0, noise), 2), unit
+
+    conn.executemany("INSERT INTO measurements VALUES (?, ?, ?, ?);", readings())
+    conn.commit()
+    conn.close()
+
+    # Indeksar og aggregat vert bygde av migreringane til repositoryet
+    SmartHouseRepository(path).close()
+    return {"floors": floors, "rooms": len(room_rows), "devices": len(device_rows), "measurements": steps * len(sensors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path")
+    parser.add_argument("--floors", type=int, default=2)
+    parser.add_argument("--rooms", type=int, default=6, help="rooms per floor")
+    parser.add_argument("--devices", type=int, default=5, help="devices per room")
+    parser.add_argument("--days", type=int, default=30, help="days of measurements")
+    parser.add_argument("--interval", type=int, default=10, help="minutes between two readings of a sensor")
+    parser.add_argument("--start", default="2024-01-01")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.path, args.floors, args.rooms, args.devices, args.days, args.interval, args.start, args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Times the repository operations and the REST API routes of the smarthouse
+against a database (by default a synthetic one from `benchmarks/generator.py`)
+and reports p50/p99 latencies and the peak of traced Python allocations per
+operation. The results can be saved as JSON and compared with an earlier run:
+
+    python benchmarks/run.py --generate --days 365 --output results.json
+    python benchmarks/run.py --db /tmp/house.sql --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from urllib.parse import quote
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from generator import generate
+
+
+def measure(fn: Callable[[], object], repeat: int) -> dict:
+    """
+    Calls `fn` `repeat` times and returns the latency percentiles in milliseconds
+    and the peak of traced allocations in KiB (measured in one extra call, since
+    tracing slows everything down).
+    """
+    fn()  # oppvarming: cachar, førebudde spørringar
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    durations.sort()
+    return {
+        "runs": repeat,
+        "p50_ms": round(statistics.median(durations), 3),
+        "p99_ms": round(durations[min(len(durations) - 1, int(len(durations) * 0.99))], 3),
+        "mean_ms": round(statistics.fmean(durations), 3),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def describe(path: str) -> dict:
+    conn = sqlite3.connect(path)
+    info = {name: conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0] for name in ("rooms", "devices", "measurements")}
+    conn.close()
+    info["size_bytes"] = os.path.getsize(path)
+    return info
+
+
+def bench_repository(path: str, repeat: int, rng: random.Random) -> Dict[str, dict]:
+    from smarthouse.persistence import SmartHouseRepository
+
+    repo = SmartHouseRepository(path)
+    house = repo.load_smarthouse_deep()
+    sensors = [d for d in house.get_devices() if d.is_sensor()]
+    rooms = [r for r in house.get_rooms() if r.room_name]
+    humid = [r for r in rooms if any(d.device_type == "Humidity Sensor" for d in r.devices)] or rooms
+    first, last = repo.cursor().execute("SELECT MIN(ts), MAX(ts) FROM measurements").fetchone()
+    days = sorted({first[:10], last[:10]})
+
+    results = {
+        "load_smarthouse_deep": measure(repo.load_smarthouse_deep, max(1, repeat // 10)),
+        # Utan cachen for siste måling, slik at kvar kall går mot databasen
+        "get_latest_reading": measure(lambda: repo.get_latest_reading(rng.choice(sensors)), repeat),
+        "get_all_readings": measure(lambda: repo.get_all_readings(rng.choice(sensors), 100), repeat),
+        "calc_avg_temperatures_in_room": measure(lambda: repo.calc_avg_temperatures_in_room(rng.choice(rooms)), repeat),
+        "calc_hours_with_humidity_above": measure(lambda: repo.calc_hours_with_humidity_above(rng.choice(humid), rng.choice(days)), repeat),
+    }
+    repo.close()
+    return results
+
+
+def bench_api(path: str, repeat: int, rng: random.Random) -> Dict[str, dict]:
+    os.environ["SMARTHOUSE_DB"] = path
+    from fastapi.testclient import TestClient
+    from smarthouse import api
+
+    house = api.smarthouse
+    sensors = [d for d in house.get_devices() if d.is_sensor()]
+    rooms = [r for r in house.get_rooms() if r.room_name]
+
+    def get(url: Callable[[], str]) -> Callable[[], object]:
+        def call():
+            response = client.get(url())
+            assert response.status_code == 200, (response.url, response.status_code, response.text)
+        return call
+
+    def room_url(room, suffix: str = "") -> str:
+        return f"/smarthouse/floor/{room.floor.level}/room/{quote(room.room_name)}{suffix}"
+
+    results = {}
+    with TestClient(api.app) as client:
+        routes = {
+            "GET /smarthouse": get(lambda: "/smarthouse"),
+            "GET /smarthouse/device": get(lambda: "/smarthouse/device"),
+            "GET /smarthouse/device/{uuid}": get(lambda: f"/smarthouse/device/{rng.choice(sensors).id}"),
+            # Desse to endepunkta les sensor-id-en frå spørjeparameteren `uiid`
+            "GET /smarthouse/sensor/{uuid}/current": get(lambda: f"/smarthouse/sensor/{{uuid}}/current?uiid={rng.choice(sensors).id}"),
+            "GET /smarthouse/sensor/{uuid}/values_limit_n": get(lambda: f"/smarthouse/sensor/{{uuid}}/values_limit_n?uiid={rng.choice(sensors).id}&n=100"),
+            "GET /smarthouse/sensor/{uuid}/downsampled": get(lambda: f"/smarthouse/sensor/{rng.choice(sensors).id}/downsampled?points=500"),
+            "GET .../room/{rid}/avg_temperatures": get(lambda: room_url(rng.choice(rooms), "/avg_temperatures")),
+        }
+        for name, call in routes.items():
+            results[name] = measure(call, repeat)
+    return results
+
+
+def report(results: Dict[str, dict], baseline: Optional[Dict[str, dict]] = None):
+    print(f"{'operation':<48} {'p50 ms':>10} {'p99 ms':>10} {'peak KiB':>10}" + (f" {'p50 vs base':>12}" if baseline else ""))
+    for name, result in results.items():
+        line = f"{name:<48} {result['p50_ms']:>10.3f} {result['p99_ms']:>10.3f} {result['peak_kib']:>10.1f}"
+        if baseline and name in baseline and baseline[name]["p50_ms"] > 0:
+            line += f" {result['p50_ms'] / baseline[name]['p50_ms']:>11.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", help="database to benchmark (default: data/db.sql, or a generated one with --generate)")
+    parser.add_argument("--generate", action="store_true", help="benchmark a freshly generated synthetic database")
+    parser.add_argument("--floors", type=int, default=2)
+    parser.add_argument("--rooms", type=int, default=6)
+    parser.add_argument("--devices", type=int, default=5)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--interval", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-api", action="store_true")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare the p50 latencies with")
+    args = parser.parse_args()
+
+    if args.generate:
+        args.db = os.path.join(tempfile.mkdtemp(prefix="smarthouse-bench-"), "house.sql")
+        print("generated", generate(args.db, args.floors, args.rooms, args.devices, args.days, args.interval, seed=args.seed))
+    path = args.db or str(Path(__file__).parent.parent / "data" / "db.sql")
+
+    rng = random.Random(args.seed)
+    results = bench_repository(path, args.repeat, rng)
+    if not args.skip_api:
+        results.update(bench_api(path, args.repeat, rng))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "database": describe(path),
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, TypeVar, Union
+from datetime import datetime
+from smarthouse.domain import Measurement, MeasurementSeries
+from smarthouse.persistence import SmartHouseRepository
+
+T = TypeVar("T")
+
+
+class AsyncSmartHouseRepository:
+    """
+    Provides an `async` interface to a _SmartHouseRepository_ for use in `async def` endpoints.
+    Reading methods run on a pool of reader threads (each thread reads through its own
+    connection, see `SmartHouseRepository.read_cursor`), so concurrent readers neither block
+    each other nor the event loop. Writing methods are queued on a single writer thread
+    and are therefore executed one after another in the order they were submitted.
+    """
+
+    def __init__(self, repo: SmartHouseRepository, readers: int = 4) -> None:
+        self.repo = repo
+        self.read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="smarthouse-reader")
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="smarthouse-writer")
+
+    def bound_to(self, repo: SmartHouseRepository) -> "AsyncSmartHouseRepository":
+        """
+        Returns an interface to another repository (e.g. the shard of a house) that runs on
+        the threads of this one. It is not closed on its own, only together with this one.
+        """
+        bound = AsyncSmartHouseRepository.__new__(AsyncSmartHouseRepository)
+        bound.repo = repo
+        bound.read_executor = self.read_executor
+        bound.write_executor = self.write_executor
+        return bound
+
+    async def read(self, fn: Callable[..., T], *args) -> T:
+        """
+        Runs the given (reading) function on the reader pool.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.read_executor, functools.partial(fn, *args))
+
+    async def write(self, fn: Callable[..., T], *args) -> T:
+        """
+        Runs the given (writing) function on the writer thread.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.write_executor, functools.partial(fn, *args))
+
+    def close(self):
+        """
+        Waits for all submitted operations and stops the threads.
+        """
+        self.write_executor.shutdown(wait=True)
+        self.read_executor.shutdown(wait=True)
+
+    # Lesing
+
+    async def get_latest_reading(self, sensor) -> Optional[Measurement]:
+        # Treff i cachen vert svara direkte utan å gå via lesetrådane
+        cache = self.repo.latest_cache
+        if cache is not None:
+            found, reading = cache.get(sensor.id)
+            if found:
+                return reading
+        return await self.read(self.repo._query_latest_reading, sensor)
+
+    async def get_all_readings(self, sensor, limit) -> Optional[List[Measurement]]:
+        return await self.read(self.repo.get_all_readings, sensor, limit)
+
+    async def get_readings_series(self, sensor, from_ts: Optional[str] = None, until_ts: Optional[str] = None) -> MeasurementSeries:
+        return await self.read(self.repo.get_readings_series, sensor, from_ts, until_ts)
+
+    async def get_downsampled_readings(self, sensor, points: int = 1000, from_ts: Optional[str] = None,
+                                       until_ts: Optional[str] = None, method: str = "buckets",
+                                       unit: Optional[str] = None) -> List[dict]:
+        return await self.read(self.repo.get_downsampled_readings, sensor, points, from_ts, until_ts, method, unit)
+
+    async def calc_avg_temperatures_in_room(self, room, from_date: Optional[str] = None, until_date: Optional[str] = None) -> dict:
+        return await self.read(self.repo.calc_avg_temperatures_in_room, room, from_date, until_date)
+
+    async def calc_hours_with_humidity_above(self, room, date: str) -> list:
+        return await self.read(self.repo.calc_hours_with_humidity_above, room, date)
+
+    async def get_device_rollups(self, sensor, granularity: str = "hour", from_bucket: Optional[str] = None,
+                                 until_bucket: Optional[str] = None) -> List[dict]:
+        return await self.read(self.repo.get_device_rollups, sensor, granularity, from_bucket, until_bucket)
+
+    async def get_room_rollups(self, room, granularity: str = "hour", unit: Optional[str] = None,
+                               from_bucket: Optional[str] = None, until_bucket: Optional[str] = None) -> List[dict]:
+        return await self.read(self.repo.get_room_rollups, room, granularity, unit, from_bucket, until_bucket)
+
+    # Skriving
+
+    async def add_measurment(self, sensor_ID: str, timestamp: datetime, value: float, unit: str) -> bool:
+        return await self.write(self.repo.add_measurment, sensor_ID, timestamp, value, unit)
+
+    async def add_measurements(self, readings: List[Tuple[str, Union[datetime, str], float, str]]) -> int:
+        return await self.write(self.repo.add_measurements, readings)
+
+    async def removing_oldest_reading_from_database(self, sensor) -> bool:
+        return await self.write(self.repo.removing_oldest_reading_from_database, sensor)
+
+    async def update_actuator_state(self, actuator):
+        return await self.write(self.repo.update_actuator_state, actuator)
+
+    async def update_actuator_states(self, actuators) -> int:
+        return await self.write(self.repo.update_actuator_states, actuators)
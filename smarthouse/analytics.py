@@ -0,0 +1,253 @@
+"""
+Numerical helpers for sensor series, written against plain sequences
+(e.g. the `array` columns of a `MeasurementSeries`) without further dependencies.
+Timestamps are milliseconds since the epoch in ascending order; results are
+returned as compact `array` columns. Apart from percentiles (one sort) every
+function makes a single pass over its input.
+"""
+import math
+from array import array
+from typing import Dict, List, Optional, Sequence, Tuple
+from smarthouse.domain import MeasurementSeries
+
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+
+
+def lttb(timestamps: Sequence[float], values: Sequence[float], threshold: int) -> List[int]:
+    """
+    Largest-Triangle-Three-Buckets downsampling: selects `threshold` points of the
+    series (always including the first and the last one) that preserve its visual
+    shape, and returns their indices in ascending order. Series with no more than
+    `threshold` points are returned completely.
+    """
+    n = len(values)
+    if threshold >= n:
+        return list(range(n))
+    if threshold < 3:
+        raise ValueError("LTTB needs at least 3 points")
+
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # Gjennomsnittet av neste bøtte er det tredje hjørnet i trekanten
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        count = next_end - next_start
+        avg_x = sum(timestamps[next_start:next_end]) / count
+        avg_y = sum(values[next_start:next_end]) / count
+
+        # Punktet i denne bøtta som gjev den største trekanten saman med førre valde punkt
+        ax, ay = timestamps[a], values[a]
+        dx, dy = ax - avg_x, avg_y - ay
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        a = max(range(start, end), key=lambda j: abs(dx * (values[j] - ay) + (timestamps[j] - ax) * dy))
+        selected.append(a)
+    selected.append(n - 1)
+    return selected
+
+
+def bucket_means(timestamps: Sequence[int], values: Sequence[float], width: int) -> Tuple[array, array]:
+    """
+    Averages the readings in consecutive time buckets of `width` milliseconds (aligned
+    to the epoch). Returns the starts of the non-empty buckets and their means.
+    """
+    starts, means = array("q"), array("d")
+    current, total, count = None, 0.0, 0
+    for ts, value in zip(timestamps, values):
+        bucket = ts - ts % width
+        if bucket != current:
+            if count:
+                starts.append(current)
+                means.append(total / count)
+            current, total, count = bucket, 0.0, 0
+        total += value
+        count += 1
+    if count:
+        starts.append(current)
+        means.append(total / count)
+    return starts, means
+
+
+def rolling_mean(timestamps: Sequence[int], values: Sequence[float], window: int) -> array:
+    """
+    Returns for every reading the mean of the readings in the trailing time window
+    `(ts - window, ts]`, i.e. a time based (not count based) moving average.
+    """
+    result = array("d")
+    total, start = 0.0, 0
+    for i, ts in enumerate(timestamps):
+        total += values[i]
+        while timestamps[start] <= ts - window:
+            total -= values[start]
+            start += 1
+        result.append(total / (i - start + 1))
+    return result
+
+
+def percentiles(values: Sequence[float], quantiles: Sequence[float]) -> array:
+    """
+    Returns the given percentiles (0-100) of the values, interpolating linearly
+    between the two closest ranks. Empty input gives NaN.
+    """
+    ordered = sorted(values)
+    n = len(ordered)
+    result = array("d")
+    for q in quantiles:
+        if not n:
+            result.append(math.nan)
+            continue
+        position = (n - 1) * q / 100
+        lower = int(position)
+        upper = min(lower + 1, n - 1)
+        result.append(ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower))
+    return result
+
+
+def exceedance_by_hour(timestamps: Sequence[int], values: Sequence[float], threshold: float,
+                       width: int = HOUR_MS) -> Tuple[array, array]:
+    """
+    Counts the readings above `threshold` per hour (or per bucket of `width` milliseconds).
+    Returns the starts of the buckets that have readings and their counts (possibly 0).
+    """
+    starts, counts = array("q"), array("l")
+    current = None
+    for ts, value in zip(timestamps, values):
+        bucket = ts - ts % width
+        if bucket != current:
+            starts.append(bucket)
+            counts.append(0)
+            current = bucket
+        if value > threshold:
+            counts[-1] += 1
+    return starts, counts
+
+
+def degree_days(timestamps: Sequence[int], values: Sequence[float], base: float = 17.0,
+                heating: bool = True) -> Tuple[array, array]:
+    """
+    Heating degree-days (`max(0, base - daily mean)`) or, with `heating=False`, cooling
+    degree-days (`max(0, daily mean - base)`) of a temperature series. Returns the
+    starts of the days with readings and their degree-days.
+    """
+    days, means = bucket_means(timestamps, values, DAY_MS)
+    sign = 1 if heating else -1
+    return days, array("d", (max(0.0, sign * (base - mean)) for mean in means))
+
+
+def correlation(a: Tuple[Sequence[int], Sequence[float]], b: Tuple[Sequence[int], Sequence[float]],
+                width: int = HOUR_MS) -> Optional[float]:
+    """
+    Pearson correlation of two series `(timestamps, values)` after averaging both
+    in buckets of `width` milliseconds; only buckets present in both series count.
+    Returns None with fewer than three common buckets or a constant series.
+    """
+    return _pearson(bucket_means(a[0], a[1], width), bucket_means(b[0], b[1], width))
+
+
+def correlation_matrix(series: Sequence[Tuple[Sequence[int], Sequence[float]]],
+                       width: int = HOUR_MS) -> List[List[Optional[float]]]:
+    """
+    Pairwise `correlation` of the given series; every series is bucketed only once.
+    """
+    bucketed = [bucket_means(timestamps, values, width) for timestamps, values in series]
+    matrix = [[None] * len(bucketed) for _ in bucketed]
+    for i in range(len(bucketed)):
+        matrix[i][i] = 1.0 if _pearson(bucketed[i], bucketed[i]) is not None else None
+        for j in range(i + 1, len(bucketed)):
+            matrix[i][j] = matrix[j][i] = _pearson(bucketed[i], bucketed[j])
+    return matrix
+
+
+def _pearson(a: Tuple[array, array], b: Tuple[array, array]) -> Optional[float]:
+    # Flettar dei to sorterte bøtte-kolonnane og summerer berre over felles bøtter
+    (a_starts, a_means), (b_starts, b_means) = a, b
+    i = j = n = 0
+    sx = sy = sxx = syy = sxy = 0.0
+    while i < len(a_starts) and j < len(b_starts):
+        if a_starts[i] < b_starts[j]:
+            i += 1
+        elif a_starts[i] > b_starts[j]:
+            j += 1
+        else:
+            x, y = a_means[i], b_means[j]
+            sx += x
+            sy += y
+            sxx += x * x
+            syy += y * y
+            sxy += x * y
+            n += 1
+            i += 1
+            j += 1
+    if n < 3:
+        return None
+    cov = sxy - sx * sy / n
+    var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+    if var <= 0:
+        return None
+    return max(-1.0, min(1.0, cov / math.sqrt(var)))
+
+
+def split_by_unit(series: MeasurementSeries) -> Dict[Optional[str], Tuple[array, array]]:
+    """
+    Splits a series into one `(timestamps, values)` pair of columns per unit, in the order
+    the units first occur. The columns of a series in a single unit are returned as they are.
+    """
+    units = series.units
+    if not units or units.count(units[0]) == len(units):
+        return {units[0]: (series.timestamps, series.values)} if units else {}
+    columns: Dict[Optional[str], Tuple[array, array]] = {}
+    for timestamp, value, unit in zip(series.timestamps, series.values, units):
+        column = columns.get(unit)
+        if column is None:
+            column = columns[unit] = (array("q"), array("d"))
+        column[0].append(timestamp)
+        column[1].append(value)
+    return columns
+
+
+def scope_report(series: Dict[str, MeasurementSeries], window: int = HOUR_MS, threshold: Optional[float] = None,
+                 base: float = 17.0, quantiles: Sequence[float] = (5, 50, 95)) -> dict:
+    """
+    Statistics for the series of a room, a floor or the whole house (device id -> series).
+    A device can have readings in several units, so the readings are grouped by device and unit:
+
+    * `devices`: per device and unit the number of readings, the mean, the given
+      percentiles (`p5`, `p50`, ...), the highest `window` rolling mean and, with a
+      `threshold`, the readings above it per hour (`exceedance`: `hours`, `counts`).
+    * `degree_days`: heating degree-days over `base` of the mean of the daily means
+      of all readings in °C (`days`, `values`, `total`).
+    * `correlations`: the hourly correlation matrix of the (device, unit) series.
+
+    Time columns are in milliseconds since the epoch.
+    """
+    devices = []
+    correlated = []
+    columns = []
+    daily: Dict[int, List[float]] = {}
+    for device_id, s in series.items():
+        for unit, (timestamps, values) in split_by_unit(s).items():
+            n = len(values)
+            entry = {"device": device_id, "unit": unit, "count": n, "mean": math.fsum(values) / n}
+            for q, value in zip(quantiles, percentiles(values, quantiles)):
+                entry[f"p{q:g}"] = value
+            entry["max_rolling_mean"] = max(rolling_mean(timestamps, values, window))
+            if threshold is not None:
+                hours, counts = exceedance_by_hour(timestamps, values, threshold)
+                entry["exceedance"] = {"hours": hours.tolist(), "counts": counts.tolist()}
+            devices.append(entry)
+            correlated.append({"device": device_id, "unit": unit})
+            columns.append((timestamps, values))
+            if unit == "°C":
+                for day, mean in zip(*bucket_means(timestamps, values, DAY_MS)):
+                    daily.setdefault(day, []).append(mean)
+
+    days = sorted(daily)
+    heating = [max(0.0, base - math.fsum(daily[day]) / len(daily[day])) for day in days]
+    return {
+        "devices": devices,
+        "degree_days": {"days": days, "values": heating, "total": math.fsum(heating)},
+        "correlations": {"series": correlated, "matrix": correlation_matrix(columns)},
+    }
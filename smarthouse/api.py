@@ -1,24 +1,117 @@
+import asyncio
+import base64
+import functools
+import hashlib
+import itertools
+import orjson
 import uvicorn
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, Response, WebSocket
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from smarthouse.persistence import SmartHouseRepository
+from fastapi.responses import ORJSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from smarthouse.aio import AsyncSmartHouseRepository
+from smarthouse.analytics import scope_report
+from smarthouse.metrics import Metrics, MetricsMiddleware, instrument
+from smarthouse.persistence import SmartHouseRepository, StateFollower
+from smarthouse.pubsub import Broker, parse_topic
+from smarthouse.retention import RetentionEngine, RetentionPolicy
+from smarthouse.tenants import Tenant, TenantRegistry, WrongShard
+from smarthouse.schemas import CurrentReading, DeviceInfo, FloorInfo, HouseInfo, ReadingColumns, RoomInfo, SensorReading
 from pathlib import Path
-from typing import List,Dict,Union
-from datetime import datetime
-from smarthouse.domain import Actuator
+from typing import Callable,List,Dict,Optional,Union
+from datetime import datetime, timedelta
+from smarthouse.domain import Actuator, parse_timestamp, timestamp_to_epoch_ms
 import os
 
 def setup_database():
     project_dir = Path(__file__).parent.parent
     db_file = project_dir / "data" / "db.sql" # you have to adjust this if you have changed the file name of the database
+    # SMARTHOUSE_DB peikar på ein annan database, t.d. ein generert av benchmarks/generator.py
+    if os.environ.get("SMARTHOUSE_DB"):
+        db_file = Path(os.environ["SMARTHOUSE_DB"])
     return SmartHouseRepository(str(db_file.absolute()))
 
-app = FastAPI()
+# Svar vert serialiserte med orjson; endepunkt på varme stiar returnerer ORJSONResponse
+# direkte og hoppar dermed over validering av svaret mot skjemaet (sjå smarthouse.schemas)
+app = FastAPI(default_response_class=ORJSONResponse)
 
 repo = setup_database()
 
-smarthouse = repo.load_smarthouse_deep()
+# Måling av svartider (SMARTHOUSE_METRICS=1) for HTTP-ruter og repository-metodar, eksponert på /metrics.
+# Kall som tek meir enn SMARTHOUSE_SLOW_QUERY_MS millisekund vert i tillegg logga.
+# Når det er slått av vert verken middleware eller wrapperar installerte.
+metrics: Optional[Metrics] = None
+if os.environ.get("SMARTHOUSE_METRICS") == "1":
+    slow_query_ms = os.environ.get("SMARTHOUSE_SLOW_QUERY_MS")
+    metrics = Metrics(slow_threshold=float(slow_query_ms) / 1000 if slow_query_ms else None)
+    instrument(repo, metrics)
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+# Async grensesnitt mot repository: lesing i ein trådpool, skriving i éin skrivetråd
+arepo = AsyncSmartHouseRepository(repo, int(os.environ.get("SMARTHOUSE_DB_READERS", "4")))
+
+# Write-behind for enkeltmålingar (gruppe-commit i bakgrunnen) vert slått på med SMARTHOUSE_WRITE_BEHIND=1
+if os.environ.get("SMARTHOUSE_WRITE_BEHIND") == "1":
+    repo.enable_write_behind()
+
+# Med SMARTHOUSE_STATE_COALESCE_MS=<ms> vert aktuator-tilstandar samla i tidsvindauge og skrivne i éin transaksjon
+if int(os.environ.get("SMARTHOUSE_STATE_COALESCE_MS", "0")) > 0:
+    repo.enable_state_coalescing(int(os.environ["SMARTHOUSE_STATE_COALESCE_MS"]) / 1000)
+
+# Siste måling per sensor vert halde i minnet (SMARTHOUSE_LATEST_CACHE_SIZE sensorar, 0 slår cachen av)
+latest_cache_size = int(os.environ.get("SMARTHOUSE_LATEST_CACHE_SIZE", "1024"))
+if latest_cache_size > 0:
+    repo.enable_latest_cache(latest_cache_size)
+
+# Med SMARTHOUSE_LAZY=1 vert huset lasta etasje for etasje ved behov i staden for alt ved oppstart
+# Med SMARTHOUSE_SNAPSHOT vert strukturen lasta frå ei snapshot-fil (sjå smarthouse.serve --workers)
+if os.environ.get("SMARTHOUSE_LAZY") == "1":
+    smarthouse = repo.load_smarthouse_lazy(int(os.environ.get("SMARTHOUSE_LAZY_CACHE_SIZE", "64")))
+elif os.environ.get("SMARTHOUSE_SNAPSHOT"):
+    smarthouse = repo.load_smarthouse_snapshot(os.environ["SMARTHOUSE_SNAPSHOT"])
+else:
+    smarthouse = repo.load_smarthouse_deep()
+
+# Sletting av gamle rådata: SMARTHOUSE_RETENTION_DAYS og/eller SMARTHOUSE_RETENTION_MAX_COUNT
+# gjeld for alle devicar og vert køyrd kvar SMARTHOUSE_RETENTION_INTERVAL sekund (aggregata vert behaldne).
+# Med SMARTHOUSE_COMPACT_AFTER_DAYS vert eldre målingar i same køyring flytta til den komprimerte lagringa.
+retention_days = os.environ.get("SMARTHOUSE_RETENTION_DAYS")
+retention_count = os.environ.get("SMARTHOUSE_RETENTION_MAX_COUNT")
+compact_days = os.environ.get("SMARTHOUSE_COMPACT_AFTER_DAYS")
+retention = RetentionEngine(repo, [], interval=float(os.environ.get("SMARTHOUSE_RETENTION_INTERVAL", "3600")),
+                            compact_after=timedelta(days=float(compact_days)) if compact_days else None)
+if retention_days or retention_count:
+    retention.policies.append(RetentionPolicy(max_age=timedelta(days=float(retention_days)) if retention_days else None,
+                                              max_count=int(retention_count) if retention_count else None))
+if retention_days or retention_count or compact_days:
+    retention.start()
+
+# Nye målingar og aktuator-tilstandar vert sende vidare til abonnentane (WebSocket/SSE)
+broker = Broker(smarthouse, int(os.environ.get("SMARTHOUSE_SUBSCRIBER_QUEUE", "1024")))
+repo.add_listener(broker.publish)
+
+# Med SMARTHOUSE_FOLLOW_STATES=1 vert aktuator-tilstandar som andre prosessar har endra i databasen
+# tekne inn i huset (og sende til abonnentane) kvar SMARTHOUSE_FOLLOW_INTERVAL_MS millisekund
+follower: Optional[StateFollower] = None
+if os.environ.get("SMARTHOUSE_FOLLOW_STATES") == "1":
+    follower = StateFollower(repo, smarthouse, int(os.environ.get("SMARTHOUSE_FOLLOW_INTERVAL_MS", "100")) / 1000)
+    follower.start()
+
+# Fleire hus i same prosess: med SMARTHOUSE_TENANTS_DIR vert /houses/{house_id}/smarthouse/... svara frå
+# databasen <katalog>/<house_id>.sql. Høgst SMARTHOUSE_TENANT_CAPACITY hus er opne samstundes, og hus som
+# ikkje er brukte på SMARTHOUSE_TENANT_IDLE_S sekund vert stengde. Med SMARTHOUSE_SHARD=<i>/<n> svarar
+# prosessen berre for husa der shard_for(house_id, n) == i. Kvart hus har høgst SMARTHOUSE_TENANT_READERS
+# lese-tilkoplingar. Hendingar (events/subscribe) og sletting av gamle rådata gjeld berre huset til prosessen.
+tenants: Optional[TenantRegistry] = None
+if os.environ.get("SMARTHOUSE_TENANTS_DIR"):
+    shard, shards = (int(part) for part in os.environ.get("SMARTHOUSE_SHARD", "0/1").split("/"))
+    tenants = TenantRegistry(os.environ["SMARTHOUSE_TENANTS_DIR"],
+                             capacity=int(os.environ.get("SMARTHOUSE_TENANT_CAPACITY", "64")),
+                             idle_timeout=float(os.environ.get("SMARTHOUSE_TENANT_IDLE_S", "600")),
+                             shard=shard, shards=shards,
+                             on_open=functools.partial(instrument, metrics=metrics) if metrics is not None else None,
+                             max_readers=int(os.environ.get("SMARTHOUSE_TENANT_READERS", "2")))
+    tenants.start()
 
 if not (Path.cwd() / "www").exists():
     os.chdir(Path.cwd().parent)
@@ -27,6 +120,105 @@ if (Path.cwd() / "www").exists():
     app.mount("/static", StaticFiles(directory="www"), name="static")
 
 
+# Skriv alle bufra målingar til databasen før prosessen avsluttar
+@app.on_event("shutdown")
+def flush_measurements():
+    retention.stop()
+    if follower is not None:
+        follower.stop()
+    if tenants is not None:
+        tenants.close()
+    arepo.close()
+    if repo.write_buffer:
+        repo.write_buffer.close()
+        repo.write_buffer = None
+    if repo.state_coalescer:
+        repo.state_coalescer.close()
+        repo.state_coalescer = None
+
+
+# Ferdig serialiserte svar for strukturendepunkta: nøkkel -> (versjon av huset, JSON, ETag)
+structure_cache: Dict[tuple, tuple] = {}
+
+
+class HouseContext:
+    """
+    The house a request is served from: the house of this process for `/smarthouse/...`,
+    or a tenant of `tenants` for `/houses/{house_id}/smarthouse/...`. The endpoints of
+    `router` get it from `house_context` and serve both APIs with the same code.
+    """
+
+    __slots__ = ("house", "repo", "arepo", "structure_cache", "tenant")
+
+    def __init__(self, house, repo: SmartHouseRepository, arepo: AsyncSmartHouseRepository,
+                 structure_cache: Dict[tuple, tuple], tenant: Optional[Tenant] = None) -> None:
+        self.house = house
+        self.repo = repo
+        self.arepo = arepo
+        self.structure_cache = structure_cache
+        self.tenant = tenant
+
+    def retain(self) -> Callable[[], None]:
+        """
+        Keeps the house open beyond the request (e.g. while a response is streamed)
+        and returns the function that ends this.
+        """
+        if self.tenant is None:
+            return lambda: None
+        tenants.retain(self.tenant)
+        return functools.partial(tenants.release, self.tenant)
+
+
+def house_context(request: Request):
+    house_id = request.path_params.get("house_id")
+    if house_id is None:
+        yield HouseContext(smarthouse, repo, arepo, structure_cache)
+        return
+    try:
+        tenant = tenants.acquire(house_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except WrongShard as e:
+        raise HTTPException(status_code=421, detail=str(e), headers={"X-Smarthouse-Shard": str(e.owner)})
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Dette huset eksisterer ikkje")
+    try:
+        yield HouseContext(tenant.house, tenant.repo, arepo.bound_to(tenant.repo), tenant.structure_cache, tenant)
+    finally:
+        tenants.release(tenant)
+
+
+# Endepunkta for eitt hus. Dei vert registrerte under /smarthouse og, med SMARTHOUSE_TENANTS_DIR,
+# under /houses/{house_id}/smarthouse (sjå nedst i fila)
+router = APIRouter()
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def _structure_response(request: Request, ctx: HouseContext, key: tuple, build) -> Response:
+    """
+    Returns the payload built by `build()` for the current version of the house
+    (see `SmartHouse.version`). The payload is serialized once per version and served
+    with a strong ETag; clients that send a matching `If-None-Match` get `304 Not Modified`.
+    """
+    version = ctx.house.version
+    cached = ctx.structure_cache.get(key)
+    if cached is None or cached[0] != version:
+        body = orjson.dumps(build())
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        cached = ctx.structure_cache[key] = (version, body, etag)
+    _, body, etag = cached
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
 # http://localhost:8000/ -> welcome page
 @app.get("/")
 def root():
@@ -41,18 +233,18 @@ def hello(name: str = "world"):
 
 # Starting point ...
 # Får all informasjon frå smarthuset
-@app.get("/smarthouse")
-def get_smarthouse_info() -> dict[str, int | float]:
+@router.get("")
+def get_smarthouse_info(request: Request, ctx: HouseContext = Depends(house_context)) -> HouseInfo:
     """
     This endpoint returns an object that provides information
     about the general structure of the smarthouse.
     """
-    return {
-        "no_rooms": len(smarthouse.get_rooms()),
-        "no_floors": len(smarthouse.get_floors()),
-        "registered_devices": len(smarthouse.get_devices()),
-        "area": smarthouse.get_area()
-    }
+    return _structure_response(request, ctx, ("house",), lambda: {
+        "no_rooms": ctx.house.count_rooms(),
+        "no_floors": len(ctx.house.get_floors()),
+        "registered_devices": ctx.house.count_devices(),
+        "area": ctx.house.get_area()
+    })
 
 
 # --------------- Det skal finnes endepunkter for å inspisere strukturen til huset ---------------
@@ -66,9 +258,13 @@ def get_smarthouse_info() -> dict[str, int | float]:
 # GET(HTTP) -> SELECT (SQL)
 
 # Få informasjon frå alle etasjar
-@app.get("/smarthouse/floor")
-def get_smarthouse_floor() -> List[Dict[str, Union[int | List]]]:
-    floorInfo = smarthouse.get_floors()
+@router.get("/floor")
+def get_smarthouse_floor(request: Request, ctx: HouseContext = Depends(house_context)) -> List[FloorInfo]:
+    return _structure_response(request, ctx, ("floors",), lambda: _floor_list(ctx.house))
+
+
+def _floor_list(house) -> List[FloorInfo]:
+    floorInfo = house.get_floors()
     floorsList = []  # Lager ei tom liste
     for floor in floorInfo: # Går gjennom alle etasjer
         floorData = {
@@ -79,76 +275,75 @@ def get_smarthouse_floor() -> List[Dict[str, Union[int | List]]]:
 
 
 # Få informasjon om ein gitt etasje gitt av "fid" = FloorID
-@app.get("/smarthouse/floor/{fid}")
-def get_smarthouse_floor_specific(fid: int) -> dict[str,int]:
+@router.get("/floor/{fid}")
+def get_smarthouse_floor_specific(fid: int, ctx: HouseContext = Depends(house_context)) -> dict[str,int]:
     
-    floorInfo = smarthouse.get_floors()
-    floorData = "", None
-    for floors in floorInfo:
-        if floors.level == fid:
-            return {
-                "Floor Level": floors.level
-            }
+    floor = ctx.house.get_floor(fid)
+    if floor:
+        return {
+            "Floor Level": floor.level
+        }
          
     raise HTTPException(status_code=404, detail="No given floor with this id was found")
          
     
 # Få informasjon om alle room på ein gitt etasje "fid" = FloorID
-@app.get("/smarthouse/floor/{fid}/room")
-def get_smarthouse_AllroomsAtSpecificFloor(fid : int) -> List[Dict[str, int | str | float]]:
-    
-    # Henter alle rom
-    getAllRooms = smarthouse.get_rooms()
+@router.get("/floor/{fid}/room")
+def get_smarthouse_AllroomsAtSpecificFloor(fid : int, request: Request, ctx: HouseContext = Depends(house_context)) -> List[RoomInfo]:
+
+    # Sjekker om etasjen eksisterer, og henter berre romma på denne etasjen
+    floor = ctx.house.get_floor(fid)
+    if floor is None:
+        raise HTTPException(status_code=404, detail="No given floor with this id was found")
+
+    return _structure_response(request, ctx, ("rooms", fid), lambda: _room_list(floor))
+
+
+def _room_list(floor) -> List[RoomInfo]:
+
     # Oppretter ei tom liste
     roomList = []
 
-    # Sjekker om etasjen eksisterer
-    checkFloor = get_smarthouse_floor_specific(fid)
-
-    if checkFloor:
-        for rooms in getAllRooms:
-            if int(rooms.floor.level) == int(fid):
-                roomData = {
-                    "Floor Level" : rooms.floor.level,
-                    "room name" : rooms.room_name,
-                    "room size" : rooms.room_size
-                }
-                roomList.append(roomData)
-        return roomList
+    for rooms in floor.rooms:
+        roomData = {
+            "Floor Level" : rooms.floor.level,
+            "room name" : rooms.room_name,
+            "room size" : rooms.room_size
+        }
+        roomList.append(roomData)
+    return roomList
 
 
 # Informasjon om ein spesific rom {rid} "RoomID" på ein gitt etasje {fid} "FloorID" 
-@app.get("/smarthouse/floor/{fid}/room/{rid}")
-def get_smarthouse_roomAtSpecificFloor(fid : int, rid : str)-> List[Dict[str, int | str | float]]:
+@router.get("/floor/{fid}/room/{rid}")
+def get_smarthouse_roomAtSpecificFloor(fid : int, rid : str, ctx: HouseContext = Depends(house_context))-> List[RoomInfo]:
 
     # Sjekker om etasjen eksisterer
-    HenterData = get_smarthouse_floor_specific(fid)
-    getAllRooms = smarthouse.get_rooms()
-    roomList = []
+    get_smarthouse_floor_specific(fid, ctx)
 
-    if HenterData:
-        for rooms in getAllRooms:
-            if str(rooms.room_name) == str(rid) and int(rooms.floor.level) == int(fid):
-                roomData = {
-                    "Floor Level" : rooms.floor.level,
-                    "room name" : rooms.room_name,
-                    "room size" : rooms.room_size
-                }
-                roomList.append(roomData)
-        # Sjekker om rommet eksisterer, om ikkje vil ein exeption bli returnert
-        if roomList:
-            return roomList
-        else: 
-            raise HTTPException(status_code=404, detail="Dette rommet eksisterer ikkje")
+    # Sjekker om rommet eksisterer, om ikkje vil ein exeption bli returnert
+    rooms = ctx.house.get_room(fid, rid)
+    if rooms is None:
+        raise HTTPException(status_code=404, detail="Dette rommet eksisterer ikkje")
+
+    return ORJSONResponse([{
+        "Floor Level" : rooms.floor.level,
+        "room name" : rooms.room_name,
+        "room size" : rooms.room_size
+    }])
 
     
 # --------- Det skal finnes endepunkter for tilgang til enheter -------------------------------------
 
 # Informasjon om alle devicer
-@app.get("/smarthouse/device")
-def get_smarthouse_device()-> List[Dict[str, int | str | float]]:
+@router.get("/device")
+def get_smarthouse_device(request: Request, ctx: HouseContext = Depends(house_context))-> List[DeviceInfo]:
+    return _structure_response(request, ctx, ("devices",), lambda: _device_list(ctx.house))
+
+
+def _device_list(house) -> List[DeviceInfo]:
     
-    allDevices = smarthouse.get_devices()
+    allDevices = house.get_devices()
     deviceList = []
     for devices in allDevices:
         deviceData = {
@@ -164,169 +359,640 @@ def get_smarthouse_device()-> List[Dict[str, int | str | float]]:
     return deviceList
 
 # Informasjon om ein gitt device identifisert av "uuid" = DeviceID
-@app.get("/smarthouse/device/{uiid}")
-def get_smarthouse_device_by_id(uiid : str)-> List[dict[str, int | float | str]]:
+@router.get("/device/{uiid}")
+def get_smarthouse_device_by_id(uiid : str, ctx: HouseContext = Depends(house_context))-> List[DeviceInfo]:
 
-    allDevices = smarthouse.get_devices()
-    deviceList = []
-
-    for devices in allDevices:        
-        if str(devices.id) == str(uiid):
-            deviceData = {
-                "Device id" : devices.id,
-                "Model Name" : devices.model_name,
-                "Supplier" : devices.supplier,
-                "Device In Room" : devices.room.room_name                           
-            }
-            deviceList.append(deviceData)
-
-    if deviceList:
-        return deviceList
-    else:
+    devices = ctx.house.get_device_by_id(uiid)
+    if devices is None:
         raise HTTPException(status_code=404, detail="Denna id'n matcher ikkje")
 
+    return ORJSONResponse([{
+        "Device id" : devices.id,
+        "Model Name" : devices.model_name,
+        "Supplier" : devices.supplier,
+        "Device In Room" : devices.room.room_name
+    }])
+
    
 
 
 # --------- Det skal finnes spesielle endepunkter for tilgang til sensor funksjoner -----------------
 
 # Get current sensor måling for sensor "uuid" = DeviceID 
-@app.get("/smarthouse/sensor/{uuid}/current")
-def get_smarthouse_sensor_currentMeasurment(uiid:str)-> List[Dict[str, int | float | str]]:
+@router.get("/sensor/{uuid}/current")
+async def get_smarthouse_sensor_currentMeasurment(uiid:str, ctx: HouseContext = Depends(house_context))-> List[CurrentReading]:
     
-    device = smarthouse.get_devices() # Henter alle devices
+    sensor = ctx.house.get_device_by_id(uiid) # Slår opp sensoren på ID
     deviceList = [] # Lager ei tom liste
 
-    for sensor in device: # Går gjennom alle sensorer i smarhuset
-        if str(sensor.id) == str(uiid): # Sjekker sensor ID opp mot ID som er tastet inn
-            SensorReading = repo.get_latest_reading(sensor) # Laster inn siste avlesninger frå sensor
-            if SensorReading: # Sjekker om avlesningen eksisterer
-                sensorData = { # Skriver data
-                    "Verdi" : SensorReading.value,
-                    "Unit" : SensorReading.unit,
-                    "Tid" : SensorReading.timestamp
-                }
-                deviceList.append(sensorData) # Legger sensorData i ei liste
+    if sensor:
+        SensorReading = await ctx.arepo.get_latest_reading(sensor) # Laster inn siste avlesninger frå sensor
+        if SensorReading: # Sjekker om avlesningen eksisterer
+            sensorData = { # Skriver data
+                "Verdi" : SensorReading.value,
+                "Unit" : SensorReading.unit,
+                "Tid" : SensorReading.timestamp
+            }
+            deviceList.append(sensorData) # Legger sensorData i ei liste
 
     # Sjekker om device list eksisterer, ellers blir HTTPExeption sendt
     if deviceList:
-        return deviceList
+        return ORJSONResponse(deviceList)
     else:
         raise HTTPException(status_code=404, detail="Denna sensoren har ikkje noko siste målinger")
 
 # Legg til måling for sensor "uuid" = DeviceID 
-@app.post("/smarthouse/sensor/{uuid}/current")
-def post_smarthouse_sensor_Measurment(uuid : str, measurment_time : str , value : float, unit : str)-> str:
+@router.post("/sensor/{uuid}/current")
+async def post_smarthouse_sensor_Measurment(uuid : str, measurment_time : str , value : float, unit : str, ctx: HouseContext = Depends(house_context))-> str:
     
     # Check if sensor exsist
-    device = smarthouse.get_device_by_id(uuid) # Henter alle devices
+    device = ctx.house.get_device_by_id(uuid) # Henter alle devices
     if device is None:
        raise HTTPException(status_code=404, detail="Sensor not found")
     
-    # Checking time format
+    # Checking time format (teksten vert lagra som han er, i same format som i databasen)
     try:
-        date_object = datetime.strptime(measurment_time, "%Y-%m-%d %H:%M:%S")
+        parse_timestamp(measurment_time)
     except ValueError as e:
         raise HTTPException(status_code=404, detail="Invalid date format")
     
     # Code for adding the measurment to the database, by calling a method from persistence
     try:
-        #measurement = repo.add_measurment(uuid,'2024-04-02 21:00:02',20.2,"Kwh")
-        measurement = repo.add_measurment(uuid, date_object, value, unit)
+        #measurement = ctx.repo.add_measurment(uuid,'2024-04-02 21:00:02',20.2,"Kwh")
+        measurement = await ctx.arepo.add_measurment(uuid, measurment_time, value, unit)
     finally:
         if measurement:
             return "Values are succsesfully added to database"
         else:
             return "Measurments are not added to the database"
 
+# Legg til mange målingar i ein operasjon, for mange sensorar.
+# Body er anten ein JSON-array eller NDJSON (ein JSON-objekt per linje, Content-Type: application/x-ndjson)
+# med objekt på forma {"uuid": ..., "timestamp": "YYYY-MM-DD HH:MM:SS", "value": ..., "unit": ...}
+@router.post("/measurements/batch")
+async def post_smarthouse_measurements_batch(request: Request, ctx: HouseContext = Depends(house_context)) -> dict[str, int | List[Dict[str, int | bool | str]]]:
+
+    # Leser inn body, NDJSON vert lest linje for linje frå straumen
+    if "ndjson" in request.headers.get("content-type", ""):
+        items = []
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            items.extend(_parse_ndjson_line(line) for line in lines if line.strip())
+        if buffer.strip():
+            items.append(_parse_ndjson_line(buffer))
+    else:
+        try:
+            items = orjson.loads(await request.body())
+        except orjson.JSONDecodeError:
+            raise HTTPException(status_code=400, detail="Body is not valid JSON")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Body has to be a JSON array of measurements")
+
+    # Validerer alle radene i eitt pass før noko vert skrive til databasen
+    results = []
+    readings = []
+    for index, item in enumerate(items):
+        reason = _validate_batch_measurement(ctx.house, item)
+        if reason:
+            results.append({"index": index, "accepted": False, "reason": reason})
+        else:
+            results.append({"index": index, "accepted": True})
+            readings.append((item["uuid"], item["timestamp"], float(item["value"]), item.get("unit")))
+
+    # Skriv alle gyldige målingar i ein transaksjon
+    if readings and await ctx.arepo.add_measurements(readings) != len(readings):
+        for result in results:
+            if result["accepted"]:
+                result["accepted"] = False
+                result["reason"] = "Database error"
+
+    accepted = sum(1 for result in results if result["accepted"])
+    return {"accepted": accepted, "rejected": len(results) - accepted, "results": results}
+
+
+# Tellarar for write-behind bufferet (kødjupn, flush-latens osv.)
+@app.get("/smarthouse/measurements/ingest_stats")
+def get_smarthouse_ingest_stats() -> dict[str, bool | int | float]:
+    if repo.write_buffer is None:
+        return {"write_behind": False}
+    return {"write_behind": True, **repo.write_buffer.stats()}
+
+
+# Tellarar for tilkoplingane til databasen (lesarar, ventetid på skrive-tilkoplinga)
+@app.get("/smarthouse/db/stats")
+def get_smarthouse_db_stats() -> dict[str, str | int | float]:
+    stats = repo.pool.stats()
+    if repo.latest_cache is not None:
+        stats.update({f"latest_cache_{key}": value for key, value in repo.latest_cache.stats().items()})
+    return stats
+
+
+def _parse_ndjson_line(line: bytes) -> object:
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return None
+
+
+def _validate_batch_measurement(house, item: object) -> Optional[str]:
+    """
+    Returns the reason why the given batch item is rejected, or None if it is valid.
+    """
+    if not isinstance(item, dict):
+        return "Invalid measurement object"
+    if house.get_device_by_id(str(item.get("uuid"))) is None:
+        return "Sensor not found"
+    try:
+        parse_timestamp(item.get("timestamp"))
+    except (TypeError, ValueError):
+        return "Invalid date format"
+    value = item.get("value")
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return "Invalid value"
+    unit = item.get("unit")
+    if unit is not None and not isinstance(unit, str):
+        return "Invalid unit"
+    return None
+
+
 #  get n siste målinger for sensor uuid. om query parameter ikkje er tilgjengelig, den alle tilgjengelege målinger.
-@app.get("/smarthouse/sensor/{uuid}/values_limit_n")
-def get_smarthouse_sensor_MeasurmentLatestAvailable(uiid:str, n:int)-> List[Dict[str , int | float | str | object]]:
+@router.get("/sensor/{uuid}/values_limit_n")
+async def get_smarthouse_sensor_MeasurmentLatestAvailable(uiid:str, n:int, ctx: HouseContext = Depends(house_context))-> List[SensorReading]:
     
-    device = smarthouse.get_devices() # Henter alle devices
+    sensor = ctx.house.get_device_by_id(uiid) # Slår opp sensoren på ID
     deviceList = [] # Lager ei tom liste
     
-    for sensor in device: # Går gjennom alle sensorer i smarhuset
-        if str(sensor.id) == str(uiid): # Sjekker sensor ID opp mot ID som er tastet inn
-            SensorReading = repo.get_all_readings(sensor,n) #Laster inn n antall avlesninger frå sensor
-            if SensorReading: # Om det er noko avlesning
-                for readings in SensorReading: # Går gjennom alle avlesningane
-                    sensorData = { # Skriver data frå avlesningane
-                    "SensorNavn" : sensor.model_name,
-                    "Verdi" : readings.value,
-                    "Unit" :  readings.unit,
-                    "Tid" :   readings.timestamp
-                    }
-                    deviceList.append(sensorData) # Legger sensorData i ei liste
+    if sensor:
+        SensorReading = await ctx.arepo.get_all_readings(sensor,n) #Laster inn n antall avlesninger frå sensor
+        if SensorReading: # Om det er noko avlesning
+            for readings in SensorReading: # Går gjennom alle avlesningane
+                sensorData = { # Skriver data frå avlesningane
+                "SensorNavn" : sensor.model_name,
+                "Verdi" : readings.value,
+                "Unit" :  readings.unit,
+                "Tid" :   readings.timestamp
+                }
+                deviceList.append(sensorData) # Legger sensorData i ei liste
 
     # Sjekker om device list eksisterer, ellers blir HTTPExeption sendt
     if deviceList:
-        return deviceList
+        return ORJSONResponse(deviceList)
     else:
         raise HTTPException(status_code=404, detail="Denna sensoren har ikkje noko målingar")
 
+
+# Alle målingar for sensor uuid i eit tidsrom som kolonnar (tid i millisekund sidan epoken, verdi, eining).
+# Seriane vert serialiserte direkte frå kolonnane utan eit objekt per måling.
+@router.get("/sensor/{uuid}/series")
+async def get_smarthouse_sensor_series(uuid: str,
+                                       from_ts: Optional[str] = Query(None, alias="from"),
+                                       until_ts: Optional[str] = Query(None, alias="until"),
+                                       ctx: HouseContext = Depends(house_context)) -> ReadingColumns:
+
+    sensor = ctx.house.get_device_by_id(uuid)
+    if sensor is None:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    _check_range(from_ts, until_ts)
+    series = await ctx.arepo.get_readings_series(sensor, from_ts, until_ts)
+    return ORJSONResponse(series.to_columns())
+
+# Alle målingar for sensor uuid i eit tidsrom, strøyma som NDJSON (standard) eller JSON.
+# Kvar måling har ein "cursor"; ein klient som mistar sambandet kan halde fram med ?cursor=<siste cursor>.
+# Med limit vert berre éi side returnert, og "next_cursor" peikar på neste side.
+@router.get("/sensor/{uuid}/values")
+def get_smarthouse_sensor_MeasurmentRange(uuid: str,
+                                          from_ts: Optional[str] = Query(None, alias="from"),
+                                          until_ts: Optional[str] = Query(None, alias="until"),
+                                          cursor: Optional[str] = None,
+                                          limit: Optional[int] = Query(None, gt=0),
+                                          format: str = Query("ndjson", pattern="^(ndjson|json)$"),
+                                          ctx: HouseContext = Depends(house_context)) -> StreamingResponse:
+
+    sensor = ctx.house.get_device_by_id(uuid)
+    if sensor is None:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    # Feil i grensene må gje 400 før svaret startar, ikkje midt i straumen
+    _check_range(from_ts, until_ts)
+
+    after = None
+    if cursor:
+        try:
+            ts, rowid = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+            after = (ts, int(rowid))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    readings = ctx.repo.iter_readings(sensor, from_ts, until_ts, after, batch_size=min(limit or 1000, 1000))
+    if limit:
+        readings = itertools.islice(readings, limit)
+
+    def reading_dicts():
+        for position, reading in readings:
+            yield {
+                "Verdi": reading.value,
+                "Unit": reading.unit,
+                "Tid": reading.timestamp,
+                "cursor": base64.urlsafe_b64encode(f"{position[0]}|{position[1]}".encode()).decode(),
+            }
+
+    def ndjson_chunks():
+        for batch in _batched(reading_dicts(), 1000):
+            yield b"".join(orjson.dumps(item) + b"\n" for item in batch)
+
+    def json_chunks():
+        yield b'{"readings":['
+        last = None
+        count = 0
+        for batch in _batched(reading_dicts(), 1000):
+            yield (b"," if last else b"") + b",".join(orjson.dumps(item) for item in batch)
+            last = batch[-1]
+            count += len(batch)
+        # Neste side finst berre om denne sida var full
+        next_cursor = last["cursor"] if limit and count == limit else None
+        yield b'],"next_cursor":' + orjson.dumps(next_cursor) + b"}"
+
+    # Huset må vere ope til straumen er ferdig, ikkje berre til endepunktet returnerer
+    release = BackgroundTask(ctx.retain())
+    if format == "json":
+        return StreamingResponse(json_chunks(), media_type="application/json", background=release)
+    return StreamingResponse(ndjson_chunks(), media_type="application/x-ndjson", background=release)
+
+
+# Målingane til sensor uuid i eit tidsrom redusert til høgst `points` punkt, for grafar:
+# method=buckets gjev min/max/avg/siste verdi per tidsbøtte, method=lttb vel ut representative målingar.
+# Berre målingar i éi eining vert tekne med: `unit`, eller eininga til den siste målinga frå sensoren
+@router.get("/sensor/{uuid}/downsampled")
+async def get_smarthouse_sensor_downsampled(uuid: str, points: int = Query(1000, ge=3, le=10000),
+                                            method: str = Query("buckets", pattern="^(buckets|lttb)$"),
+                                            from_ts: Optional[str] = Query(None, alias="from"),
+                                            until_ts: Optional[str] = Query(None, alias="until"),
+                                            unit: Optional[str] = None,
+                                            ctx: HouseContext = Depends(house_context)) -> List[Dict[str, int | float | str]]:
+
+    sensor = ctx.house.get_device_by_id(uuid)
+    if sensor is None:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    _check_range(from_ts, until_ts)
+    return ORJSONResponse(await ctx.arepo.get_downsampled_readings(sensor, points, from_ts, until_ts, method, unit))
+
+
+def _check_range(from_ts: Optional[str], until_ts: Optional[str]):
+    # Grensene vert samanlikna som millisekund sidan epoken og må difor vere gyldige ISO 8601-tidspunkt
+    for bound in (from_ts, until_ts):
+        if bound is not None:
+            try:
+                timestamp_to_epoch_ms(bound)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid date format")
+
+
+def _batched(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
 # Slett gamleste måling for sensor uuid
-@app.delete("/smarthouse/sensor/{uuid}/oldest")
-def delete_smarthouse_sensor_MeasurmentLatestAvailable(uuid : str)-> str:
+@router.delete("/sensor/{uuid}/oldest")
+async def delete_smarthouse_sensor_MeasurmentLatestAvailable(uuid : str, ctx: HouseContext = Depends(house_context))-> str:
     
     # Check if sensor exsist
-    device = smarthouse.get_device_by_id(uuid) # Sjekker om device eksisterer
+    device = ctx.house.get_device_by_id(uuid) # Sjekker om device eksisterer
     if device is None:
        raise HTTPException(status_code=404, detail="Sensor not found")
 
     try:
         if device: # Om det er ein device, så køyrer ein fjerning av eldste avlesning
-           sucess = repo.removing_oldest_reading_from_database(device)
+           sucess = await ctx.arepo.removing_oldest_reading_from_database(device)
     finally:
         if sucess:
             return "Oldest reading have been sucesfylly removed"
         else: 
             return "Oldest reading was not removed"
 
+# --------- Statistikk frå dei førehandsaggregerte tabellane (rollups) -----------------------------
+
+# Statistikk (count, sum, min, max, avg) for sensor uuid per minutt, time eller dag
+@router.get("/sensor/{uuid}/rollups")
+async def get_smarthouse_sensor_rollups(uuid: str, granularity: str = Query("hour", pattern="^(minute|hour|day)$"),
+                                  from_bucket: Optional[str] = Query(None, alias="from"),
+                                  until_bucket: Optional[str] = Query(None, alias="until"),
+                                  ctx: HouseContext = Depends(house_context)) -> List[Dict[str, int | float | str]]:
+
+    sensor = ctx.house.get_device_by_id(uuid)
+    if sensor is None:
+        raise HTTPException(status_code=404, detail="Sensor not found")
+    return await ctx.arepo.get_device_rollups(sensor, granularity, from_bucket, until_bucket)
+
+
+# Statistikk for alle devicar i rommet {rid} på etasje {fid} per time eller dag, gruppert på eining
+@router.get("/floor/{fid}/room/{rid}/rollups")
+async def get_smarthouse_room_rollups(fid: int, rid: str, granularity: str = Query("hour", pattern="^(hour|day)$"),
+                                unit: Optional[str] = None,
+                                from_bucket: Optional[str] = Query(None, alias="from"),
+                                until_bucket: Optional[str] = Query(None, alias="until"),
+                                ctx: HouseContext = Depends(house_context)) -> List[Dict[str, int | float | str]]:
+
+    room = ctx.house.get_room(fid, rid)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Dette rommet eksisterer ikkje")
+    return await ctx.arepo.get_room_rollups(room, granularity, unit, from_bucket, until_bucket)
+
+
+# Statistikk for målingane i eit rom (floor og room), ein etasje (floor) eller heile huset:
+# per device og eining gjennomsnitt, persentilar, høgaste glidande gjennomsnitt og timar over `threshold`,
+# graddagar og korrelasjonar mellom devicane (sjå smarthouse.analytics.scope_report)
+@router.get("/analytics")
+async def get_smarthouse_analytics(floor: Optional[int] = None, room: Optional[str] = None,
+                                   from_ts: Optional[str] = Query(None, alias="from"),
+                                   until_ts: Optional[str] = Query(None, alias="until"),
+                                   unit: Optional[str] = None, threshold: Optional[float] = None,
+                                   base: float = 17.0, window_minutes: int = Query(60, ge=1),
+                                   ctx: HouseContext = Depends(house_context)) -> dict:
+    if room is not None:
+        if floor is None:
+            raise HTTPException(status_code=400, detail="A room is given by floor and room")
+        scope = ctx.house.get_room(floor, room)
+        if scope is None:
+            raise HTTPException(status_code=404, detail="Dette rommet eksisterer ikkje")
+        devices = list(scope.devices)
+    elif floor is not None:
+        scope = ctx.house.get_floor(floor)
+        if scope is None:
+            raise HTTPException(status_code=404, detail="No given floor with this id was found")
+        devices = [device for r in scope.rooms for device in r.devices]
+    else:
+        devices = ctx.house.get_devices()
+    _check_range(from_ts, until_ts)
+
+    # Både henting og utrekning køyrer på lesetrådane, ikkje i event-loopen
+    def report() -> dict:
+        series = ctx.repo.get_series_for_devices(devices, from_ts, until_ts, unit)
+        return scope_report(series, window=window_minutes * 60 * 1000, threshold=threshold, base=base)
+    return ORJSONResponse(await ctx.arepo.read(report))
+
+
+# Gjennomsnittstemperatur per dag i rommet {rid} på etasje {fid}
+@router.get("/floor/{fid}/room/{rid}/avg_temperatures")
+async def get_smarthouse_room_avg_temperatures(fid: int, rid: str,
+                                         from_date: Optional[str] = Query(None, alias="from"),
+                                         until_date: Optional[str] = Query(None, alias="until"),
+                                         ctx: HouseContext = Depends(house_context)) -> Dict[str, float]:
+
+    room = ctx.house.get_room(fid, rid)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Dette rommet eksisterer ikkje")
+    return await ctx.arepo.calc_avg_temperatures_in_room(room, from_date, until_date)
+
+
+# Timar på dagen {date} med meir enn tre fuktmålingar over dagsgjennomsnittet i rommet {rid} på etasje {fid}
+@router.get("/floor/{fid}/room/{rid}/humidity_hours")
+async def get_smarthouse_room_humidity_hours(fid: int, rid: str, date: str, ctx: HouseContext = Depends(house_context)) -> List[int]:
+
+    room = ctx.house.get_room(fid, rid)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Dette rommet eksisterer ikkje")
+    try:
+        datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    return await ctx.arepo.calc_hours_with_humidity_above(room, date)
+
+
 # --------- Det skal finnes spesielle endepunkter for tilgang til aktuator funskjoner ---------------
 
 # get current state for actuator uuid
-@app.get("/smarthouse/actuator/{uuid}/current")
-def get_smarthouse_actuatorCurrentState(uuid:str)-> dict[str, str | float]:
+@router.get("/actuator/{uuid}/current")
+def get_smarthouse_actuatorCurrentState(uuid:str, ctx: HouseContext = Depends(house_context))-> dict[str, str | float]:
     
-    # Initial verdier
-    actuator_found = False
-    state_value = None
-
-    for dev in smarthouse.get_devices(): # henter alle devices
-        if isinstance(dev, Actuator) and dev.id == uuid:
-            actuator_found = True # Actuator er funnet
-            try:
-                # Passer på at state er ein flaot, vist den ikkje er None eller allerede ein float
-                state_value = dev.state if isinstance(dev.state, float) else float(dev.state)
-            except ValueError:
-                raise HTTPException(status_code=500, detail="Invalid state value for actuator")
-            break  # Aktuator funnet, treng ikje og fortsette
-
-    if not actuator_found:
+    dev = ctx.house.get_device_by_id(uuid) # Slår opp device på ID
+    if not isinstance(dev, Actuator):
         raise HTTPException(status_code=404, detail="Actuator not found")
 
+    try:
+        # Passer på at state er ein flaot, vist den ikkje er None eller allerede ein float
+        state_value = dev.state if isinstance(dev.state, float) else float(dev.state)
+    except ValueError:
+        raise HTTPException(status_code=500, detail="Invalid state value for actuator")
+
     return {"uuid": uuid, "state": state_value} # Returnerer uuid og verdien av staten
 
 # oppdater current state for actuator uuid
-@app.put("/smarthouse/device/{uuid}")
-def put_smarthouse_actuatorCurrentState(uuid : str, state_update: Union[int, float])-> dict[str, Union[str, int, float]]:
-    
-    for dev in smarthouse.get_devices():  # Går gjennom alle devicer i smarthuset
-        if isinstance(dev, Actuator) and dev.id == uuid:
-            # Om ein finn actuator, så går ein videre.
-            try:
-                dev.state = state_update  # Oppdaterer state
-                repo.update_actuator_state(dev)  # køyrer metode fra persistence for å oppdatere status
-                return {"uuid": uuid, "state": dev.state}  # returnerer oppdatert status
-            except Exception as e:
-                # If an error occurs, return an HTTPException with error details
-                raise HTTPException(status_code=500, detail=str(e))
+@router.put("/device/{uuid}")
+async def put_smarthouse_actuatorCurrentState(uuid : str, state_update: Union[int, float], ctx: HouseContext = Depends(house_context))-> dict[str, Union[str, int, float]]:
     
-    # Actuator not found, raise a 404 error
-    raise HTTPException(status_code=404, detail="Actuator not found")
+    dev = ctx.house.get_device_by_id(uuid)  # Slår opp device på ID
+    if not isinstance(dev, Actuator):
+        # Actuator not found, raise a 404 error
+        raise HTTPException(status_code=404, detail="Actuator not found")
+
+    # Om ein finn actuator, så går ein videre.
+    try:
+        dev.state = state_update  # Oppdaterer state
+        await ctx.arepo.update_actuator_state(dev)  # køyrer metode fra persistence for å oppdatere status
+        return {"uuid": uuid, "state": dev.state}  # returnerer oppdatert status
+    except Exception as e:
+        # If an error occurs, return an HTTPException with error details
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Same kommando til mange aktuatorar i ein operasjon, t.d. "slå av alle lys i 2. etasje".
+# Body: {"action": "on" | "off", "target": <tal, valfri>} og anten {"devices": [uuid, ...]}
+# eller {"floor": fid} / {"floor": fid, "room": rid}, eventuelt avgrensa med {"kind": "Light Bulp"}.
+# Alle tilstandane vert lagra i éin transaksjon.
+@router.post("/actuators/command")
+async def post_smarthouse_actuators_command(request: Request, ctx: HouseContext = Depends(house_context)) -> dict[str, int | List]:
+
+    try:
+        command = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Body is not valid JSON")
+    if not isinstance(command, dict) or command.get("action") not in ("on", "off"):
+        raise HTTPException(status_code=400, detail='"action" has to be "on" or "off"')
+    target = command.get("target")
+    if target is not None and (isinstance(target, bool) or not isinstance(target, (int, float))):
+        raise HTTPException(status_code=400, detail="Invalid target")
+
+    # Finn aktuatorane kommandoen gjeld
+    not_found = []
+    if "devices" in command:
+        if not isinstance(command["devices"], list):
+            raise HTTPException(status_code=400, detail='"devices" has to be a list of ids')
+        actuators = []
+        for uuid in command["devices"]:
+            dev = ctx.house.get_device_by_id(str(uuid))
+            if isinstance(dev, Actuator):
+                actuators.append(dev)
+            else:
+                not_found.append(uuid)
+    elif "floor" in command:
+        # true/false er òg int i Python, men ikkje eit gyldig etasjenummer
+        level = command["floor"]
+        floor = ctx.house.get_floor(level) if isinstance(level, int) and not isinstance(level, bool) else None
+        if floor is None:
+            raise HTTPException(status_code=404, detail="No given floor with this id was found")
+        if "room" in command:
+            room = ctx.house.get_room(floor.level, command["room"])
+            if room is None:
+                raise HTTPException(status_code=404, detail="Dette rommet eksisterer ikkje")
+            rooms = [room]
+        else:
+            rooms = floor.rooms
+        actuators = [dev for room in rooms for dev in room.devices if isinstance(dev, Actuator)]
+    else:
+        raise HTTPException(status_code=400, detail='Either "devices" or "floor" is required')
+    if command.get("kind") is not None:
+        actuators = [dev for dev in actuators if dev.device_type == command["kind"]]
+
+    for dev in actuators:
+        if command["action"] == "on":
+            dev.turn_on(float(target) if target is not None else None)
+        else:
+            dev.turn_off()
+    try:
+        updated = await ctx.arepo.update_actuator_states(actuators)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "updated": updated,
+        "devices": [{"uuid": dev.id, "state": dev.state} for dev in actuators],
+        "not_found": not_found,
+    }
+
+
+# Tellarar for samlinga av aktuator-tilstandar
+@app.get("/smarthouse/actuators/coalescing_stats")
+def get_smarthouse_coalescing_stats() -> dict[str, bool | int]:
+    if repo.state_coalescer is None:
+        return {"coalescing": False}
+    return {"coalescing": True, **repo.state_coalescer.stats()}
+
+
+# --------- Sanntid: målingar og tilstandar vert pusha til abonnentar -------------------------------
+# Emne (topic): device:<uuid>, room:<fid>/<rid> eller floor:<fid>, t.d. ?topic=floor:1&topic=device:<uuid>
+# Ein abonnent som ikkje tek unna hendingane sine raskt nok, vert kopla frå.
+
+def _parse_topics(topics: List[str]) -> List[str]:
+    try:
+        return [parse_topic(topic) for topic in topics]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.websocket("/smarthouse/subscribe")
+async def websocket_smarthouse_subscribe(websocket: WebSocket, topic: List[str] = Query(...)):
+    try:
+        topics = [parse_topic(t) for t in topic]
+    except ValueError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    await websocket.accept()
+    subscription = broker.subscribe(topics)
+
+    # Klienten sender ingenting, men mottaket fortel når han koplar frå
+    async def receive_until_disconnect():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    receiver = asyncio.create_task(receive_until_disconnect())
+    try:
+        while True:
+            getter = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait({getter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                return
+            event = getter.result()
+            if event is None:
+                await websocket.close(code=1008, reason="Subscriber too slow")
+                return
+            await websocket.send_text(orjson.dumps(event).decode())
+    finally:
+        receiver.cancel()
+        broker.unsubscribe(subscription)
+
+
+@app.get("/smarthouse/events")
+async def get_smarthouse_events(topic: List[str] = Query(...)) -> StreamingResponse:
+    subscription = broker.subscribe(_parse_topics(topic))
+
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), 15)
+                except asyncio.TimeoutError:
+                    # Held sambandet ope gjennom proxyar
+                    yield b": keep-alive\n\n"
+                    continue
+                if event is None:
+                    yield b"event: dropped\ndata: {}\n\n"
+                    return
+                yield b"event: " + event["event"].encode() + b"\ndata: " + orjson.dumps(event) + b"\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+# Tellarar for slettinga av gamle rådata
+@app.get("/smarthouse/retention/stats")
+def get_smarthouse_retention_stats() -> dict[str, bool | int | float]:
+    return retention.stats()
+
+
+# Køyrer slettinga av gamle rådata no, i staden for å vente på neste planlagde køyring. Køyringa skjer
+# i eigen tråd (ikkje i skrivetråden, så innsending ikkje ventar) og i korte batchar; ei køyring i
+# bakgrunnen som alt er i gang vert venta på
+@app.post("/smarthouse/retention/run")
+async def post_smarthouse_retention_run() -> dict[str, int]:
+    return {"deleted": await asyncio.to_thread(retention.run_once)}
+
+
+# Tellarar for sanntidsabonnementa
+@app.get("/smarthouse/events/stats")
+def get_smarthouse_events_stats() -> dict[str, int]:
+    return broker.stats()
+
+
+# Tellarar for følginga av tilstandsendringar frå andre prosessar
+@app.get("/smarthouse/actuators/follow_stats")
+def get_smarthouse_actuators_follow_stats() -> dict[str, bool | int]:
+    if follower is None:
+        return {"following": False}
+    return {"following": True, **follower.stats()}
+
+
+# Tellarar for dei opne husa (SMARTHOUSE_TENANTS_DIR)
+@app.get("/houses/stats")
+def get_houses_stats() -> dict[str, int]:
+    if tenants is None:
+        raise HTTPException(status_code=404, detail="Fleire hus er ikkje slått på (SMARTHOUSE_TENANTS_DIR)")
+    return tenants.stats()
+
+
+# Målingar i Prometheus-tekstformat
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    if metrics is None:
+        raise HTTPException(status_code=404, detail="Metrics er ikkje slått på (SMARTHOUSE_METRICS=1)")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Dei siste trege repository-kalla
+@app.get("/metrics/slow")
+def get_metrics_slow() -> List[dict]:
+    if metrics is None:
+        raise HTTPException(status_code=404, detail="Metrics er ikkje slått på (SMARTHOUSE_METRICS=1)")
+    return list(metrics.slow_queries)
 
 
+app.include_router(router, prefix="/smarthouse")
+if tenants is not None:
+    app.include_router(router, prefix="/houses/{house_id}/smarthouse")
 
 
 # TODO: implement the remaining HTTP endpoints as requested in
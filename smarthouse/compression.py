@@ -0,0 +1,200 @@
+"""
+Compression of sensor readings for the cold tier of the repository (see
+`SmartHouseRepository.compact_readings`), after the Gorilla time series format:
+timestamps are written as the difference between consecutive deltas and values as
+the XOR with the previous value, both with variable length bit codes. Readings taken
+at a fixed interval cost one bit per timestamp, and a value that did not change one
+bit as well.
+"""
+import struct
+from array import array
+from typing import Sequence, Tuple
+
+_DOUBLE = struct.Struct(">d")
+_UINT64 = struct.Struct(">Q")
+_MASK64 = (1 << 64) - 1
+
+# Delta-of-delta: antal 1-bit i prefikset (avslutta med 0) gjev talet på bit i verdien.
+# Med fem 1-bit følgjer heile verdien (64 bit) utan avsluttande 0.
+_DOD_BITS = (0, 7, 9, 12, 20, 64)
+
+# Største tal på bit for éi måling (5 + 64 for tidsstempelet, 2 + 11 + 64 for verdien)
+# og kor mange 64-bit ord dekoderen les inn om gongen
+_MAX_READING_BITS = 146
+_REFILL_WORDS = 3
+
+
+class _BitWriter:
+    """
+    Appends bit fields to a byte buffer, most significant bit first.
+    """
+
+    __slots__ = ("buffer", "acc", "bits")
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value: int, bits: int):
+        self.acc = (self.acc << bits) | value
+        self.bits += bits
+        if self.bits >= 64:
+            # Heile byte vert flytta over i bufferet, resten vert att i akkumulatoren
+            rest = self.bits & 7
+            self.buffer += (self.acc >> rest).to_bytes(self.bits >> 3, "big")
+            self.acc &= (1 << rest) - 1
+            self.bits = rest
+
+    def getvalue(self) -> bytes:
+        pad = -self.bits & 7
+        return bytes(self.buffer + (self.acc << pad).to_bytes((self.bits + pad) >> 3, "big"))
+
+
+def encode_chunk(timestamps: Sequence[int], values: Sequence[float]) -> bytes:
+    """
+    Encodes readings given as timestamps (milliseconds since the epoch, in ascending
+    order) and float values into one compressed chunk. The encoding is lossless.
+    """
+    if len(timestamps) != len(values):
+        raise ValueError("Timestamps and values differ in length")
+    writer = _BitWriter()
+    write = writer.write
+    writer.write(len(timestamps), 32)
+    if not timestamps:
+        return writer.getvalue()
+
+    previous_ts = timestamps[0]
+    previous_bits = _UINT64.unpack(_DOUBLE.pack(values[0]))[0]
+    write(previous_ts & _MASK64, 64)
+    write(previous_bits, 64)
+    previous_delta = 0
+    # Vindauget (leiande og avsluttande 0-bit) til den førre XOR-verdien
+    window_lead, window_trail = -1, 0
+
+    for i in range(1, len(timestamps)):
+        ts = timestamps[i]
+        delta = ts - previous_ts
+        dod = delta - previous_delta
+        previous_ts, previous_delta = ts, delta
+        if dod == 0:
+            write(0, 1)
+        else:
+            for ones in range(1, 5):
+                bits = _DOD_BITS[ones]
+                if -(1 << (bits - 1)) < dod <= 1 << (bits - 1):
+                    # Prefiks med `ones` 1-bit og ein 0-bit, så verdien forskyvd til ikkje-negativ
+                    write(((1 << ones) - 1) << 1, ones + 1)
+                    write(dod + (1 << (bits - 1)) - 1, bits)
+                    break
+            else:
+                if not -(1 << 63) <= dod < 1 << 63:
+                    raise ValueError("Timestamps out of range")
+                write(0b11111, 5)
+                write(dod & _MASK64, 64)
+
+        bits = _UINT64.unpack(_DOUBLE.pack(values[i]))[0]
+        xor = bits ^ previous_bits
+        previous_bits = bits
+        if xor == 0:
+            write(0, 1)
+            continue
+        lead = min(64 - xor.bit_length(), 31)
+        trail = (xor & -xor).bit_length() - 1
+        if window_lead >= 0 and lead >= window_lead and trail >= window_trail:
+            # Dei meiningsfulle bitane får plass i det førre vindauget
+            write(0b10, 2)
+            write(xor >> window_trail, 64 - window_lead - window_trail)
+        else:
+            size = 64 - lead - trail
+            write(0b11, 2)
+            write(lead, 5)
+            write(size - 1, 6)
+            write(xor >> trail, size)
+            window_lead, window_trail = lead, trail
+    return writer.getvalue()
+
+
+def decode_chunk(data: bytes) -> Tuple[array, array]:
+    """
+    Decodes a chunk written by `encode_chunk` into an `array("q")` of timestamps
+    and an `array("d")` of values.
+    """
+    # Bitane vert lesne frå akkumulatoren `acc`, der dei `avail` lågaste bitane er ulesne.
+    # Før kvar måling vert han fylt opp med 64-bit ord til minst _MAX_READING_BITS bit,
+    # så lesinga inne i løkka treng ingen grensesjekk.
+    if len(data) < 4:
+        raise ValueError("Truncated chunk")
+    padded = bytes(data) + bytes(-len(data) % 8 + 8 * _REFILL_WORDS)
+    words = struct.unpack(f">{len(padded) >> 3}Q", padded)
+    acc, avail, index = 0, 0, 0
+    while avail < 32 + 128:
+        acc = (acc << 64) | words[index]
+        index += 1
+        avail += 64
+
+    avail -= 32
+    count = acc >> avail
+    timestamps, values = array("q"), array("d")
+    if count == 0:
+        return timestamps, values
+    avail -= 64
+    ts = acc >> avail & _MASK64
+    ts = ts - (1 << 64) if ts >> 63 else ts
+    avail -= 64
+    bits = acc >> avail & _MASK64
+    value = _DOUBLE.unpack(_UINT64.pack(bits))[0]
+    acc &= (1 << avail) - 1
+    append_ts, append_value = timestamps.append, values.append
+    append_ts(ts)
+    append_value(value)
+    delta = 0
+    window_size, window_shift = 64, 0
+
+    for _ in range(count - 1):
+        if avail < _MAX_READING_BITS:
+            refill = words[index:index + _REFILL_WORDS]
+            if not refill:
+                raise ValueError("Truncated chunk")
+            for word in refill:
+                acc = (acc << 64) | word
+            index += len(refill)
+            avail += 64 * len(refill)
+
+        # Tidsstempel: 0 for uendra delta, elles prefiks og delta-of-delta
+        avail -= 1
+        if acc >> avail & 1:
+            ones = 1
+            while ones < 5:
+                avail -= 1
+                if not acc >> avail & 1:
+                    break
+                ones += 1
+            size = _DOD_BITS[ones]
+            avail -= size
+            dod = acc >> avail & ((1 << size) - 1)
+            if ones == 5:
+                delta += dod - (1 << 64) if dod >> 63 else dod
+            else:
+                delta += dod - (1 << (size - 1)) + 1
+        ts += delta
+        append_ts(ts)
+
+        # Verdi: 0 for uendra, 10 for XOR i det førre vindauget, 11 for nytt vindauge
+        avail -= 1
+        if acc >> avail & 1:
+            avail -= 1
+            if acc >> avail & 1:
+                avail -= 11
+                header = acc >> avail & 0x7FF
+                window_size = (header & 63) + 1
+                window_shift = 64 - (header >> 6) - window_size
+            avail -= window_size
+            bits ^= (acc >> avail & ((1 << window_size) - 1)) << window_shift
+            value = _DOUBLE.unpack(_UINT64.pack(bits))[0]
+        append_value(value)
+        acc &= (1 << avail) - 1
+
+    if (index << 6) - avail > len(data) << 3:
+        raise ValueError("Truncated chunk")
+    return timestamps, values
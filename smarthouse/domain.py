@@ -1,6 +1,8 @@
-from datetime import datetime
+from array import array
+from bisect import insort
+from datetime import datetime, timedelta, timezone
 from random import random
-from typing import List, Optional, Union 
+from typing import Dict, List, Optional, Tuple, Union
 from abc import abstractmethod
 
 class Measurement:
@@ -8,14 +10,119 @@ class Measurement:
     This class represents a measurement taken from a sensor.
     """
 
+    __slots__ = ("timestamp", "value", "unit")
+
     def __init__(self, timestamp:str , value: float, unit: str) -> None:
         self.timestamp = timestamp
         self.value = value
         self.unit = unit
 
 
+# Naive tidspunkt vert rekna som UTC; aritmetikk på datetime er mykje raskare enn strptime/strftime
+_EPOCH = datetime(1970, 1, 1)
+_MILLISECOND = timedelta(milliseconds=1)
+
+
+def timestamp_to_epoch_ms(timestamp: Union[str, datetime]) -> int:
+    """
+    Converts a timestamp in ISO 8601 format (e.g. '2024-01-28 23:00:00') to milliseconds since the epoch.
+    Timestamps without a time zone are interpreted as UTC.
+    """
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - _EPOCH) // _MILLISECOND
+
+
+def parse_timestamp(timestamp: str) -> int:
+    """
+    Parses a timestamp in exactly the format of the database ('YYYY-MM-DD HH:MM:SS')
+    to milliseconds since the epoch, the strict (and about ten times faster)
+    equivalent of `datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")`.
+    Raises ValueError for anything else.
+    """
+    if len(timestamp) != 19 or timestamp[10] != " " or timestamp[4] != "-" or timestamp[16] != ":":
+        raise ValueError(f"Invalid timestamp: {timestamp!r}")
+    parsed = datetime.fromisoformat(timestamp)
+    if parsed.tzinfo is not None:
+        raise ValueError(f"Invalid timestamp: {timestamp!r}")
+    return (parsed - _EPOCH) // _MILLISECOND
+
+
+def epoch_ms_to_timestamp(epoch_ms: int) -> str:
+    """
+    Converts milliseconds since the epoch to a timestamp string in the format used by the database ('YYYY-MM-DD HH:MM:SS'),
+    with the milliseconds appended ('YYYY-MM-DD HH:MM:SS.mmm') unless they are zero.
+    """
+    timestamp = _EPOCH + epoch_ms * _MILLISECOND
+    return timestamp.isoformat(" ", timespec="milliseconds" if epoch_ms % 1000 else "seconds")
+
+
+class MeasurementSeries:
+    """
+    This class represents a series of measurements from a sensor stored column by column:
+    timestamps as 64 bit integers (milliseconds since the epoch) and values as 64 bit floats
+    in compact `array` buffers, and one shared unit string reference per reading.
+    Indexing or iterating the series yields `Measurement` objects.
+    """
+
+    __slots__ = ("timestamps", "values", "units")
+
+    def __init__(self) -> None:
+        self.timestamps = array("q")
+        self.values = array("d")
+        self.units : List[Optional[str]] = []
+
+    def append(self, epoch_ms: int, value: float, unit: Optional[str]):
+        self.timestamps.append(epoch_ms)
+        self.values.append(value)
+        self.units.append(unit)
+
+    def extend(self, rows):
+        """
+        Appends rows of the form `(epoch_ms, value, unit)`.
+        """
+        # Kolonne for kolonne, slik at kvar array vert utvida i eitt kall
+        rows = rows if isinstance(rows, list) else list(rows)
+        self.timestamps.extend([row[0] for row in rows])
+        self.values.extend([row[1] for row in rows])
+        # Like einingar vert delt mellom radene i staden for ein ny streng per rad
+        units = [row[2] for row in rows]
+        shared = {unit: unit for unit in units}
+        self.units.extend(map(shared.__getitem__, units))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, index: int) -> Measurement:
+        return Measurement(epoch_ms_to_timestamp(self.timestamps[index]), self.values[index], self.units[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def to_columns(self) -> Dict[str, list]:
+        """
+        Returns the series as a dict of three parallel lists (`timestamps` in
+        milliseconds since the epoch, `values` and `units`), ready for JSON serialization.
+        """
+        return {"timestamps": self.timestamps.tolist(), "values": self.values.tolist(), "units": self.units}
+
+    def nbytes(self) -> int:
+        """
+        Returns the approximate size of the buffers in bytes.
+        """
+        return (self.timestamps.itemsize * len(self.timestamps) + self.values.itemsize * len(self.values)
+                + 8 * len(self.units))
+
+
 class Device:
 
+    # Alle attributta til Sensor og Actuator er deklarert her, sidan ActuatorWithSensor
+    # arvar frå begge og Python ikkje tillet to basisklassar med kvar sine slots.
+    __slots__ = ("id", "model_name", "supplier", "device_type", "room", "unit", "state")
+
     def __init__(self, id: str, model_name: str, supplier: str, device_type: str):
         self.id = id
         self.model_name = model_name 
@@ -37,6 +144,8 @@ class Device:
 
 class Sensor(Device):
 
+    __slots__ = ()
+
     def __init__(self, id: str, model_name: str, supplier: str, device_type: str, unit: str = ""):
         super().__init__(id, model_name, supplier, device_type)
         self.unit = unit
@@ -55,6 +164,8 @@ class Sensor(Device):
 
 class Actuator(Device):
 
+    __slots__ = ()
+
     def __init__(self, id: str, model_name: str, supplier: str, device_type: str):
         super().__init__(id, model_name, supplier, device_type)
         self.state : Union[float, bool] = False
@@ -80,6 +191,8 @@ class Actuator(Device):
 
 class ActuatorWithSensor(Actuator, Sensor):
 
+    __slots__ = ()
+
     def __init__(self, id: str, model_name: str, supplier: str, device_type: str):
         super().__init__(id, model_name, supplier, device_type)
 
@@ -92,6 +205,8 @@ class ActuatorWithSensor(Actuator, Sensor):
 
 class Floor:
 
+    __slots__ = ("level", "rooms")
+
     def __init__(self, level):
         self.level = level
         self.rooms = []
@@ -99,6 +214,8 @@ class Floor:
 
 class Room:
 
+    __slots__ = ("floor", "room_size", "room_name", "devices")
+
     def __init__(self, floor: Floor, room_size: float, room_name: Optional[str]):
         self.floor = floor 
         self.room_size = room_size
@@ -119,6 +236,15 @@ class SmartHouse:
 
     def __init__(self) -> None:
         self.floors : List[Floor]= []
+        self.rooms : List[Room] = []
+        # Oppslagstabellar som vert haldne oppdatert av register_* metodane
+        self.floors_by_level : Dict[int, Floor] = {}
+        self.rooms_by_key : Dict[Tuple[int, Optional[str]], Room] = {}
+        self.devices_by_id : Dict[str, Device] = {}
+        self.total_area = 0.0
+        self.device_list : Optional[List[Device]] = None
+        # Vert auka ved kvar endring av strukturen (etasjar, rom, plassering av einingar)
+        self.version = 0
 
     def register_floor(self, level: int) -> Floor:
         """
@@ -126,7 +252,9 @@ class SmartHouse:
         and returns the respective floor object.
         """
         floor = Floor(level)
-        self.floors.append(floor)
+        insort(self.floors, floor, key=lambda f: f.level)
+        self.floors_by_level.setdefault(level, floor)
+        self.version += 1
         return floor
 
     def register_room(self, floor: Floor, room_size: float, room_name: Optional[str] = None) -> Room:
@@ -136,6 +264,10 @@ class SmartHouse:
         """
         room = Room(floor, room_size, room_name)
         floor.rooms.append(room)
+        self.rooms.append(room)
+        self.rooms_by_key.setdefault((floor.level, room_name), room)
+        self.total_area += room_size
+        self.version += 1
         return room
 
 
@@ -149,25 +281,41 @@ class SmartHouse:
         return self.floors
 
 
+    def get_floor(self, level: int) -> Optional[Floor]:
+        """
+        This method retrieves the floor at the given level, or None if there is no such floor.
+        """
+        return self.floors_by_level.get(level)
+
+
     def get_rooms(self) -> List[Room]:
         """
         This methods returns the list of all registered rooms in the house.
         The resulting list has no particular order.
         """
-        result = []
-        for f in self.floors:
-            result.extend(f.rooms)
-        return result
+        return self.rooms
+
+
+    def get_room(self, level: int, room_name: Optional[str]) -> Optional[Room]:
+        """
+        This method retrieves the room with the given name on the floor at the given level,
+        or None if there is no such room.
+        """
+        return self.rooms_by_key.get((level, room_name))
+
+
+    def count_rooms(self) -> int:
+        """
+        This method returns the number of registered rooms in the house.
+        """
+        return len(self.rooms)
 
 
     def get_area(self) -> float:
         """
         This methods return the total area size of the house, i.e. the sum of the area sizes of each room in the house.
         """
-        result = 0.0
-        for r in self.get_rooms():
-            result += r.room_size
-        return result
+        return self.total_area
 
 
     def register_device(self, room: Room, device: Device):
@@ -179,21 +327,26 @@ class SmartHouse:
             old_room.devices.remove(device)
         room.devices.append(device)
         device.room = room
+        self.devices_by_id[device.id] = device
+        # Lista er ordna etter rom, så ei flytting endrar ho òg
+        self.device_list = None
+        self.version += 1
 
 
     def get_devices(self) -> List[Device]:
-        """This method retrieves a list of all devices in the house"""
-        result = []
-        for r in self.get_rooms():
-            result.extend(r.devices)
-        return result
+        """This method retrieves a list of all devices in the house, room by room"""
+        if self.device_list is None:
+            self.device_list = [device for room in self.get_rooms() for device in room.devices]
+        return list(self.device_list)
+
+    
+    def count_devices(self) -> int:
+        """This method returns the number of devices in the house"""
+        return len(self.devices_by_id)
 
     
     def get_device_by_id(self, device_id: str) -> Optional[Device]:
         """
         This method retrieves a device object via its id.
         """
-        for d in self.get_devices():
-            if d.id == device_id:
-                return d
-        return None
\ No newline at end of file
+        return self.devices_by_id.get(device_id)
@@ -0,0 +1,41 @@
+"""
+Maintenance of the database that is too slow to run while the API serves requests:
+
+    python -m smarthouse.maintenance vacuum
+    python -m smarthouse.maintenance incremental-vacuum --pages 10000
+
+`vacuum` switches the database to incremental auto-vacuum. Migration 3 does this
+when a database is opened, but only for databases up to `AUTO_VACUUM_MAX_BYTES`,
+since it takes a full VACUUM that rewrites the file and blocks all writers.
+`incremental-vacuum` returns free pages to the file system, as the retention
+engine does after each run. The database is `SMARTHOUSE_DB` or `data/db.sql`,
+unless given with `--db`.
+"""
+import argparse
+import logging
+import os
+from pathlib import Path
+from smarthouse.persistence import SmartHouseRepository
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["vacuum", "incremental-vacuum"])
+    parser.add_argument("--db", default=os.environ.get("SMARTHOUSE_DB") or str(Path(__file__).parent.parent / "data" / "db.sql"))
+    parser.add_argument("--pages", type=int, default=1000000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+
+    repo = SmartHouseRepository(args.db)
+    try:
+        if args.command == "vacuum":
+            if not repo.enable_incremental_vacuum():
+                logging.info("%s already uses incremental auto-vacuum", args.db)
+        else:
+            logging.info("Freed %d pages of %s", repo.incremental_vacuum(args.pages), args.db)
+    finally:
+        repo.close()
+
+
+if __name__ == "__main__":
+    main()
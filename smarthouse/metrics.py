@@ -0,0 +1,324 @@
+"""
+Latency instrumentation for the REST API and the repository, exposed in the
+Prometheus text format (see `Metrics.render`).
+
+Nothing here is active unless installed: `MetricsMiddleware` is only added to the
+app and `instrument` only wraps the methods of a repository instance when metrics
+are enabled, so a disabled instrumentation costs nothing on the request path.
+"""
+import functools
+import inspect
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Øvre grenser (sekund) for histogramma, same standard som i Prometheus-klientane
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Repository-metodane som vert målte (oppsett og livssyklus er utelatne)
+INSTRUMENTED_METHODS = (
+    "load_smarthouse_deep", "load_smarthouse_lazy",
+    "get_latest_reading", "_query_latest_reading", "get_all_readings", "get_readings_series",
+    "get_downsampled_readings", "iter_readings",
+    "calc_avg_temperatures_in_room", "calc_hours_with_humidity_above",
+    "get_device_rollups", "get_room_rollups", "rebuild_rollups",
+    "add_measurment", "add_measurements", "removing_oldest_reading_from_database",
+    "delete_readings_batch", "reading_position", "incremental_vacuum",
+    "compact_readings", "delete_cold_readings",
+    "update_actuator_state", "update_actuator_states", "write_actuator_states",
+)
+
+
+class Histogram:
+    """
+    A cumulative histogram over fixed bucket bounds. Not thread-safe on its own;
+    `Metrics` guards all histograms with its lock.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        result, total = [], 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            total += n
+            result.append(("+Inf" if bound == float("inf") else repr(bound), total))
+        return result
+
+
+class Metrics:
+    """
+    Registry of the request and repository metrics. Calls to the repository that take
+    longer than `slow_threshold` seconds are kept in `slow_queries` (the newest
+    `slow_log_size`) and logged.
+    """
+
+    def __init__(self, slow_threshold: Optional[float] = None, slow_log_size: int = 100,
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.slow_threshold = slow_threshold
+        self.slow_queries = deque(maxlen=slow_log_size)
+        # (metode, rute, status) -> Histogram
+        self.requests: Dict[Tuple[str, str, int], Histogram] = {}
+        self.in_flight = 0
+        # metode -> Histogram / tellarar
+        self.calls: Dict[str, Histogram] = {}
+        self.rows: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.commits = Histogram(buckets)
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        key = (method, route, status)
+        with self.lock:
+            histogram = self.requests.get(key)
+            if histogram is None:
+                histogram = self.requests[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def observe_call(self, name: str, seconds: float, rows: int, failed: bool, args: tuple = ()):
+        with self.lock:
+            histogram = self.calls.get(name)
+            if histogram is None:
+                histogram = self.calls[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            self.rows[name] = self.rows.get(name, 0) + rows
+            if failed:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            entry = {"method": name, "ms": round(seconds * 1000, 3), "rows": rows,
+                     "args": [_describe(arg) for arg in args], "at": time.time()}
+            self.slow_queries.append(entry)
+            logger.warning("Slow repository call: %s(%s) took %s ms", name, ", ".join(entry["args"]), entry["ms"])
+
+    def observe_commit(self, seconds: float):
+        with self.lock:
+            self.commits.observe(seconds)
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        lines = []
+        with self.lock:
+            _histogram(lines, "smarthouse_http_request_duration_seconds", "Latency of HTTP requests by route.",
+                       ((f'method="{m}",route="{_escape(r)}",status="{s}"', h) for (m, r, s), h in sorted(self.requests.items())))
+            lines.append("# HELP smarthouse_http_requests_in_flight HTTP requests currently being served.")
+            lines.append("# TYPE smarthouse_http_requests_in_flight gauge")
+            lines.append(f"smarthouse_http_requests_in_flight {self.in_flight}")
+            _histogram(lines, "smarthouse_repository_call_duration_seconds", "Duration of repository calls by method.",
+                       ((f'method="{name}"', h) for name, h in sorted(self.calls.items())))
+            _counter(lines, "smarthouse_repository_rows_total", "Rows (items) returned by repository calls.", self.rows)
+            _counter(lines, "smarthouse_repository_errors_total", "Repository calls that raised.", self.errors)
+            _histogram(lines, "smarthouse_repository_commit_duration_seconds", "Duration of commits on the writer connection.",
+                       [("", self.commits)])
+            lines.append("# HELP smarthouse_repository_slow_calls Slow repository calls in the log.")
+            lines.append("# TYPE smarthouse_repository_slow_calls gauge")
+            lines.append(f"smarthouse_repository_slow_calls {len(self.slow_queries)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _histogram(lines: List[str], name: str, help: str, series: Iterable[Tuple[str, Histogram]]):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in series:
+        prefix = labels + "," if labels else ""
+        for bound, count in histogram.cumulative():
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+        suffix = "{" + labels + "}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {histogram.sum!r}")
+        lines.append(f"{name}_count{suffix} {histogram.count}")
+
+
+def _counter(lines: List[str], name: str, help: str, values: Dict[str, int]):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} counter")
+    for method, value in sorted(values.items()):
+        lines.append(f'{name}{{method="{method}"}} {value}')
+
+
+def _describe(arg) -> str:
+    # Kort skildring av argumenta i loggen: devicar og rom ved id/namn, resten avkorta
+    for attr in ("id", "room_name"):
+        value = getattr(arg, attr, None)
+        if isinstance(value, (str, int)):
+            return f"{type(arg).__name__}({value})"
+    text = repr(arg)
+    return text if len(text) <= 60 else text[:57] + "..."
+
+
+def _rows(result) -> int:
+    # Skrivemetodane returnerer tal på rader (eller bool), lesemetodane lister o.l.
+    if result is None:
+        return 0
+    if isinstance(result, int):
+        return int(result)
+    try:
+        return len(result)
+    except TypeError:
+        return 1
+
+
+class _TimedConnection:
+    """
+    Stands in for the writer connection of an instrumented repository and times `commit()`;
+    everything else is delegated to the connection.
+    """
+
+    __slots__ = ("conn", "metrics")
+
+    def __init__(self, conn, metrics: Metrics) -> None:
+        self.conn = conn
+        self.metrics = metrics
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return self.conn.commit()
+        finally:
+            self.metrics.observe_commit(time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def instrument(repo, metrics: Metrics, methods: Iterable[str] = INSTRUMENTED_METHODS):
+    """
+    Wraps the given methods of the repository instance (not its class) with timing
+    and times the commits on its writer connection, also after `reconnect()`.
+    Methods returning a generator are timed while the generator is consumed.
+    Returns the repository.
+    """
+    for name in methods:
+        method = getattr(repo, name, None)
+        if method is not None:
+            setattr(repo, name, _timed(name, method, metrics))
+    repo.conn = _TimedConnection(repo.conn, metrics)
+    reconnect = getattr(repo, "reconnect", None)
+    if reconnect is not None:
+        # Ny skrivetilkopling etter reconnect må òg målast
+        @functools.wraps(reconnect)
+        def timed_reconnect():
+            reconnect()
+            repo.conn = _TimedConnection(repo.conn, metrics)
+        repo.reconnect = timed_reconnect
+    return repo
+
+
+def _timed(name: str, method: Callable, metrics: Metrics) -> Callable:
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        failed, result = True, None
+        try:
+            result = method(*args, **kwargs)
+            failed = False
+        finally:
+            elapsed = time.perf_counter() - started
+            if failed or not inspect.isgenerator(result):
+                metrics.observe_call(name, elapsed, _rows(result), failed, args)
+        if inspect.isgenerator(result):
+            return _timed_generator(name, result, elapsed, metrics, args)
+        return result
+    return timed
+
+
+def _timed_generator(name: str, generator, elapsed: float, metrics: Metrics, args: tuple):
+    # Ein generator gjer arbeidet sitt når han vert lesen: tida inne i generatoren vert summert
+    # og observert når han er tom, vert lukka av lesaren eller feilar
+    rows, failed = 0, True
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                failed = False
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+            rows += 1
+            yield item
+    except GeneratorExit:
+        failed = False
+        raise
+    finally:
+        generator.close()
+        metrics.observe_call(name, elapsed, rows, failed, args)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that counts requests in flight and records the latency of every
+    HTTP request under its route template (e.g. `/smarthouse/device/{uiid}`), so
+    that the number of label values stays bounded. Requests that match no route
+    are recorded as `unmatched`.
+    """
+
+    def __init__(self, app, metrics: Metrics) -> None:
+        self.app = app
+        self.metrics = metrics
+        self.routes: Dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        metrics = self.metrics
+        with metrics.lock:
+            metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            with metrics.lock:
+                metrics.in_flight -= 1
+            metrics.observe_request(scope["method"], self.route(scope), status, elapsed)
+
+    def route(self, scope) -> str:
+        # Ruteren skriv ruta inn i scope; same endepunkt kan vere registrert under fleire malar
+        route = scope.get("route")
+        if getattr(route, "path", None):
+            return route.path
+        # Elles vert malen slått opp éin gong per endepunkt
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self.routes.get(endpoint)
+        if path is None:
+            path = "unmatched"
+            for route in getattr(scope.get("app"), "routes", ()):
+                # Mount (t.d. /static) har ingen endpoint, men appen sin står i scope
+                if getattr(route, "endpoint", None) is endpoint or getattr(route, "app", None) is endpoint:
+                    path = route.path
+                    break
+            self.routes[endpoint] = path
+        return path
@@ -1,8 +1,503 @@
+import atexit
+import logging
+import mmap
+import orjson
+import os
 import sqlite3
-from typing import Optional
-from smarthouse.domain import Measurement, SmartHouse,Room,Floor, Sensor, ActuatorWithSensor, Actuator
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
+from smarthouse.analytics import lttb
+from smarthouse.compression import decode_chunk, encode_chunk
+from smarthouse.domain import epoch_ms_to_timestamp, parse_timestamp, timestamp_to_epoch_ms, Measurement, MeasurementSeries, SmartHouse,Room,Floor, Device, Sensor, ActuatorWithSensor, Actuator
 from pathlib import Path
-from datetime import datetime
+from datetime import date as date_type, datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+# Millisekund sidan epoken for eit tidsstempel i measurements (julianday er raskare enn strftime('%s'))
+EPOCH_MS_OF = "CAST(ROUND((julianday({}) - 2440587.5) * 86400000) AS INTEGER)"
+EPOCH_MS_SQL = EPOCH_MS_OF.format("ts")
+
+# Aggregat (rollups) per device og per rom. Bøtta er eit prefiks av tidsstempelet:
+# 'YYYY-MM-DD HH:MM' (minute), 'YYYY-MM-DD HH' (hour) og 'YYYY-MM-DD' (day).
+DEVICE_ROLLUP_GRANULARITIES = {"minute": 16, "hour": 13, "day": 10}
+ROOM_ROLLUP_GRANULARITIES = {"hour": 13, "day": 10}
+
+ROLLUP_TABLES_SQL = """
+    CREATE TABLE IF NOT EXISTS device_rollups (
+        device TEXT NOT NULL,
+        unit TEXT NOT NULL,
+        granularity TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        total REAL NOT NULL,
+        min_value REAL NOT NULL,
+        max_value REAL NOT NULL,
+        PRIMARY KEY (device, granularity, bucket, unit)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS room_rollups (
+        room INT NOT NULL,
+        unit TEXT NOT NULL,
+        granularity TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        total REAL NOT NULL,
+        min_value REAL NOT NULL,
+        max_value REAL NOT NULL,
+        PRIMARY KEY (room, unit, granularity, bucket)
+    ) WITHOUT ROWID;
+"""
+
+_ROLLUP_UPSERT = """
+        ON CONFLICT({key}) DO UPDATE SET
+            n = n + excluded.n,
+            total = total + excluded.total,
+            min_value = min(min_value, excluded.min_value),
+            max_value = max(max_value, excluded.max_value);"""
+
+# Triggeren held aggregata oppdatert for alle innsettingar (enkeltvis, batch og write-behind).
+# Sletting av rådata rører ikkje aggregata, slik at dei overlever rådata.
+ROLLUP_TRIGGER_SQL = "CREATE TRIGGER IF NOT EXISTS measurements_rollup AFTER INSERT ON measurements\nBEGIN" + "".join(
+    f"""
+        INSERT INTO device_rollups VALUES (NEW.device, COALESCE(NEW.unit, ''), '{granularity}',
+            replace(substr(NEW.ts, 1, {length}), 'T', ' '), 1, NEW.value, NEW.value, NEW.value)"""
+    + _ROLLUP_UPSERT.format(key="device, granularity, bucket, unit")
+    for granularity, length in DEVICE_ROLLUP_GRANULARITIES.items()
+) + "".join(
+    f"""
+        INSERT INTO room_rollups SELECT room, COALESCE(NEW.unit, ''), '{granularity}',
+            replace(substr(NEW.ts, 1, {length}), 'T', ' '), 1, NEW.value, NEW.value, NEW.value
+        FROM devices WHERE id = NEW.device"""
+    + _ROLLUP_UPSERT.format(key="room, unit, granularity, bucket")
+    for granularity, length in ROOM_ROLLUP_GRANULARITIES.items()
+) + "\nEND;\n"
+
+# Byggjer aggregata på nytt frå rådata i measurements
+ROLLUP_REBUILD_SQL = "DELETE FROM device_rollups; DELETE FROM room_rollups;" + "".join(
+    f"""
+    INSERT INTO device_rollups
+    SELECT device, COALESCE(unit, ''), '{granularity}', replace(substr(ts, 1, {length}), 'T', ' ') AS bucket,
+           COUNT(*), SUM(value), MIN(value), MAX(value)
+    FROM measurements
+    GROUP BY device, COALESCE(unit, ''), bucket;"""
+    for granularity, length in DEVICE_ROLLUP_GRANULARITIES.items()
+) + "".join(
+    f"""
+    INSERT INTO room_rollups
+    SELECT d.room, COALESCE(m.unit, ''), '{granularity}', replace(substr(m.ts, 1, {length}), 'T', ' ') AS bucket,
+           COUNT(*), SUM(m.value), MIN(m.value), MAX(m.value)
+    FROM measurements m
+    JOIN devices d ON d.id = m.device
+    GROUP BY d.room, COALESCE(m.unit, ''), bucket;"""
+    for granularity, length in ROOM_ROLLUP_GRANULARITIES.items()
+)
+
+
+# Største database (byte) som migrering 3 køyrer VACUUM på når han vert opna. VACUUM skriv heile
+# fila på nytt og stenger ute alle skrivarar så lenge; større databasar må byte til inkrementell
+# auto-vacuum i eit vedlikehaldsvindauge (`python -m smarthouse.maintenance vacuum`).
+AUTO_VACUUM_MAX_BYTES = 64 * 1024 * 1024
+
+
+def _enable_incremental_vacuum(conn: sqlite3.Connection, force: bool = False) -> bool:
+    # auto_vacuum kan berre endrast for ein eksisterande database med VACUUM,
+    # og VACUUM kan ikkje køyre inne i ein transaksjon
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+        return False
+    size = conn.execute("PRAGMA page_count;").fetchone()[0] * conn.execute("PRAGMA page_size;").fetchone()[0]
+    if not force and size > AUTO_VACUUM_MAX_BYTES:
+        logger.warning("Incremental auto-vacuum is not enabled: VACUUM of the %.1f MiB database is left to "
+                       "`python -m smarthouse.maintenance vacuum`", size / 2 ** 20)
+        return False
+    logger.info("Enabling incremental auto-vacuum: VACUUM of the %.1f MiB database", size / 2 ** 20)
+    started = time.perf_counter()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    conn.execute("VACUUM;")
+    logger.info("VACUUM finished in %.1f s", time.perf_counter() - started)
+    return True
+
+
+# Kvar endring av ein aktuator-tilstand vert logga med eit aukande sekvensnummer.
+# Berre dei siste STATE_LOG_SIZE endringane vert behaldne.
+STATE_LOG_SIZE = 10000
+STATE_LOG_SQL = f"""
+CREATE TABLE IF NOT EXISTS state_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    device TEXT NOT NULL,
+    state REAL
+);
+CREATE TRIGGER IF NOT EXISTS states_log_update AFTER UPDATE OF state ON states
+WHEN NEW.state IS NOT OLD.state
+BEGIN
+    INSERT INTO state_log (device, state) VALUES (NEW.device, NEW.state);
+    DELETE FROM state_log WHERE seq <= last_insert_rowid() - {STATE_LOG_SIZE};
+END;
+"""
+
+# Tidspunktet til målingane som heiltal (millisekund sidan epoken, UTC), slik at tidsintervall
+# kan filtrerast og sorterast på heiltal via indeksen utan å tolke teksten i `ts` for kvar rad.
+# Repositoryet skriv `ts_ms` saman med `ts`; for rader frå andre skrivarar fyller triggeren det inn.
+# Den nye indeksen erstattar (device, ts, value, unit): `ts` er med som nest-nøkkel, så oppslag
+# sortert på (ts_ms, ts) er framleis dekte, og kvar innsetting oppdaterer berre éin måle-indeks.
+TS_MS_SQL = f"""
+ALTER TABLE measurements ADD COLUMN ts_ms INTEGER;
+UPDATE measurements SET ts_ms = {EPOCH_MS_SQL};
+CREATE INDEX IF NOT EXISTS measurements_device_ts_ms ON measurements(device, ts_ms, ts, value, unit);
+DROP INDEX IF EXISTS measurements_device_ts;
+CREATE TRIGGER IF NOT EXISTS measurements_ts_ms AFTER INSERT ON measurements
+WHEN NEW.ts_ms IS NULL
+BEGIN
+    UPDATE measurements SET ts_ms = {EPOCH_MS_SQL} WHERE rowid = NEW.rowid;
+END;
+"""
+
+# Rekkjefølgja "nyaste først" for siste måling per device: lik rekkjefølgja i indeksen
+# (device, ts_ms, ts, value, unit) baklengs, så oppslaget er utan sortering og like tidspunkt
+# alltid gjev same rad, anten det er spørringa for ein device eller fyllinga av cachen
+LATEST_FIRST = "ts_ms DESC, ts DESC, value DESC, unit DESC, rowid DESC"
+
+# Kald lagring: eldre målingar vert pakka per device og eining i komprimerte bitar
+# (sjå smarthouse.compression) med første og siste tidsstempel for oppslag på intervall.
+CHUNK_SIZE = 1024
+MAX_CHUNK_SIZE = 4096
+MEASUREMENT_CHUNKS_SQL = """
+CREATE TABLE IF NOT EXISTS measurement_chunks (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    unit TEXT,
+    first_ms INTEGER NOT NULL,
+    last_ms INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS measurement_chunks_device ON measurement_chunks(device, first_ms, last_ms);
+"""
+
+def _sql_statements(script: str) -> List[str]:
+    # executescript committar sjølv og kan difor ikkje brukast inne i BEGIN IMMEDIATE;
+    # skriptet vert delt i heile setningar (triggerar inneheld semikolon før END)
+    statements, statement = [], ""
+    for part in script.split(";")[:-1]:
+        statement += part + ";"
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ""
+    return statements
+
+
+# Kor lenge (ms) ein prosess ventar på at ein annan prosess er ferdig med å migrere databasen
+MIGRATION_BUSY_TIMEOUT_MS = 10 * 60 * 1000
+
+# Versjonerte skjema-migreringar. Migrering nummer n (1-basert) vert køyrd
+# dersom `PRAGMA user_version` i databasen er mindre enn n, og versjonen vert
+# oppdatert i same transaksjon som migreringa. Migreringar som ikkje kan køyre
+# i ein transaksjon er funksjonar som får tilkoplinga; dei må tole å bli køyrde meir enn éin gong.
+SCHEMA_MIGRATIONS = [
+    # 1: covering index so that per-device lookups ordered by time (latest reading,
+    #    last n readings, oldest reading) are served from the index without a sort
+    #    or a full table scan. Room joins get an index on devices(room) as well.
+    """
+    CREATE INDEX IF NOT EXISTS measurements_device_ts ON measurements(device, ts, value, unit);
+    CREATE INDEX IF NOT EXISTS devices_room ON devices(room);
+    """,
+    # 2: minute/hour/day rollups per device and hour/day rollups per room, maintained by
+    #    an insert trigger and initially built from the existing measurements.
+    ROLLUP_TABLES_SQL + ROLLUP_TRIGGER_SQL + ROLLUP_REBUILD_SQL,
+    # 3: incremental auto-vacuum, so that pages freed by retention deletes can be
+    #    returned to the file system in small steps (see `incremental_vacuum`). Databases
+    #    above AUTO_VACUUM_MAX_BYTES are left to `enable_incremental_vacuum`.
+    _enable_incremental_vacuum,
+    # 4: log of actuator state changes, so that processes serving the same database
+    #    can follow each other's changes (see `StateFollower`).
+    STATE_LOG_SQL,
+    # 5: integer timestamps (`ts_ms`); the covering index on (device, ts_ms, ts, value, unit)
+    #    replaces the one from migration 1 for range queries and time-ordered lookups.
+    TS_MS_SQL,
+    # 6: cold tier of compressed chunks of older readings (see `compact_readings`).
+    MEASUREMENT_CHUNKS_SQL,
+]
+
+
+class TimedLock:
+    """
+    A re-entrant lock that records how often and how long threads waited for it.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.acquisitions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        waited = time.perf_counter() - started
+        self.acquisitions += 1
+        self.total_wait += waited
+        if waited > self.max_wait:
+            self.max_wait = waited
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class ConnectionPool:
+    """
+    The connections of a _SmartHouseRepository_: one dedicated writer connection,
+    shared by all threads and guarded by `write_lock`, and one reader connection per
+    thread that reads. With `max_readers`, at most that many reader connections are
+    open instead; a thread leases one of them for as long as it has a read cursor open
+    (see `lease_reader`) and waits up to the busy timeout for a free one. All
+    connections are opened with the same pragmas: WAL journal (readers and the writer
+    do not block each other), `synchronous=NORMAL`, a page cache of `cache_size_kib`,
+    memory mapped I/O of up to `mmap_size` bytes and a busy timeout. Every connection
+    caches up to `cached_statements` prepared statements.
+    """
+
+    def __init__(self, file: str, wal: bool = True, cache_size_kib: int = 16384, mmap_size: int = 256 * 1024 * 1024,
+                 busy_timeout_ms: int = 5000, cached_statements: int = 256, max_readers: Optional[int] = None) -> None:
+        self.file = file
+        self.wal = wal
+        self.cache_size_kib = cache_size_kib
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self.write_lock = TimedLock()
+        self.local = threading.local()
+        self.readers: List[sqlite3.Connection] = []
+        self.readers_lock = threading.Lock()
+        self.max_readers = max_readers
+        # Ledige lese-tilkoplingar når talet er avgrensa (max_readers)
+        self.idle_readers: List[sqlite3.Connection] = []
+        self.reader_released = threading.Condition(self.readers_lock)
+        self.generation = 0
+        self.readers_opened = 0
+        self.reads = 0
+        self.writer = self.connect()
+        if wal:
+            # Journal-modus er lagra i databasefila og treng berre setjast frå éi tilkopling
+            self.journal_mode = self.writer.execute("PRAGMA journal_mode = WAL;").fetchone()[0]
+        else:
+            self.journal_mode = self.writer.execute("PRAGMA journal_mode;").fetchone()[0]
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Opens a new connection to the database with the configured pragmas.
+        """
+        conn = sqlite3.connect(self.file, timeout=self.busy_timeout_ms / 1000, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)};")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kib)};")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)};")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        if self.wal:
+            conn.execute("PRAGMA synchronous = NORMAL;")
+        return conn
+
+    def reader(self) -> sqlite3.Connection:
+        """
+        Returns the reader connection of the calling thread, opening it if necessary.
+        """
+        local = self.local
+        if getattr(local, "generation", None) != self.generation:
+            local.conn = self.connect()
+            local.generation = self.generation
+            with self.readers_lock:
+                self.readers.append(local.conn)
+                self.readers_opened += 1
+        self.reads += 1
+        return local.conn
+
+    def lease_reader(self) -> Tuple[sqlite3.Connection, Callable[[], None]]:
+        """
+        Leases a reader connection to the calling thread (with `max_readers`) and returns
+        it with the function that ends the lease. A thread that already leases one gets
+        the same connection again; it returns to the pool when all its leases have ended.
+        Raises sqlite3.OperationalError if no connection becomes free within the busy timeout.
+        """
+        local = self.local
+        deadline = time.monotonic() + self.busy_timeout_ms / 1000
+        with self.reader_released:
+            lease = getattr(local, "lease", None)
+            if lease is None or lease[1] == 0 or lease[2] != self.generation:
+                while not self.idle_readers and len(self.readers) >= self.max_readers:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise sqlite3.OperationalError("No reader connection available")
+                    self.reader_released.wait(remaining)
+                if self.idle_readers:
+                    conn = self.idle_readers.pop()
+                else:
+                    conn = self.connect()
+                    self.readers.append(conn)
+                    self.readers_opened += 1
+                # [tilkopling, tal på lån, generasjon]
+                lease = local.lease = [conn, 0, self.generation]
+            lease[1] += 1
+            self.reads += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if released:
+                return
+            released = True
+            with self.reader_released:
+                lease[1] -= 1
+                # Tilkoplingar frå før close_readers er alt stengde
+                if lease[1] == 0 and lease[2] == self.generation:
+                    self.idle_readers.append(lease[0])
+                    self.reader_released.notify()
+
+        return lease[0], release
+
+    def close_readers(self):
+        """
+        Closes the reader connections of all threads; they are reopened on the next read.
+        """
+        with self.readers_lock:
+            self.generation += 1
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+            self.idle_readers = []
+            self.reader_released.notify_all()
+
+    def reconnect(self):
+        """
+        Closes all connections and opens a new writer connection.
+        """
+        with self.write_lock:
+            self.close_readers()
+            self.writer.close()
+            self.writer = self.connect()
+
+    def close(self):
+        self.close_readers()
+        self.writer.close()
+
+    def stats(self) -> dict:
+        """
+        Returns pool metrics: open and opened reader connections, number of reads,
+        and how often and how long (milliseconds) writers waited for the writer connection.
+        """
+        lock = self.write_lock
+        return {
+            "journal_mode": self.journal_mode,
+            "open_readers": len(self.readers),
+            "readers_opened": self.readers_opened,
+            "reads": self.reads,
+            "writes": lock.acquisitions,
+            "write_wait_total_ms": lock.total_wait * 1000,
+            "write_wait_max_ms": lock.max_wait * 1000,
+            "write_wait_avg_ms": lock.total_wait * 1000 / lock.acquisitions if lock.acquisitions else 0.0,
+        }
+
+
+class _LeasedCursor(sqlite3.Cursor):
+    # Ein lese-cursor frå ein avgrensa pool: lånet av tilkoplinga sluttar når cursoren
+    # vert stengd (eller rydda bort utan å ha vorte stengd)
+    release: Optional[Callable[[], None]] = None
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.release is not None:
+                self.release()
+
+    def __del__(self):
+        if self.release is not None:
+            self.release()
+
+
+def _recency(reading: Measurement) -> tuple:
+    # Same rekkjefølgje som LATEST_FIRST (baklengs): `ts_ms`, der tidsstempel som ikkje kan
+    # tolkast er NULL og kjem først, så ts, value og unit
+    try:
+        epoch_ms = timestamp_to_epoch_ms(reading.timestamp)
+    except (TypeError, ValueError):
+        epoch_ms = None
+    return (epoch_ms is not None, epoch_ms or 0, str(reading.timestamp), reading.value, reading.unit or "")
+
+
+class LatestReadingCache:
+    """
+    Bounded LRU cache of the latest reading per device id. Devices without readings are
+    cached as well (as None). Entries are only ever replaced by newer readings, ordered
+    as in the database (see `LATEST_FIRST`: by milliseconds since the epoch first), so a
+    reader filling the cache after a miss cannot overwrite what a writer put there in
+    the meantime. `invalidate` drops entries; fills started before an invalidation
+    are discarded (see `generation`).
+    """
+
+    def __init__(self, capacity: int = 1024) -> None:
+        self.capacity = capacity
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, device_id: str) -> Tuple[bool, Optional[Measurement]]:
+        """
+        Returns `(True, reading)` if the device is cached (reading may be None for
+        devices without readings) and `(False, None)` otherwise.
+        """
+        with self.lock:
+            if device_id in self.entries:
+                self.entries.move_to_end(device_id)
+                self.hits += 1
+                return True, self.entries[device_id][1]
+            self.misses += 1
+            return False, None
+
+    def store(self, device_id: str, reading: Optional[Measurement], generation: Optional[int] = None):
+        """
+        Caches the given reading unless a newer one is cached already. With `generation`
+        (the value of `self.generation` before the reading was queried) nothing is
+        stored if the cache was invalidated since.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            recency = _recency(reading) if reading is not None else None
+            if device_id in self.entries:
+                cached_recency, cached = self.entries[device_id]
+                if reading is None or (cached is not None and cached_recency > recency):
+                    return
+            self.entries[device_id] = (recency, reading)
+            self.entries.move_to_end(device_id)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, device_id: Optional[str] = None):
+        """
+        Drops the entry of the given device, or all entries if no device is given.
+        """
+        with self.lock:
+            self.generation += 1
+            if device_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(device_id, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
 
 
 class SmartHouseRepository:
@@ -18,12 +513,37 @@ class SmartHouseRepository:
     #    self.file = file 
     #    self.conn = sqlite3.connect(file)
 
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, wal: bool = True, cache_size_kib: int = 16384, mmap_size: int = 256 * 1024 * 1024,
+                 busy_timeout_ms: int = 5000, cached_statements: int = 256, max_readers: Optional[int] = None) -> None:
         self.file = file
-        self.conn = sqlite3.connect(file, check_same_thread=False)
+        # Ei skrive-tilkopling og ei lese-tilkopling per tråd (eller høgst max_readers), sjå ConnectionPool
+        self.pool = ConnectionPool(file, wal, cache_size_kib, mmap_size, busy_timeout_ms, cached_statements, max_readers)
+        self.conn = self.pool.writer
+        # Serialiserer skrivingar på skrive-tilkoplinga (request-trådar og flush-tråden)
+        self.lock = self.pool.write_lock
+        self.write_buffer: Optional[MeasurementBuffer] = None
+        self.state_coalescer: Optional[StateCoalescer] = None
+        self.latest_cache: Optional[LatestReadingCache] = None
+        self.listeners: List[Callable[[dict], None]] = []
+        self.migrate()
 
     def __del__(self):
-        self.conn.close()
+        # __init__ kan ha feila før poolen vart oppretta
+        if hasattr(self, "pool"):
+            self.pool.close()
+
+    def close(self):
+        """
+        Flushes all buffered measurements (if write-behind is enabled) and actuator
+        states (if state coalescing is enabled) and closes all database connections.
+        """
+        if self.write_buffer:
+            self.write_buffer.close()
+            self.write_buffer = None
+        if self.state_coalescer:
+            self.state_coalescer.close()
+            self.state_coalescer = None
+        self.pool.close()
 
     def cursor(self) -> sqlite3.Cursor:
 
@@ -37,9 +557,85 @@ class SmartHouseRepository:
 
         return self.conn.cursor()
 
+    def read_cursor(self) -> sqlite3.Cursor:
+        """
+        Provides a cursor on a connection that belongs to the calling thread and is
+        only used for reading. Threads reading concurrently therefore do not share
+        a connection. Remember to `close` the cursor when you are done; with a bounded
+        pool (`max_readers`) that returns the connection to the pool.
+        """
+        if self.pool.max_readers is None:
+            return self.pool.reader().cursor()
+        conn, release = self.pool.lease_reader()
+        try:
+            cursor = conn.cursor(_LeasedCursor)
+        except BaseException:
+            release()
+            raise
+        cursor.release = release
+        return cursor
+
+    def close_readers(self):
+        """
+        Closes the read connections of all threads; they are reopened on the next read.
+        """
+        self.pool.close_readers()
+
     def reconnect(self):
-        self.conn.close()
-        self.conn = sqlite3.connect(self.file)
+        self.pool.reconnect()
+        self.conn = self.pool.writer
+
+    def schema_version(self) -> int:
+        """
+        Returns the schema version of the database, i.e. the number of applied migrations.
+        """
+        return self.conn.execute("PRAGMA user_version;").fetchone()[0]
+
+    def migrate(self) -> int:
+        """
+        Applies all migrations from `SCHEMA_MIGRATIONS` that have not been applied
+        to the database yet. Every SQL migration runs in its own transaction together
+        with the update of the schema version. Returns the resulting schema version.
+
+        Several processes may open the same database at once (e.g. `uvicorn --workers N`).
+        The schema version is read in the `BEGIN IMMEDIATE` transaction that applies the
+        migration, so every migration is applied by one process while the others wait.
+        Migrations that are functions run between two such transactions and have to be
+        idempotent.
+        """
+        with self.lock:
+            # Andre prosessar ventar på migreringane (òg VACUUM) i staden for å feile etter busy_timeout
+            self.conn.execute(f"PRAGMA busy_timeout = {MIGRATION_BUSY_TIMEOUT_MS};")
+            try:
+                applied = None
+                while True:
+                    self.conn.execute("BEGIN IMMEDIATE;")
+                    try:
+                        version = self.schema_version()
+                        if applied == version + 1:
+                            self.conn.execute(f"PRAGMA user_version = {applied};")
+                            version = applied
+                        applied = None
+                        if version >= len(SCHEMA_MIGRATIONS):
+                            self.conn.commit()
+                            break
+                        migration = SCHEMA_MIGRATIONS[version]
+                        if callable(migration):
+                            # Kan ikkje køyre i ein transaksjon; versjonen vert sett i den neste
+                            self.conn.commit()
+                            migration(self.conn)
+                            applied = version + 1
+                            continue
+                        for statement in _sql_statements(migration):
+                            self.conn.execute(statement)
+                        self.conn.execute(f"PRAGMA user_version = {version + 1};")
+                        self.conn.commit()
+                    except Exception:
+                        self.conn.rollback()
+                        raise
+            finally:
+                self.conn.execute(f"PRAGMA busy_timeout = {int(self.pool.busy_timeout_ms)};")
+        return self.schema_version()
 
     
     def load_smarthouse_deep(self):
@@ -50,83 +646,65 @@ class SmartHouseRepository:
         are retrieved as well. 
         """
 
-        ## Kode for registering rooms and floors from database
-        DEMO_HOUSE2 = SmartHouse()
-        
-        # Spørring for å finne alle rom og lagre dette til ei liste
-        cursor = self.cursor()
-        query = "SELECT DISTINCT floor FROM rooms r;" # Spørring som tar vekk duplikerte etasjer, og returnerer berre dei unike etasjene
-        cursor.execute(query)
-        FLoorExtract = cursor.fetchall()
-        cursor.close()
-
-        # Går gjennom alle etasjer og registrerer dei
-        for floor in FLoorExtract:
-            DEMO_HOUSE2.register_floor(floor[0])
+        rooms, devices = self._structure_rows(self.read_cursor())
+        return _build_house(rooms, devices)
 
-        # Henter ei liste med alle etasjer
-        floorList = DEMO_HOUSE2.get_floors()
-
-        # Spørring for å finne alle rom og lagre dette til ei liste
-        cursor = self.cursor()
-        query = "SELECT * FROM rooms r"
-        cursor.execute(query)
-        RoomExtract = cursor.fetchall()
-        cursor.close()
-
-        # Kode for å registrere rom basert på antall etasjer
-        for rooms in RoomExtract: # går gjennom alle rom
-            for floor in floorList: # går gjennom alle etasjer
-                if rooms[1] == floor.level: # er room == etasje, så blir rommet registrert
-                    DEMO_HOUSE2.register_room(floor,rooms[2],rooms[3])
-
-        # Lager ei liste over alle registrerte romm.        
-        roomList = DEMO_HOUSE2.get_rooms()
-
-        # Spørring for å hente ut informasjon om device og rooms basert på id
-        cursor = self.cursor()
-        query2 = "select * FROM rooms r inner join devices d on r.id = d.room;"
-        cursor.execute(query2)
-        DeviceExtract2 = cursor.fetchall()
-        #cursor.close()
-
-        # Kode for å registrere device i rett rom
-        for devices in DeviceExtract2:
-            if devices[7] == "sensor":
-                device = Sensor(devices[4],devices[9],devices[8],devices[6])
-                for room in roomList: # Går gjennom alle rom som er registrert
-                    if devices[1] == 1: # Sjekker etasje
-                        if str(devices[3]) == str(room.room_name): # Sjekker rom navn er like, gitt at dei er unike
-                            DEMO_HOUSE2.register_device(room,device) # Registrerer devicen i rette rommet
-                    if devices[1] == 2: # sjekker etasje
-                        if str(devices[3]) == str(room.room_name): # Sjekker rom navn er like, gitt at dei er unike
-                            DEMO_HOUSE2.register_device(room,device) # Registrerer devicen i rette rommet
-            if devices[7] == "actuator":
-                device = Actuator(devices[4],devices[9],devices[8],devices[6])
-                for room in roomList: # Går gjennom alle rom som er registrert
-                    if devices[1] == 1: # Sjekker etasje
-                        if str(devices[3]) == str(room.room_name): # Sjekker rom navn er like, gitt at dei er unike
-                            DEMO_HOUSE2.register_device(room,device) # Registrerer devicen i rette rommet
-                    if devices[1] == 2: # sjekker etasje
-                        if str(devices[3]) == str(room.room_name): # Sjekker rom navn er like, gitt at dei er unike
-                            DEMO_HOUSE2.register_device(room,device) # Registrerer devicen i rette rommet
-
-        
-        for dev in DEMO_HOUSE2.get_devices():
-            if isinstance(dev, Actuator):
-                cursor.execute(f"SELECT state FROM states where device = '{dev.id}';")
-                state = cursor.fetchone()[0]
-                if state is None:
-                    dev.turn_off()
-                elif float(state) == 1.0:
-                    dev.turn_on()
-                else:
-                    dev.turn_on(float(state))
+    def _structure_rows(self, cursor: sqlite3.Cursor) -> Tuple[list, list]:
+        # Henter alle rom og alle devicar saman med tilstanden til aktuatorane i to spørringar
+        # (LEFT JOIN, sensorar har ingen tilstand)
+        try:
+            cursor.execute("SELECT id, floor, area, name FROM rooms ORDER BY floor, rowid;")
+            rooms = cursor.fetchall()
+            cursor.execute("""
+                SELECT d.id, d.room, d.kind, d.category, d.supplier, d.product, s.state
+                FROM devices d
+                LEFT JOIN states s ON s.device = d.id
+                ORDER BY d.rowid;
+            """)
+            devices = cursor.fetchall()
+        finally:
+            cursor.close()
+        return rooms, devices
 
+    def export_snapshot(self, path: str) -> int:
+        """
+        Writes the structure of the house (floors, rooms, devices and the actuator states)
+        to `path` as compact JSON, so that other processes can build their object graph
+        from the file instead of the database (see `load_smarthouse_snapshot`). The file
+        is replaced atomically. Returns the size of the snapshot in bytes.
+        """
+        rooms, devices = self._structure_rows(self.read_cursor())
+        data = orjson.dumps({"format": 1, "rooms": rooms, "devices": devices})
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return len(data)
 
-        cursor.close()
+    @staticmethod
+    def load_smarthouse_snapshot(path: str) -> SmartHouse:
+        """
+        Builds the _SmartHouse_ from a snapshot written by `export_snapshot`. The file
+        is memory mapped, i.e. processes loading the same snapshot share its pages.
+        The actuator states are the ones at the time of the snapshot; a `StateFollower`
+        brings them up to date.
+        """
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            snapshot = orjson.loads(memoryview(data))
+        if snapshot.get("format") != 1:
+            raise ValueError(f"Unsupported snapshot format: {snapshot.get('format')}")
+        return _build_house(snapshot["rooms"], snapshot["devices"])
 
-        return DEMO_HOUSE2
+    def load_smarthouse_lazy(self, cache_size: int = 64) -> "LazySmartHouse":
+        """
+        Returns a _SmartHouse_ proxy that only loads the floor levels up front.
+        The rooms and devices of a floor are fetched from the database the first
+        time the floor is accessed and are kept in memory for at most `cache_size`
+        floors (least recently used floors are evicted).
+        """
+        return LazySmartHouse(self, cache_size)
 
     # Method for returning the latest measurment from a sensor
     def get_latest_reading(self, sensor) -> Optional[Measurement]:
@@ -136,16 +714,31 @@ class SmartHouseRepository:
         Returns None if the given device has no sensor readings.
         """
         
+        # Med cache vert databasen berre spurt når sensoren ikkje ligg i cachen
+        if self.latest_cache is not None:
+            found, reading = self.latest_cache.get(sensor.id)
+            if found:
+                return reading
+        return self._query_latest_reading(sensor)
+
+    def _query_latest_reading(self, sensor) -> Optional[Measurement]:
+        """
+        Reads the most recent reading of the given device from the database and
+        stores it in the latest-reading cache (if enabled).
+        """
+        cache = self.latest_cache
+        generation = cache.generation if cache is not None else None
+
         # Lager spørring der eg velger value, ts og unit fra tabell measurments
         # where device = ?, der ? er ein plass holder for sensor.id som kjem seinare i koden
         # order by ts, desc, 
         # Limitert til 1 verdi
-        cursor = self.cursor()
-        query = """
+        cursor = self.read_cursor()
+        query = f"""
             SELECT value, ts, unit
             FROM measurements
             WHERE device = ?
-            ORDER BY ts DESC
+            ORDER BY {LATEST_FIRST}
             LIMIT 1;
         """
 
@@ -160,37 +753,61 @@ class SmartHouseRepository:
         # Sjekker om det er noko data, om det er data. returnerer vi objetet Measurment og setter rett data på rett plass
         # Dersom ingen data, None vil bli returnert. 
         if latest_reading_data:
-            return Measurement(value=latest_reading_data[0], timestamp=latest_reading_data[1], unit=latest_reading_data[2])
+            reading = Measurement(value=latest_reading_data[0], timestamp=latest_reading_data[1], unit=latest_reading_data[2])
         else:
-            return None
+            reading = None
+        if cache is not None:
+            cache.store(sensor.id, reading, generation)
+        return reading
         
 
 
         # Method for returning the oldest measurment from a sensor
-    def removing_oldest_reading_from_database(self, sensor) -> Optional[Measurement]:
+    def removing_oldest_reading_from_database(self, sensor) -> bool:
 
         """
-        Retrieves the most recent sensor reading for the given device if available.
-        Returns None if the given device has no sensor readings.
+        Deletes the oldest reading of the given sensor from the database.
+        Returns True if a reading was removed, False otherwise.
         """
         
-        # Lager ei spørring der eg finner den eldste verdien i tabellen, for den gitte sensoren
+        # Lager ei spørring der eg finner den eldste verdien i tabellen, for den gitte sensoren.
+        # Oppslaget går via indeksen (device, ts_ms, ts), og berre éi rad vert sletta.
+        # Ligg den eldste målinga i den kalde lagringa, vert ho fjerna frå biten sin i staden.
         cursor = self.cursor()
         query = """
         DELETE FROM measurements
-        WHERE ts = (
-            SELECT MIN(ts)
+        WHERE rowid = (
+            SELECT rowid
             FROM measurements
             WHERE device = ?
-        )
-        AND device = ?;
+            ORDER BY ts_ms ASC, ts ASC
+            LIMIT 1
+        );
         """
 
         # dette er ei try block, om det skulle vere ein feil i denne spørringa tl.d. 
         # så vil koden hoppe videre til finnaly og lukke close cursor
         try:
-            cursor.execute(query, (sensor.id, sensor.id))
-            self.conn.commit()
+            with self.lock:
+                try:
+                    cursor.execute("SELECT id, first_ms FROM measurement_chunks WHERE device = ? ORDER BY first_ms LIMIT 1;",
+                                   (sensor.id,))
+                    chunk = cursor.fetchone()
+                    if chunk is not None:
+                        cursor.execute("SELECT ts_ms FROM measurements WHERE device = ? ORDER BY ts_ms, ts LIMIT 1;", (sensor.id,))
+                        oldest = cursor.fetchone()
+                        if oldest is None or (oldest[0] is not None and chunk[1] <= oldest[0]):
+                            self._trim_chunk(cursor, chunk[0], drop_oldest=1)
+                            self.conn.commit()
+                            return True
+                    cursor.execute(query, (sensor.id,))
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                if self.latest_cache is not None and cursor.rowcount > 0:
+                    # Var det den einaste målinga, er ho også den siste
+                    self.latest_cache.invalidate(sensor.id)
             if cursor.rowcount > 0: # Sjekker om noen av radene har blitt fjernet
                 return True
             else:
@@ -201,6 +818,234 @@ class SmartHouseRepository:
         finally:
             cursor.close()
     
+    def delete_readings_batch(self, device_id: str, before_ts: str, before_rowid: Optional[int] = None, limit: int = 1000) -> int:
+        """
+        Deletes up to `limit` of the oldest readings of the given device with a timestamp
+        before `before_ts`, or, if `before_rowid` is given, up to and including the reading
+        at position `(before_ts, before_rowid)`. Readings whose timestamp cannot be parsed
+        (`ts_ms` is NULL) sort before all others and are therefore deleted first. Each call
+        is one short transaction; the rollups are not touched. Returns the number of deleted readings.
+        """
+        if before_rowid is None:
+            condition, params = "ts_ms < ?", (timestamp_to_epoch_ms(before_ts),)
+            null_condition, null_params = "", ()
+        else:
+            # Posisjonen er på tekstforma; nøkkelen i indeksen vert rekna ut som i triggeren
+            condition, params = f"(ts_ms, ts, rowid) <= ({EPOCH_MS_OF.format('?')}, ?, ?)", (before_ts, before_ts, before_rowid)
+            # Er posisjonen sjølv utan ts_ms, er det berre radene utan ts_ms fram til han som er eldre
+            null_condition = f"AND ({EPOCH_MS_OF.format('?')} IS NOT NULL OR (ts, rowid) <= (?, ?))"
+            null_params = (before_ts, before_ts, before_rowid)
+        # Radene utan ts_ms kjem først, som i indeksen, og LIMIT gjeld for begge delane saman.
+        # Kvar del er eit eige søk i indeksen, så batchen stoppar utan å lese resten av devicen.
+        query = f"""
+            DELETE FROM measurements
+            WHERE rowid IN (
+                SELECT rowid FROM (
+                    SELECT rowid FROM measurements
+                    WHERE device = ? AND ts_ms IS NULL {null_condition}
+                    ORDER BY ts, rowid
+                )
+                UNION ALL
+                SELECT rowid FROM (
+                    SELECT rowid FROM measurements
+                    WHERE device = ? AND {condition}
+                    ORDER BY ts_ms, ts, rowid
+                )
+                LIMIT ?
+            );
+        """
+        cursor = self.cursor()
+        try:
+            with self.lock:
+                try:
+                    cursor.execute(query, (device_id, *null_params, device_id, *params, limit))
+                    deleted = cursor.rowcount
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                if deleted > 0 and self.latest_cache is not None:
+                    self.latest_cache.invalidate(device_id)
+            return deleted
+        finally:
+            cursor.close()
+
+    def reading_position(self, device_id: str, offset: int) -> Optional[Tuple[str, int]]:
+        """
+        Returns the position `(ts, rowid)` of the device's reading that has `offset`
+        newer readings, or None if the device has no more than `offset` readings.
+        """
+        cursor = self.read_cursor()
+        try:
+            cursor.execute("""
+                SELECT ts, rowid FROM measurements
+                WHERE device = ?
+                ORDER BY ts_ms DESC, ts DESC, rowid DESC
+                LIMIT 1 OFFSET ?;
+            """, (device_id, offset))
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        return tuple(row) if row else None
+
+    def enable_incremental_vacuum(self) -> bool:
+        """
+        Switches the database to incremental auto-vacuum, whatever its size. This runs a
+        full VACUUM, which rewrites the database file and blocks all writers meanwhile,
+        so it belongs in a maintenance window (see `smarthouse.maintenance`).
+        Returns False if the database already used incremental auto-vacuum.
+        """
+        with self.lock:
+            return _enable_incremental_vacuum(self.conn, force=True)
+
+    def incremental_vacuum(self, pages: int = 1000) -> int:
+        """
+        Returns up to `pages` free pages of the database file to the file system
+        (requires incremental auto-vacuum, see migration 3 and `enable_incremental_vacuum`).
+        Returns the number of freed pages.
+        """
+        with self.lock:
+            before = self.conn.execute("PRAGMA freelist_count;").fetchone()[0]
+            self.conn.execute(f"PRAGMA incremental_vacuum({int(pages)});").fetchall()
+            after = self.conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        return before - after
+
+    def compact_readings(self, before_ts: Union[datetime, str], device_id: Optional[str] = None,
+                         chunk_size: int = CHUNK_SIZE) -> int:
+        """
+        Moves the readings older than `before_ts` (of one device or of all devices) into
+        the cold tier: per device and unit, up to `chunk_size` consecutive readings are
+        packed into one compressed chunk (see `smarthouse.compression`). The newest
+        reading of every device stays in `measurements`, as do readings whose timestamp
+        is not in the database format with whole seconds. Each chunk is written in one
+        short transaction together with the deletion of its rows; the rollups are not
+        touched. All reading methods combine both tiers. Returns the number of
+        compacted readings.
+        """
+        if not 1 <= chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"The chunk size must be between 1 and {MAX_CHUNK_SIZE}")
+        cutoff = timestamp_to_epoch_ms(before_ts)
+        if device_id is not None:
+            devices = [device_id]
+        else:
+            cursor = self.read_cursor()
+            try:
+                cursor.execute("SELECT id FROM devices;")
+                devices = [row[0] for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        return sum(self._compact_device(device, cutoff, chunk_size) for device in devices)
+
+    def _compact_device(self, device_id: str, cutoff: int, chunk_size: int) -> int:
+        # Radene vert lesne i rekkjefølgja til indeksen, med posisjonen etter førre batch som
+        # nedre grense, slik at rader som vert verande (t.d. andre tidsformat) ikkje vert lesne på nytt
+        query = f"""
+            SELECT ts_ms, ts, rowid, value, unit FROM measurements
+            WHERE device = ? AND ts_ms >= ? AND ts_ms < ? AND (ts_ms, ts, rowid) > (?, ?, ?)
+            AND rowid != (SELECT rowid FROM measurements WHERE device = ? ORDER BY {LATEST_FIRST} LIMIT 1)
+            ORDER BY ts_ms, ts, rowid LIMIT ?;
+        """
+        # Den nyaste målinga vert valt som i `_query_latest_reading`, så siste måling er den same
+        compacted = 0
+        key = (_MIN_EPOCH_MS, "", -1)
+        while True:
+            cursor = self.cursor()
+            try:
+                with self.lock:
+                    cursor.execute(query, (device_id, key[0], cutoff, *key, device_id, chunk_size))
+                    rows = cursor.fetchall()
+                    by_unit: Dict[Optional[str], list] = {}
+                    for ts_ms, ts, rowid, value, unit in rows:
+                        if isinstance(value, float) and ts == epoch_ms_to_timestamp(ts_ms):
+                            by_unit.setdefault(unit, []).append((ts_ms, value, rowid))
+                    # Ein feil midt i batchen må ikkje etterlate målingar i begge lagringsnivåa
+                    try:
+                        for unit, readings in by_unit.items():
+                            timestamps = [reading[0] for reading in readings]
+                            cursor.execute("""
+                                INSERT INTO measurement_chunks (device, unit, first_ms, last_ms, n, data)
+                                VALUES (?, ?, ?, ?, ?, ?);
+                            """, (device_id, unit, timestamps[0], timestamps[-1], len(readings),
+                                  encode_chunk(timestamps, [reading[1] for reading in readings])))
+                            cursor.executemany("DELETE FROM measurements WHERE rowid = ?;", [(reading[2],) for reading in readings])
+                        self.conn.commit()
+                    except Exception:
+                        self.conn.rollback()
+                        raise
+                    compacted += sum(len(readings) for readings in by_unit.values())
+            finally:
+                cursor.close()
+            if len(rows) < chunk_size:
+                return compacted
+            key = rows[-1][:3]
+
+    def delete_cold_readings(self, device_id: str, before_ts: Optional[Union[datetime, str]] = None,
+                             keep: Optional[int] = None) -> int:
+        """
+        Deletes readings of the given device from the cold tier: those with a timestamp
+        before `before_ts`, and, with `keep`, all but as many of the newest as the device
+        needs to keep `keep` readings in total (the readings in `measurements` are the
+        newest and count first). Chunks are rewritten where a limit falls inside them.
+        Runs in one transaction. Returns the number of deleted readings.
+        """
+        deleted = 0
+        cursor = self.cursor()
+        try:
+            with self.lock:
+                chunks_query = "SELECT id, first_ms, last_ms, n FROM measurement_chunks WHERE device = ? ORDER BY last_ms DESC;"
+                cursor.execute(chunks_query, (device_id,))
+                chunks = cursor.fetchall()
+                if not chunks:
+                    return 0
+                try:
+                    if before_ts is not None:
+                        cutoff = timestamp_to_epoch_ms(before_ts)
+                        for chunk_id, first_ms, last_ms, n in chunks:
+                            if last_ms < cutoff:
+                                cursor.execute("DELETE FROM measurement_chunks WHERE id = ?;", (chunk_id,))
+                                deleted += n
+                            elif first_ms < cutoff:
+                                deleted += self._trim_chunk(cursor, chunk_id, drop_before_ms=cutoff)
+                        cursor.execute(chunks_query, (device_id,))
+                        chunks = cursor.fetchall()
+                    if keep is not None:
+                        cursor.execute("SELECT COUNT(*) FROM measurements WHERE device = ?;", (device_id,))
+                        room = max(0, keep - cursor.fetchone()[0])
+                        for chunk_id, _, _, n in chunks:
+                            if room >= n:
+                                room -= n
+                            elif room > 0:
+                                deleted += self._trim_chunk(cursor, chunk_id, drop_oldest=n - room)
+                                room = 0
+                            else:
+                                cursor.execute("DELETE FROM measurement_chunks WHERE id = ?;", (chunk_id,))
+                                deleted += n
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+        finally:
+            cursor.close()
+        return deleted
+
+    def _trim_chunk(self, cursor: sqlite3.Cursor, chunk_id: int, drop_oldest: int = 0,
+                    drop_before_ms: Optional[int] = None) -> int:
+        # Skriv biten om utan dei `drop_oldest` eldste målingane og målingane før `drop_before_ms`
+        # (eller slettar han når ingen er att). Returnerer talet på fjerna målingar.
+        cursor.execute("SELECT data FROM measurement_chunks WHERE id = ?;", (chunk_id,))
+        timestamps, values = decode_chunk(cursor.fetchone()[0])
+        start = drop_oldest
+        if drop_before_ms is not None:
+            start = max(start, bisect_left(timestamps, drop_before_ms))
+        if start >= len(timestamps):
+            cursor.execute("DELETE FROM measurement_chunks WHERE id = ?;", (chunk_id,))
+            return len(timestamps)
+        if start > 0:
+            timestamps, values = timestamps[start:], values[start:]
+            cursor.execute("UPDATE measurement_chunks SET first_ms = ?, n = ?, data = ? WHERE id = ?;",
+                           (timestamps[0], len(timestamps), encode_chunk(timestamps, values), chunk_id))
+        return start
+
     # Method for returning n: number of readings from a sensor
     def get_all_readings(self, sensor, limit) -> Optional[Measurement]:
 
@@ -213,12 +1058,12 @@ class SmartHouseRepository:
         # where device = ?, der ? er ein plass holder for sensor.id som kjem seinare i koden
         # order by ts, desc, 
         # Limitert til 1 verdi
-        cursor = self.cursor()
+        cursor = self.read_cursor()
         query = """
-            SELECT value, ts, unit
+            SELECT value, ts, unit, ts_ms
             FROM measurements
             WHERE device = ?
-            ORDER BY ts DESC
+            ORDER BY ts_ms DESC, ts DESC
             LIMIT ?;
         """
 
@@ -227,8 +1072,10 @@ class SmartHouseRepository:
         # dette er ei try block, om det skulle vere ein feil i denne spørringa tl.d. 
         # så vil koden hoppe videre til finnaly og lukke close cursor
         try:
-            cursor.execute(query, (sensor.id,limit))
-            readingmeasurments = cursor.fetchall()
+            with _read_transaction(cursor):
+                cursor.execute(query, (sensor.id,limit))
+                readingmeasurments = cursor.fetchall()
+                readingmeasurments = self._newest_with_cold(cursor, sensor.id, readingmeasurments, limit)
             for data in readingmeasurments:
                 signelRow = Measurement(value=data[0], timestamp=data[1], unit=data[2])
                 readings.append(signelRow)
@@ -241,21 +1088,307 @@ class SmartHouseRepository:
         # Sjekker om det er noko data, om det er data. returnerer vi objetet Measurment og setter rett data på rett plass
         # Dersom ingen data, None vil bli returnert. 
 
+    def _newest_with_cold(self, cursor: sqlite3.Cursor, device_id: str, rows: list, limit: int) -> list:
+        # Dei `limit` nyaste radene (value, ts, unit, ts_ms) av begge lagringsnivåa. Bitane vert
+        # lesne frå den nyaste; ein bit som sluttar før den `limit`-te nyaste målinga så langt
+        # kan ikkje endre resultatet. Ei negativ grense er ingen grense, som i SQLite.
+        if limit == 0:
+            return rows
+        if limit < 0:
+            limit = _MAX_EPOCH_MS
+        bound = rows[-1][3] if len(rows) == limit and rows[-1][3] is not None else _MIN_EPOCH_MS
+        cursor.execute("""
+            SELECT unit, last_ms, data FROM measurement_chunks
+            WHERE device = ? AND last_ms >= ?
+            ORDER BY last_ms DESC;
+        """, (device_id, bound))
+        chunks = cursor.fetchmany(1)
+        if not chunks:
+            return rows
+
+        def newest_first(row):
+            return (_MIN_EPOCH_MS if row[3] is None else row[3], row[1])
+
+        rows = list(rows)
+        while chunks:
+            unit, last_ms, data = chunks[0]
+            if len(rows) >= limit:
+                rows.sort(key=newest_first, reverse=True)
+                del rows[limit:]
+                if last_ms < newest_first(rows[-1])[0]:
+                    break
+            timestamps, values = decode_chunk(data)
+            # Berre dei `limit` nyaste målingane i biten kan kome med
+            for i in range(max(0, len(timestamps) - limit), len(timestamps)):
+                rows.append((values[i], epoch_ms_to_timestamp(timestamps[i]), unit, timestamps[i]))
+            chunks = cursor.fetchmany(1)
+        rows.sort(key=newest_first, reverse=True)
+        return rows[:limit]
+
+    # Method for returning all readings of a sensor within a time range as a columnar series
+    def get_readings_series(self, sensor, from_ts: Optional[str] = None, until_ts: Optional[str] = None) -> MeasurementSeries:
+        """
+        Retrieves the readings of the given sensor with `from_ts <= ts <= until_ts` in
+        chronological order as a `MeasurementSeries`. Both bounds are optional and given
+        in the same format as the stored timestamps (e.g. '2024-01-27 00:00:00').
+        Rows are fetched in chunks, so no intermediate list of all rows is built.
+        """
+        query = "SELECT ts_ms, value, unit FROM measurements WHERE device = ? AND ts_ms BETWEEN ? AND ?"
+        params = (sensor.id, *_epoch_ms_range(from_ts, until_ts))
+        query += " ORDER BY ts_ms;"
+
+        series = MeasurementSeries()
+        cursor = self.read_cursor()
+        try:
+            with _read_transaction(cursor):
+                cold = _cold_parts(cursor, [sensor.id], *params[1:])
+                cursor.execute(query, params)
+                rows = cursor.fetchmany(10000)
+                while rows:
+                    series.extend([row for row in rows if row[0] is not None])
+                    rows = cursor.fetchmany(10000)
+        finally:
+            cursor.close()
+        return _merge_cold(cold.get(sensor.id), series)
+
+    def get_series_for_devices(self, devices: List[Device], from_ts: Optional[str] = None, until_ts: Optional[str] = None,
+                               unit: Optional[str] = None) -> Dict[str, MeasurementSeries]:
+        """
+        Retrieves the readings of all given devices (e.g. the devices of a room) with
+        `from_ts <= ts <= until_ts`, and optionally only those in `unit`, in one query.
+        Returns a `MeasurementSeries` in chronological order per device id; devices
+        without readings get an empty series.
+        """
+        result = {device.id: MeasurementSeries() for device in devices}
+        if not result:
+            return result
+        query = (f"SELECT device, ts_ms, value, unit FROM measurements "
+                 f"WHERE device IN ({', '.join('?' * len(result))}) AND ts_ms BETWEEN ? AND ?")
+        params: list = [*result, *_epoch_ms_range(from_ts, until_ts)]
+        if unit is not None:
+            query += " AND unit = ?"
+            params.append(unit)
+        query += " ORDER BY device, ts_ms;"
+
+        cursor = self.read_cursor()
+        try:
+            with _read_transaction(cursor):
+                cold = _cold_parts(cursor, list(result), *_epoch_ms_range(from_ts, until_ts), unit)
+                cursor.execute(query, params)
+                rows = cursor.fetchmany(10000)
+                while rows:
+                    # Radene kjem sortert på device, så kvar samanhengande bit går til éin serie
+                    start = 0
+                    for i in range(1, len(rows) + 1):
+                        if i == len(rows) or rows[i][0] != rows[start][0]:
+                            result[rows[start][0]].extend([row[1:] for row in rows[start:i] if row[1] is not None])
+                            start = i
+                    rows = cursor.fetchmany(10000)
+        finally:
+            cursor.close()
+        for device_id, parts in cold.items():
+            result[device_id] = _merge_cold(parts, result[device_id])
+        return result
+
+    # Method for returning a sensor series reduced to a bounded number of points, e.g. for charts
+    def get_downsampled_readings(self, sensor, points: int = 1000, from_ts: Optional[str] = None,
+                                 until_ts: Optional[str] = None, method: str = "buckets",
+                                 unit: Optional[str] = None) -> List[dict]:
+        """
+        Returns the readings of the given sensor in `unit` with `from_ts <= ts <= until_ts`
+        reduced to at most `points` entries, whatever the length of the time range.
+        Readings in different units are never mixed; `unit` defaults to the unit of the
+        sensor or, if it has none, to the unit of its latest reading.
+
+        With `method="buckets"` the range is split into `points` equally long time buckets
+        that are aggregated in SQL; each non-empty bucket gives a dict with its start
+        (`timestamp`), `count`, `min`, `max`, `avg` and `last` value. With `method="lttb"`
+        the Largest-Triangle-Three-Buckets algorithm selects `points` of the raw readings,
+        each given as a dict with `timestamp` and `value`.
+        """
+        if method not in ("buckets", "lttb"):
+            raise ValueError(f"Unknown downsampling method: {method}")
+        if unit is None:
+            unit = self._sensor_unit(sensor)
+        if method == "lttb":
+            series = self.get_series_for_devices([sensor], from_ts, until_ts, unit)[sensor.id]
+            return [{"timestamp": epoch_ms_to_timestamp(series.timestamps[i]), "value": series.values[i]}
+                    for i in lttb(series.timestamps, series.values, points)]
+        if points < 1:
+            raise ValueError("At least one point is needed")
+
+        condition = "device = ? AND ts_ms BETWEEN ? AND ?"
+        params = (sensor.id, *_epoch_ms_range(from_ts, until_ts))
+        if unit is not None:
+            condition += " AND unit = ?"
+            params += (unit,)
+
+        cursor = self.read_cursor()
+        try:
+            # Med målingar i den kalde lagringa vert bøttene rekna ut over den samanfletta serien
+            cursor.execute("SELECT 1 FROM measurement_chunks WHERE device = ? AND first_ms <= ? AND last_ms >= ? LIMIT 1;",
+                           (sensor.id, params[2], params[1]))
+            if cursor.fetchone() is not None:
+                return _bucket_stats(self.get_series_for_devices([sensor], from_ts, until_ts, unit)[sensor.id], points)
+            # Start og slutt kjem frå indeksen (device, ts_ms)
+            cursor.execute(f"SELECT MIN(ts_ms), MAX(ts_ms) FROM measurements WHERE {condition};", params)
+            first, last = cursor.fetchone()
+            if first is None:
+                return []
+            # Heile millisekund per bøtte, slik at det vert høgst `points` bøtter
+            width = (last - first) // points + 1
+            bucket = "(ts_ms - ?) / ?"
+            cursor.execute(f"""
+                SELECT {bucket} AS bucket, COUNT(*), MIN(value), MAX(value), AVG(value)
+                FROM measurements
+                WHERE {condition}
+                GROUP BY bucket
+                ORDER BY bucket;
+            """, (first, width, *params))
+            rows = cursor.fetchall()
+            # Med MAX(ts_ms) som einaste aggregat kjem value frå den siste målinga i bøtta
+            cursor.execute(f"""
+                SELECT {bucket} AS bucket, MAX(ts_ms), value
+                FROM measurements
+                WHERE {condition}
+                GROUP BY bucket
+                ORDER BY bucket;
+            """, (first, width, *params))
+            latest = {row[0]: row[2] for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+        return [{
+            "timestamp": epoch_ms_to_timestamp(first + bucket * width),
+            "count": count,
+            "min": min_value,
+            "max": max_value,
+            "avg": avg_value,
+            "last": latest[bucket],
+        } for bucket, count, min_value, max_value, avg_value in rows]
+
+    def _sensor_unit(self, sensor) -> Optional[str]:
+        # Devices-tabellen har inga eining, så sensorar frå databasen får eininga til den siste målinga
+        if getattr(sensor, "unit", None):
+            return sensor.unit
+        latest = self.get_latest_reading(sensor)
+        return latest.unit if latest is not None else None
+
+    # Method for streaming the readings of a sensor within a time range, page by page
+    def iter_readings(self, sensor, from_ts: Optional[str] = None, until_ts: Optional[str] = None,
+                      after: Optional[Tuple[str, int]] = None, batch_size: int = 1000) -> Iterator[Tuple[Tuple[str, int], Measurement]]:
+        """
+        Yields the readings of the given sensor with `from_ts <= ts <= until_ts` in
+        chronological order together with their position `(ts, rowid)`. Passing a
+        previously yielded position as `after` resumes directly behind that reading.
+        The rows are read with keyset pagination, i.e. one short indexed query per
+        `batch_size` rows, so no cursor is held open between batches and memory use
+        does not depend on the size of the range. Readings in the cold tier are
+        decoded one chunk at a time and get negative rowids in their positions; the
+        chunks are looked up again for every batch, so a `compact_readings` running
+        while the stream is consumed does not make it skip readings.
+        """
+        # Posisjonen (ts, rowid) vert gjort om til nøkkelen (ts_ms, ts, rowid) i indeksen, med
+        # ts_ms rekna ut som i triggeren; startposisjonen ("", -1) ligg før alle rader
+        from_ms, until_ms = _epoch_ms_range(from_ts, until_ts)
+        position = after if after is not None else ("", -1)
+        cursor = self.read_cursor()
+        try:
+            cursor.execute(f"SELECT coalesce({EPOCH_MS_OF.format('?')}, {_MIN_EPOCH_MS});", (position[0],))
+            key = (cursor.fetchone()[0], *position)
+        finally:
+            cursor.close()
+
+        while True:
+            items, complete, next_ms = self._readings_page(sensor.id, from_ms, until_ms, key, batch_size)
+            for key, measurement in items:
+                yield key[1:], measurement
+            if complete:
+                if next_ms is None:
+                    return
+                # Alt før den neste biten i den kalde lagringa er lese
+                key = max(key, (next_ms, "", _MIN_EPOCH_MS))
+
+    def _readings_page(self, device_id: str, from_ms: int, until_ms: int, key: Tuple[int, str, int],
+                       batch_size: int) -> Tuple[list, bool, Optional[int]]:
+        """
+        Reads the next page of `iter_readings` behind `key` from both tiers in one read
+        transaction. The chunks are looked up again for every page, so readings that a
+        concurrent `compact_readings` moves to the cold tier are still found. Only the
+        chunks covering the start of the rest of the range are decoded; the page ends
+        before the next chunk starts (`next_ms`) and, if the hot rows fill the page, at
+        the last of them. Returns the readings in key order, whether every reading before
+        `next_ms` (or `until_ms`) has been returned, and `next_ms`.
+        """
+        # Den nedre grensa på ts_ms står åleine, slik at kvar side startar søket i indeksen ved posisjonen
+        hot_query = """
+            SELECT ts_ms, ts, rowid, value, unit FROM measurements
+            WHERE device = ? AND ts_ms >= max(?, ?) AND ts_ms <= ?
+            AND (ts_ms, ts, rowid) > (?, ?, ?)
+            ORDER BY ts_ms, ts, rowid LIMIT ?;
+        """
+        overlapping = "device = ? AND last_ms >= max(?, ?) AND first_ms <= ?"
+        cursor = self.read_cursor()
+        try:
+            with _read_transaction(cursor):
+                cursor.execute(f"SELECT MIN(first_ms) FROM measurement_chunks WHERE {overlapping};",
+                               (device_id, from_ms, key[0], until_ms))
+                first_ms = cursor.fetchone()[0]
+                chunks, next_ms = [], None
+                if first_ms is not None:
+                    # Bitane som alt er starta ved posisjonen, eller som startar først etter han
+                    start_ms = max(first_ms, key[0])
+                    cursor.execute(f"SELECT id, unit, data FROM measurement_chunks WHERE {overlapping} AND first_ms <= ?;",
+                                   (device_id, from_ms, key[0], until_ms, start_ms))
+                    chunks = cursor.fetchall()
+                    cursor.execute(f"SELECT MIN(first_ms) FROM measurement_chunks WHERE {overlapping} AND first_ms > ?;",
+                                   (device_id, from_ms, key[0], until_ms, start_ms))
+                    next_ms = cursor.fetchone()[0]
+                upper_ms = until_ms if next_ms is None else next_ms - 1
+                cursor.execute(hot_query, (device_id, from_ms, key[0], upper_ms, *key, batch_size))
+                rows = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        items = [((ts_ms, ts, rowid), Measurement(value=value, timestamp=ts, unit=unit))
+                 for ts_ms, ts, rowid, value, unit in rows]
+        complete = len(rows) < batch_size
+        upper = None if complete else items[-1][0]
+        # Kvar måling i ein bit får ein negativ rowid ut frå id-en til biten og plassen i han
+        for chunk_id, unit, data in chunks:
+            timestamps, values = decode_chunk(data)
+            base = -(chunk_id + 1) * MAX_CHUNK_SIZE
+            for i in range(bisect_left(timestamps, max(from_ms, key[0])), bisect_right(timestamps, upper_ms)):
+                ts_ms = timestamps[i]
+                ts = epoch_ms_to_timestamp(ts_ms)
+                cold_key = (ts_ms, ts, base + i)
+                if cold_key > key and (upper is None or cold_key <= upper):
+                    items.append((cold_key, Measurement(value=values[i], timestamp=ts, unit=unit)))
+        if chunks:
+            items.sort(key=lambda item: item[0])
+        return items, complete, next_ms
+
     # Method for adding measurments to database, returning a bool true or false if implimentation was ok
     def add_measurment(self, sensor_ID : str , timestamp : datetime , value : float , unit : str ) -> bool: #Optional[Measurement]:
 
+        # I write-behind modus vert målinga lagt i bufferet og skrive av flush-tråden
+        if self.write_buffer:
+            return self.write_buffer.put((sensor_ID, timestamp, value, unit))
+
         # Oppretter forbindelse med database
         cursor = self.cursor()
         query = """
-            INSERT INTO measurements(device, value, ts, unit)
-            VALUES(?,?,?,?);
+            INSERT INTO measurements(device, value, ts, unit, ts_ms)
+            VALUES(?,?,?,?,?);
         """
 
         try:
-            # Legger til måling i database
-            cursor.execute(query,(sensor_ID, value, timestamp,unit))
-            # Committer endringa til databasen
-            self.conn.commit()
+            with self.lock:
+                # Legger til måling i database
+                cursor.execute(query,(sensor_ID, value, timestamp, unit, _epoch_ms(timestamp)))
+                # Committer endringa til databasen
+                self.conn.commit()
+                self._cache_latest([(sensor_ID, timestamp, value, unit)])
+            self._notify_measurements([(sensor_ID, timestamp, value, unit)])
             return True
 
         except Exception as e:
@@ -263,36 +1396,192 @@ class SmartHouseRepository:
             print(f"An error occurred: {e}")
             return False
         finally:
-            cursor.close()      
-    
+            cursor.close()
+
+    # Method for adding many measurments in one transaction, returning the number of rows added
+    def add_measurements(self, readings: List[Tuple[str, Union[datetime, str], float, str]]) -> int:
+        """
+        Adds a batch of measurements to the database. Each reading is a tuple
+        `(sensor_ID, timestamp, value, unit)` like the arguments of `add_measurment`.
+        All rows are written with a single `executemany` in one transaction, i.e.
+        either the whole batch is stored or nothing is. Returns the number of stored rows.
+        """
+        if not readings:
+            return 0
+
+        query = """
+            INSERT INTO measurements(device, value, ts, unit, ts_ms)
+            VALUES(?,?,?,?,?);
+        """
+        cursor = self.cursor()
+        try:
+            with self.lock:
+                try:
+                    cursor.executemany(query, [(sensor_ID, value, timestamp, unit, _epoch_ms(timestamp))
+                                               for sensor_ID, timestamp, value, unit in readings])
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                self._cache_latest(readings)
+            self._notify_measurements(readings)
+            return len(readings)
+        except Exception:
+            logger.exception("Adding %d measurements failed", len(readings))
+            return 0
+        finally:
+            cursor.close()
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        """
+        Registers a function that is called with an event dict after every committed change:
+        `{"event": "measurement", "uuid", "timestamp", "value", "unit"}` for each added
+        measurement and `{"event": "state", "uuid", "state"}` for each saved actuator state.
+        Listeners are called on the writing thread and should return quickly.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[dict], None]):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _notify(self, event: dict):
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception:
+                logger.exception("A listener failed on %s", event.get("event"))
+
+    def _notify_measurements(self, readings: List[Tuple[str, Union[datetime, str], float, str]]):
+        if not self.listeners:
+            return
+        for sensor_ID, timestamp, value, unit in readings:
+            if isinstance(timestamp, datetime):
+                timestamp = timestamp.isoformat(" ")
+            self._notify({"event": "measurement", "uuid": sensor_ID, "timestamp": timestamp, "value": value, "unit": unit})
+
+    def enable_latest_cache(self, capacity: int = 1024) -> LatestReadingCache:
+        """
+        Keeps the latest reading of up to `capacity` devices in memory, so that
+        `get_latest_reading` does not query the database for cached devices. The cache
+        is filled with one query over all devices and then kept up to date by
+        `add_measurment`, `add_measurements` (also in write-behind mode) and
+        `removing_oldest_reading_from_database`. Changes made to the database by other
+        means require a call to `invalidate_latest_cache`.
+        """
+        if self.latest_cache is not None:
+            return self.latest_cache
+        cache = LatestReadingCache(capacity)
+        cursor = self.read_cursor()
+        try:
+            # Siste måling per device med same rekkjefølgje som i _query_latest_reading,
+            # kvar slått opp via indeksen (device, ts_ms, ts, value, unit)
+            cursor.execute(f"""
+                SELECT devices.id, m.value, m.ts, m.unit
+                FROM devices
+                LEFT JOIN measurements m ON m.rowid = (
+                    SELECT rowid FROM measurements
+                    WHERE device = devices.id
+                    ORDER BY {LATEST_FIRST}
+                    LIMIT 1
+                )
+                LIMIT ?;
+            """, (capacity,))
+            for device_id, value, ts, unit in cursor.fetchall():
+                cache.store(device_id, Measurement(value=value, timestamp=ts, unit=unit) if ts is not None else None)
+        finally:
+            cursor.close()
+        self.latest_cache = cache
+        return cache
+
+    def invalidate_latest_cache(self, device_id: Optional[str] = None):
+        """
+        Drops the cached latest reading of the given device (or of all devices).
+        """
+        if self.latest_cache is not None:
+            self.latest_cache.invalidate(device_id)
+
+    def _cache_latest(self, readings: List[Tuple[str, Union[datetime, str], float, str]]):
+        """
+        Write-through of newly committed readings into the latest-reading cache.
+        """
+        cache = self.latest_cache
+        if cache is None:
+            return
+        for sensor_ID, timestamp, value, unit in readings:
+            # Same form as the value read back from the database
+            if isinstance(timestamp, datetime):
+                timestamp = timestamp.isoformat(" ")
+            if isinstance(timestamp, str) and isinstance(value, (int, float)) and not isinstance(value, bool):
+                cache.store(sensor_ID, Measurement(value=float(value), timestamp=timestamp, unit=unit))
+            else:
+                cache.invalidate(sensor_ID)
+
+    def enable_write_behind(self, max_batch: int = 500, max_latency: float = 0.05, capacity: int = 10000) -> "MeasurementBuffer":
+        """
+        Switches `add_measurment` into write-behind mode: readings are queued in an
+        in-memory buffer and written by a background thread in groups of up to
+        `max_batch` rows, at the latest `max_latency` seconds after they were queued.
+        When `capacity` readings are waiting, `add_measurment` blocks until there is
+        room again. Call `close()` (or `flush()` on the returned buffer) to make sure
+        all readings are stored.
+        """
+        if self.write_buffer is None:
+            self.write_buffer = MeasurementBuffer(self, max_batch, max_latency, capacity)
+        return self.write_buffer
+
+    def enable_state_coalescing(self, window: float = 0.05) -> "StateCoalescer":
+        """
+        Switches `update_actuator_state(s)` into coalescing mode: states are collected for
+        up to `window` seconds and only the latest state of each actuator is written, all
+        in one transaction. Call `close()` (or `flush()` on the returned coalescer) to make
+        sure all states are stored.
+        """
+        if self.state_coalescer is None:
+            self.state_coalescer = StateCoalescer(self, window)
+        return self.state_coalescer
+
     # Metode tatt frå løysningsforslag
     def update_actuator_state(self, actuator):
         """
         Saves the state of the given actuator in the database. 
         """
-        if isinstance(actuator, Actuator):
-            s = 'NULL'
-            if isinstance(actuator.state, float):
-                s = str(actuator.state)
-            elif actuator.state is True:
-                s = '1.0'
-            query = f"""
-                    UPDATE states 
-                    SET state = {s}
-                    WHERE device = '{actuator.id}';
-                            """
-            c = self.cursor()
-            c.execute(query)
-            self.conn.commit()
-            c.close()
+        self.update_actuator_states([actuator])
 
+    def update_actuator_states(self, actuators: List[Device]) -> int:
+        """
+        Saves the states of the given actuators in the database in one transaction
+        (other devices are ignored). Returns the number of saved states.
+        """
+        updates = [(_state_value(actuator.state), actuator.id) for actuator in actuators if isinstance(actuator, Actuator)]
+        if not updates:
+            return 0
+        if self.state_coalescer:
+            for state, actuator_id in updates:
+                self.state_coalescer.put(actuator_id, state)
+            return len(updates)
+        return self.write_actuator_states(updates)
 
-        # TODO: Implement this method. You will probably need to extend the existing database structure: e.g.
-        #       by creating a new table (`CREATE`), adding some data to it (`INSERT`) first, and then issue
-        #       and SQL `UPDATE` statement. Remember also that you will have to call `commit()` on the `Connection`
-        #       stored in the `self.conn` instance variable.
+    def write_actuator_states(self, updates: List[Tuple[Optional[float], str]]) -> int:
+        """
+        Writes the given `(state, actuator id)` pairs with one parameterized `executemany`
+        in one transaction. Returns the number of written states.
+        """
+        c = self.cursor()
+        try:
+            with self.lock:
+                try:
+                    c.executemany("UPDATE states SET state = ? WHERE device = ?;", updates)
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+        finally:
+            c.close()
+        for state, actuator_id in updates:
+            self._notify({"event": "state", "uuid": actuator_id, "state": state})
+        return len(updates)
 
-    
     def calc_avg_temperatures_in_room(self, room, from_date: Optional[str] = None, until_date: Optional[str] = None) -> dict:
         """Calculates the average temperatures in the given room for the given time range by
         fetching all available temperature sensor data (either from a dedicated temperature sensor 
@@ -303,31 +1592,21 @@ class SmartHouseRepository:
         The result should be a dictionary where the keys are strings representing dates (iso format) and 
         the values are floating point numbers containing the average temperature that day.
         """
-        cursor = self.conn.cursor()
+        cursor = self.read_cursor()
 
-        # Spørring
-        # ved å bruke measurments.unit = '°C', så tar spørringa med seg alle plasser der det er ein temperatur.
+        # Spørring mot dagsaggregata for rommet
+        # ved å bruke unit = '°C', så tar spørringa med seg alle plasser der det er ein temperatur.
         query = """
-        SELECT DATE(measurements.ts) as date, AVG(measurements.value) as avg_temp
-        FROM measurements
-        JOIN devices ON measurements.device = devices.id
-        JOIN rooms ON devices.room = rooms.id
-        WHERE rooms.name = ? AND measurements.unit = '°C'
-        AND (DATE(measurements.ts) BETWEEN ? AND ? OR ? IS NULL OR ? IS NULL)
-        GROUP BY DATE(measurements.ts);
+        SELECT rr.bucket AS date, SUM(rr.total) / SUM(rr.n) AS avg_temp
+        FROM room_rollups rr
+        JOIN rooms ON rr.room = rooms.id
+        WHERE rooms.name = ? AND rooms.floor = ? AND rr.unit = '°C' AND rr.granularity = 'day'
+        AND (rr.bucket BETWEEN ? AND ? OR ? IS NULL OR ? IS NULL)
+        GROUP BY rr.bucket;
         """
 
-        # Spørring som kan brukest i dbeaver.
-        """SELECT DATE(measurements.ts) as date, AVG(measurements.value) as avg_temp
-        FROM measurements
-        JOIN devices ON measurements.device = devices.id
-        JOIN rooms ON devices.room = rooms.id
-        WHERE (rooms.name = 'Living Room / Kitchen'  AND measurements.unit = '°C' AND devices.kind IN ('Temperature Sensor', 'Heat Pump','Smart Oven'))
-        GROUP BY DATE(measurements.ts);"""
-
-
         # Eksekuterer spørringa, ? fra spørringa er referert til i cursor under
-        cursor.execute(query, (room.room_name, from_date, until_date, from_date, until_date))
+        cursor.execute(query, (room.room_name, room.floor.level, from_date, until_date, from_date, until_date))
         rows = cursor.fetchall()
 
         # Konverterer rows in til ein dictionary
@@ -346,52 +1625,858 @@ class SmartHouseRepository:
         """
         
         # Spørring for å rom id
-        cursor = self.conn.cursor()
-        room_id_query = "SELECT id FROM rooms WHERE name = ?"
-        cursor.execute(room_id_query, (room.room_name,))
+        cursor = self.read_cursor()
+        room_id_query = "SELECT id FROM rooms WHERE name = ? AND floor = ?"
+        cursor.execute(room_id_query, (room.room_name, room.floor.level))
         room_id_result = cursor.fetchone()
         
         # Om ikkje id er funnet, returnerer tom liste
         if not room_id_result:
+            cursor.close()
             return []  # Room not found
 
         # rom ID = første indeks i resultatet
         room_id = room_id_result[0]
 
-        # Spørring
+        # Gjennomsnittet for dagen kjem frå dagsaggregata til fuktsensorane i rommet
+        cursor.execute("""
+            SELECT SUM(dr.total) / SUM(dr.n)
+            FROM device_rollups dr
+            JOIN devices ON dr.device = devices.id
+            WHERE devices.room = ? AND devices.kind = 'Humidity Sensor'
+            AND dr.granularity = 'day' AND dr.bucket = ?;
+        """, (room_id, date))
+        avg_humidity = cursor.fetchone()[0]
+        if avg_humidity is None:
+            cursor.close()
+            return []
+
+        # Teljinga per time treng rådata, men berre for den eine dagen: eit indeksert
+        # intervall på (device, ts_ms) i staden for DATE(ts) over heile tabellen.
+        next_day = (date_type.fromisoformat(date) + timedelta(days=1)).isoformat()
         query = """
-        WITH AverageHumidity AS (
-            SELECT AVG(measurements.value) as avg_humidity
-            FROM measurements
-            JOIN devices ON measurements.device = devices.id
-            WHERE devices.room = ?
-            AND DATE(measurements.ts) = ?
-            AND devices.kind = 'Humidity Sensor'
-        ),
-        HourlyMeasurements AS (
-            SELECT 
-                strftime('%H', measurements.ts) as hour,
-                measurements.value as humidity
-            FROM measurements
-            JOIN devices ON measurements.device = devices.id
-            WHERE devices.room = ?
-            AND DATE(measurements.ts) = ?
-            AND devices.kind = 'Humidity Sensor'
-        )
-        SELECT hour
-        FROM HourlyMeasurements, AverageHumidity
-        WHERE humidity > avg_humidity
-        GROUP BY hour
-        HAVING COUNT(humidity) > 3;
-        """
-
-        # Setter inn rom id og dato inn i spørringa der det står ?
-        cursor.execute(query, (room_id, date,room_id,date))
-        rows = cursor.fetchall()
+        SELECT substr(measurements.ts, 12, 2) AS hour, COUNT(*)
+        FROM measurements
+        JOIN devices ON measurements.device = devices.id
+        WHERE devices.room = ?
+        AND devices.kind = 'Humidity Sensor'
+        AND measurements.ts_ms >= ? AND measurements.ts_ms < ?
+        AND measurements.value > ?
+        GROUP BY hour;
+        """
+
+        # Setter inn rom id, dato og gjennomsnitt inn i spørringa der det står ?
+        day_ms, next_day_ms = timestamp_to_epoch_ms(date), timestamp_to_epoch_ms(next_day)
+        with _read_transaction(cursor):
+            cursor.execute(query, (room_id, day_ms, next_day_ms, avg_humidity))
+            counts = {int(hour): n for hour, n in cursor.fetchall()}
+            # Målingar frå dagen i den kalde lagringa vert talde med
+            cursor.execute("SELECT id FROM devices WHERE room = ? AND kind = 'Humidity Sensor';", (room_id,))
+            cold = _cold_parts(cursor, [row[0] for row in cursor.fetchall()], day_ms, next_day_ms - 1)
         cursor.close()
+        for parts in cold.values():
+            for timestamps, values, _ in parts:
+                for ts_ms, value in zip(timestamps, values):
+                    if value > avg_humidity:
+                        hour = (ts_ms - day_ms) // 3600000
+                        counts[hour] = counts.get(hour, 0) + 1
 
         # Converterer rekke in til ei liste av timer
-        hours_with_high_humidity = [int(row[0]) for row in rows]
+        hours_with_high_humidity = sorted(hour for hour, n in counts.items() if n > 3)
         return hours_with_high_humidity
 
+    def get_device_rollups(self, sensor, granularity: str = "hour", from_bucket: Optional[str] = None,
+                           until_bucket: Optional[str] = None) -> List[dict]:
+        """
+        Returns the pre-aggregated statistics (count, sum, min, max, avg) of the given sensor
+        per minute, hour or day in chronological order. The optional bounds are timestamps
+        or prefixes of timestamps (e.g. '2024-01-27'); `until_bucket` is inclusive.
+        """
+        if granularity not in DEVICE_ROLLUP_GRANULARITIES:
+            raise ValueError(f"Unknown granularity: {granularity}")
+        query = """
+            SELECT bucket, unit, n, total, min_value, max_value
+            FROM device_rollups
+            WHERE device = ? AND granularity = ? AND bucket >= ? AND bucket <= ?
+            ORDER BY bucket, unit;
+        """
+        return self._rollup_rows(query, (sensor.id, granularity), granularity, from_bucket, until_bucket)
+
+    def get_room_rollups(self, room, granularity: str = "hour", unit: Optional[str] = None,
+                         from_bucket: Optional[str] = None, until_bucket: Optional[str] = None) -> List[dict]:
+        """
+        Returns the pre-aggregated statistics (count, sum, min, max, avg) over all devices
+        in the given room per hour or day, grouped by unit (optionally only for one unit).
+        Bounds are interpreted like in `get_device_rollups`.
+        """
+        if granularity not in ROOM_ROLLUP_GRANULARITIES:
+            raise ValueError(f"Unknown granularity: {granularity}")
+        query = """
+            SELECT rr.bucket, rr.unit, rr.n, rr.total, rr.min_value, rr.max_value
+            FROM room_rollups rr
+            JOIN rooms r ON r.id = rr.room
+            WHERE r.name = ? AND r.floor = ? AND rr.unit = coalesce(?, rr.unit) AND rr.granularity = ?
+            AND rr.bucket >= ? AND rr.bucket <= ?
+            ORDER BY rr.bucket, rr.unit;
+        """
+        return self._rollup_rows(query, (room.room_name, room.floor.level, unit, granularity), granularity, from_bucket, until_bucket)
+
+    def _rollup_rows(self, query: str, params: tuple, granularity: str, from_bucket: Optional[str], until_bucket: Optional[str]) -> List[dict]:
+        # Grensene vert kutta til lengda av bøtta; '~' sorterer etter alle teikn i eit tidsstempel,
+        # slik at until_bucket tek med alle bøtter som byrjar med prefikset.
+        length = DEVICE_ROLLUP_GRANULARITIES[granularity]
+        lower = (from_bucket or "").replace("T", " ")[:length]
+        upper = (until_bucket or "~").replace("T", " ")[:length] + "~"
+        cursor = self.read_cursor()
+        try:
+            cursor.execute(query, (*params, lower, upper))
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+        return [
+            {"bucket": bucket, "unit": unit, "count": n, "sum": total, "min": min_value, "max": max_value, "avg": total / n}
+            for bucket, unit, n, total, min_value, max_value in rows
+        ]
+
+    def rebuild_rollups(self):
+        """
+        Recomputes all device and room rollups from the raw measurements, including
+        those in the cold tier. Note that this drops the rollups of readings removed
+        by retention.
+        """
+        with self.lock:
+            self.conn.executescript(f"BEGIN; {ROLLUP_REBUILD_SQL}")
+            try:
+                self._rollup_cold_readings()
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def _rollup_cold_readings(self):
+        # Legg målingane i den kalde lagringa til i aggregata, bit for bit
+        cursor = self.conn.cursor()
+        chunks = self.conn.cursor()
+        try:
+            cursor.execute("SELECT id, room FROM devices;")
+            rooms = dict(cursor.fetchall())
+            chunks.execute("SELECT device, unit, data FROM measurement_chunks;")
+            for device, unit, data in chunks:
+                unit = unit or ""
+                device_rows: Dict[tuple, list] = {}
+                room_rows: Dict[tuple, list] = {}
+                for ts_ms, value in zip(*decode_chunk(data)):
+                    ts = epoch_ms_to_timestamp(ts_ms)
+                    for granularity, length in DEVICE_ROLLUP_GRANULARITIES.items():
+                        _add_to_rollup(device_rows, (device, unit, granularity, ts[:length]), value)
+                    if device in rooms:
+                        for granularity, length in ROOM_ROLLUP_GRANULARITIES.items():
+                            _add_to_rollup(room_rows, (rooms[device], unit, granularity, ts[:length]), value)
+                cursor.executemany("INSERT INTO device_rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                                   + _ROLLUP_UPSERT.format(key="device, granularity, bucket, unit"),
+                                   [(*key, *stats) for key, stats in device_rows.items()])
+                cursor.executemany("INSERT INTO room_rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                                   + _ROLLUP_UPSERT.format(key="room, unit, granularity, bucket"),
+                                   [(*key, *stats) for key, stats in room_rows.items()])
+        finally:
+            chunks.close()
+            cursor.close()
+
+
+
+
+def _epoch_ms(timestamp: Union[datetime, str]) -> Optional[int]:
+    # `ts_ms` for ei ny måling, lik det triggeren (julianday) ville rekna ut, for tidsstempel på
+    # heile sekund; alt anna (brøkdelar av sekund, tidssoner) vert fylt inn av triggeren (NULL)
+    if isinstance(timestamp, str):
+        try:
+            return parse_timestamp(timestamp)
+        except ValueError:
+            return None
+    if isinstance(timestamp, datetime) and timestamp.tzinfo is None and timestamp.microsecond == 0:
+        return timestamp_to_epoch_ms(timestamp)
+    return None
+
+
+@contextmanager
+def _read_transaction(cursor: sqlite3.Cursor):
+    # Begge lagringsnivåa vert lesne i éin transaksjon, så ei samtidig komprimering
+    # verken gjev manglande eller doble målingar
+    cursor.execute("BEGIN;")
+    try:
+        yield cursor
+    finally:
+        cursor.execute("COMMIT;")
+
+
+def _cold_parts(cursor: sqlite3.Cursor, device_ids: List[str], from_ms: int, until_ms: int,
+                unit: Optional[str] = None) -> Dict[str, list]:
+    """
+    Decodes the chunks of the given devices that overlap `from_ms..until_ms` into
+    parts `(timestamps, values, unit)` cut to that interval, listed per device id
+    in the order of their first timestamp. Devices without such chunks are left out.
+    """
+    if not device_ids:
+        return {}
+    query = (f"SELECT device, unit, data FROM measurement_chunks "
+             f"WHERE device IN ({', '.join('?' * len(device_ids))}) AND first_ms <= ? AND last_ms >= ?")
+    params: list = [*device_ids, until_ms, from_ms]
+    if unit is not None:
+        query += " AND unit = ?"
+        params.append(unit)
+    cursor.execute(query + " ORDER BY device, first_ms;", params)
+    parts: Dict[str, list] = {}
+    for device, chunk_unit, data in cursor.fetchall():
+        timestamps, values = decode_chunk(data)
+        start, end = bisect_left(timestamps, from_ms), bisect_right(timestamps, until_ms)
+        if start < end:
+            parts.setdefault(device, []).append((timestamps[start:end], values[start:end], chunk_unit))
+    return parts
+
+
+def _merge_cold(parts: Optional[list], hot: MeasurementSeries) -> MeasurementSeries:
+    # Dei kalde delane ligg normalt før dei varme målingane; berre når tidsintervalla
+    # overlappar (t.d. målingar som kom inn seint) må serien sorterast
+    if not parts:
+        return hot
+    series = MeasurementSeries()
+    ordered = True
+    for timestamps, values, unit in parts + [(hot.timestamps, hot.values, None)]:
+        if not timestamps:
+            continue
+        if series.timestamps and series.timestamps[-1] > timestamps[0]:
+            ordered = False
+        series.timestamps.extend(timestamps)
+        series.values.extend(values)
+    for _, values, unit in parts:
+        series.units.extend([unit] * len(values))
+    series.units.extend(hot.units)
+    if not ordered:
+        order = sorted(range(len(series)), key=series.timestamps.__getitem__)
+        series.timestamps = array("q", [series.timestamps[i] for i in order])
+        series.values = array("d", [series.values[i] for i in order])
+        series.units = [series.units[i] for i in order]
+    return series
+
+
+def _bucket_stats(series: MeasurementSeries, points: int) -> List[dict]:
+    # Dei same bøttene som SQL-vegen i `get_downsampled_readings`, rekna ut over ein serie
+    timestamps, values = series.timestamps, series.values
+    if not timestamps:
+        return []
+    first = timestamps[0]
+    width = (timestamps[-1] - first) // points + 1
+    result = []
+    start = 0
+    while start < len(timestamps):
+        bucket = (timestamps[start] - first) // width
+        end = bisect_left(timestamps, first + (bucket + 1) * width, start)
+        bucket_values = values[start:end]
+        result.append({
+            "timestamp": epoch_ms_to_timestamp(first + bucket * width),
+            "count": end - start,
+            "min": min(bucket_values),
+            "max": max(bucket_values),
+            "avg": sum(bucket_values) / (end - start),
+            "last": bucket_values[-1],
+        })
+        start = end
+    return result
+
+
+def _add_to_rollup(rows: Dict[tuple, list], key: tuple, value: float):
+    stats = rows.get(key)
+    if stats is None:
+        rows[key] = [1, value, value, value]
+    else:
+        stats[0] += 1
+        stats[1] += value
+        stats[2] = min(stats[2], value)
+        stats[3] = max(stats[3], value)
+
+
+# Grensene til eit tidsintervall som heiltal; manglande grenser gjev heile intervallet
+_MIN_EPOCH_MS = -(2 ** 63)
+_MAX_EPOCH_MS = 2 ** 63 - 1
+
+
+def _epoch_ms_range(from_ts: Optional[str], until_ts: Optional[str]) -> Tuple[int, int]:
+    return (_MIN_EPOCH_MS if from_ts is None else timestamp_to_epoch_ms(from_ts),
+            _MAX_EPOCH_MS if until_ts is None else timestamp_to_epoch_ms(until_ts))
+
+
+def _state_value(state) -> Optional[float]:
+    # Tilstanden vert lagra som tal: målverdien, 1.0 for på utan målverdi og NULL for av
+    if state is True:
+        return 1.0
+    if isinstance(state, (int, float)) and state is not False:
+        return float(state)
+    return None
+
+
+def _build_house(rooms: list, devices: list) -> SmartHouse:
+    """
+    Builds the house from the rows `(id, floor, area, name)` of the rooms table (ordered
+    by floor) and the rows of the devices table joined with the states table.
+    """
+    house = SmartHouse()
+    # Etasjane vert registrert første gong dei dukkar opp, og romma vert lagra
+    # i ein dictionary på rom-id slik at devicane kan slåast opp direkte.
+    floorsByLevel = {}
+    roomsById = {}
+    for room_id, level, area, name in rooms:
+        floor = floorsByLevel.get(level)
+        if floor is None:
+            floor = floorsByLevel[level] = house.register_floor(level)
+        roomsById[room_id] = house.register_room(floor, area, name)
+    for row in devices:
+        room = roomsById.get(row[1])
+        device = _create_device(row)
+        if room and device:
+            house.register_device(room, device) # Registrerer devicen i rette rommet
+    return house
+
+
+def _apply_state(actuator: Actuator, state: Optional[float]):
+    # Lagra tilstand -> aktuator: NULL er av, 1.0 er på, andre verdiar er på med målverdi
+    if state is None:
+        actuator.turn_off()
+    elif float(state) == 1.0:
+        actuator.turn_on()
+    else:
+        actuator.turn_on(float(state))
+
+
+def _create_device(row: tuple) -> Optional[Device]:
+    """
+    Creates the device object for a row `(id, room, kind, category, supplier, product, state)`
+    of the devices table joined with the states table.
+    """
+    device_id, room_id, kind, category, supplier, product, state = row
+    if category == "sensor":
+        return Sensor(device_id, product, supplier, kind)
+    if category == "actuator":
+        device = Actuator(device_id, product, supplier, kind)
+        _apply_state(device, state)
+        return device
+    return None
+
+
+class LazyFloor(Floor):
+    """
+    A floor of a `LazySmartHouse`. Its rooms (with their devices) are loaded
+    from the database when the `rooms` attribute is accessed.
+    """
+
+    def __init__(self, level: int, house: "LazySmartHouse"):
+        self.house = house
+        self.loaded_rooms: List[Room] = []
+        self.hydrated = False
+        super().__init__(level)
+
+    @property
+    def rooms(self) -> List[Room]:
+        if not self.hydrated:
+            self.house.hydrate(self)
+        else:
+            self.house.touch(self)
+        return self.loaded_rooms
+
+    @rooms.setter
+    def rooms(self, rooms: List[Room]):
+        self.loaded_rooms = rooms
+
+
+class LazySmartHouse(SmartHouse):
+    """
+    A _SmartHouse_ that is loaded on demand from a `SmartHouseRepository`
+    (see `SmartHouseRepository.load_smarthouse_lazy`). Floor levels, the number
+    of rooms and devices and the total area are read when the house is created;
+    rooms and devices are loaded floor by floor and kept in an LRU cache.
+    Methods that need the whole house (`get_rooms`, `get_devices`) load every floor.
+    """
+
+    def __init__(self, repo: SmartHouseRepository, cache_size: int = 64) -> None:
+        super().__init__()
+        self.repo = repo
+        self.cache_size = max(cache_size, 1)
+        self.resident: OrderedDict[int, LazyFloor] = OrderedDict()
+        self.lock = threading.RLock()
+        self.hydrations = 0
+        self.evictions = 0
+
+        # Strukturen vert lesen via lese-tilkoplingane, så ein open skrivetransaksjon ikkje er synleg
+        cursor = repo.read_cursor()
+        try:
+            cursor.execute("SELECT floor, COUNT(*), SUM(area) FROM rooms GROUP BY floor ORDER BY floor;")
+            floor_rows = cursor.fetchall()
+            cursor.execute("SELECT COUNT(*) FROM devices d JOIN rooms r ON r.id = d.room WHERE d.category IN ('sensor', 'actuator');")
+            self.no_of_devices = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+        self.no_of_rooms = sum(row[1] for row in floor_rows)
+        self.house_area = sum(row[2] for row in floor_rows)
+        for level, _, _ in floor_rows:
+            floor = LazyFloor(level, self)
+            self.floors.append(floor)
+            self.floors_by_level[level] = floor
+
+    def touch(self, floor: LazyFloor):
+        with self.lock:
+            if floor.level in self.resident:
+                self.resident.move_to_end(floor.level)
+
+    def hydrate(self, floor: LazyFloor):
+        """
+        Loads the rooms and devices of the given floor and evicts the least recently used floors if the cache is full.
+        """
+        with self.lock:
+            if floor.hydrated:
+                self.touch(floor)
+                return
+            cursor = self.repo.read_cursor()
+            try:
+                cursor.execute("SELECT id, area, name FROM rooms WHERE floor = ? ORDER BY rowid;", (floor.level,))
+                room_rows = cursor.fetchall()
+                cursor.execute("""
+                    SELECT d.id, d.room, d.kind, d.category, d.supplier, d.product, s.state
+                    FROM devices d
+                    JOIN rooms r ON r.id = d.room
+                    LEFT JOIN states s ON s.device = d.id
+                    WHERE r.floor = ?
+                    ORDER BY d.rowid;
+                """, (floor.level,))
+                device_rows = cursor.fetchall()
+            finally:
+                cursor.close()
+
+            floor.hydrated = True
+            # Å laste ein etasje endrar ikkje strukturen til huset
+            version = self.version
+            roomsById = {}
+            for room_id, area, name in room_rows:
+                roomsById[room_id] = self.register_room(floor, area, name)
+            for row in device_rows:
+                device = _create_device(row)
+                if device:
+                    self.register_device(roomsById[row[1]], device)
+            self.version = version
+
+            self.resident[floor.level] = floor
+            self.hydrations += 1
+            while len(self.resident) > self.cache_size:
+                self.evict(self.resident.popitem(last=False)[1])
+
+    def evict(self, floor: LazyFloor):
+        """
+        Drops the rooms and devices of the given floor from memory.
+        """
+        with self.lock:
+            self.resident.pop(floor.level, None)
+            evicted = set(floor.loaded_rooms)
+            for room in floor.loaded_rooms:
+                self.total_area -= room.room_size
+                if self.rooms_by_key.get((floor.level, room.room_name)) is room:
+                    del self.rooms_by_key[(floor.level, room.room_name)]
+                for device in room.devices:
+                    self.devices_by_id.pop(device.id, None)
+            self.rooms = [room for room in self.rooms if room not in evicted]
+            self.device_list = None
+            floor.loaded_rooms = []
+            floor.hydrated = False
+            self.evictions += 1
+
+    def get_rooms(self) -> List[Room]:
+        result = []
+        for floor in self.floors:
+            result.extend(floor.rooms)
+        return result
+
+    def get_room(self, level: int, room_name: Optional[str]) -> Optional[Room]:
+        floor = self.get_floor(level)
+        if floor is None:
+            return None
+        floor.rooms  # laster etasjen om han ikkje er i minnet
+        return super().get_room(level, room_name)
+
+    def get_area(self) -> float:
+        return self.house_area
+
+    def get_devices(self) -> List[Device]:
+        result = []
+        for room in self.get_rooms():
+            result.extend(room.devices)
+        return result
+
+    def get_device_by_id(self, device_id: str) -> Optional[Device]:
+        with self.lock:
+            device = self.devices_by_id.get(device_id)
+            if device:
+                self.touch(device.room.floor)
+                return device
+
+            cursor = self.repo.read_cursor()
+            try:
+                cursor.execute("SELECT r.floor FROM devices d JOIN rooms r ON r.id = d.room WHERE d.id = ?;", (device_id,))
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+            if row is None or row[0] not in self.floors_by_level:
+                return None
+            self.hydrate(self.floors_by_level[row[0]])
+            return self.devices_by_id.get(device_id)
+
+    def count_rooms(self) -> int:
+        return self.no_of_rooms
+
+    def count_devices(self) -> int:
+        return self.no_of_devices
+
+    def cache_info(self) -> dict:
+        """
+        Returns the number of resident floors and devices and the hydration/eviction counters.
+        """
+        with self.lock:
+            return {
+                "resident_floors": len(self.resident),
+                "cache_size": self.cache_size,
+                "resident_devices": len(self.devices_by_id),
+                "hydrations": self.hydrations,
+                "evictions": self.evictions,
+            }
+
+
+class MeasurementBuffer:
+    """
+    Bounded in-memory queue of measurements that a background thread writes to
+    the database with group commits (see `SmartHouseRepository.enable_write_behind`).
+    """
+
+    def __init__(self, repo: SmartHouseRepository, max_batch: int = 500, max_latency: float = 0.05,
+                 capacity: int = 10000, put_timeout: float = 5.0) -> None:
+        self.repo = repo
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.capacity = capacity
+        self.put_timeout = put_timeout
+        self.queue: deque = deque()
+        self.cond = threading.Condition()
+        self.oldest = 0.0       # when the oldest queued reading was added (time.monotonic)
+        self.in_flight = 0      # readings taken from the queue but not committed yet
+        self.flush_requested = False
+        self.closed = False
+        # Tellarar
+        self.flushed_rows = 0
+        self.failed_rows = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.thread = threading.Thread(target=self._run, name="measurement-flusher", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, reading: Tuple[str, Union[datetime, str], float, str]) -> bool:
+        """
+        Queues a reading `(sensor_ID, timestamp, value, unit)`. Blocks while the buffer
+        is full (backpressure) and returns False if there was no room within `put_timeout`
+        seconds or the buffer is closed.
+        """
+        with self.cond:
+            deadline = time.monotonic() + self.put_timeout
+            while len(self.queue) >= self.capacity and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.cond.wait(remaining):
+                    self.rejected += 1
+                    return False
+            if self.closed:
+                self.rejected += 1
+                return False
+            if not self.queue:
+                self.oldest = time.monotonic()
+            self.queue.append(reading)
+            # Vekkjer flush-tråden når latens-klokka startar og når ein full gruppe er klar
+            if len(self.queue) == 1 or len(self.queue) >= self.max_batch:
+                self.cond.notify_all()
+            return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Blocks until every reading queued so far has been committed.
+        Returns False if that did not happen within `timeout` seconds.
+        """
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.queue and self.in_flight == 0, timeout)
+
+    def close(self) -> None:
+        """
+        Stops accepting readings, writes everything that is still queued and stops the flusher thread.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        atexit.unregister(self.close)
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the buffer: queue depth, flushed/failed/rejected rows and flush latencies in milliseconds.
+        """
+        with self.cond:
+            return {
+                "queue_depth": len(self.queue),
+                "capacity": self.capacity,
+                "in_flight": self.in_flight,
+                "flushed_rows": self.flushed_rows,
+                "failed_rows": self.failed_rows,
+                "rejected": self.rejected,
+                "flushes": self.flushes,
+                "last_flush_ms": self.last_flush_ms,
+                "max_flush_ms": self.max_flush_ms,
+                "avg_flush_ms": self.total_flush_ms / self.flushes if self.flushes else 0.0,
+            }
+
+    def _batch_ready(self) -> bool:
+        return (len(self.queue) >= self.max_batch or self.flush_requested or self.closed
+                or time.monotonic() - self.oldest >= self.max_latency)
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while not (self.queue and self._batch_ready()):
+                    if self.closed and not self.queue:
+                        self.cond.notify_all()
+                        return
+                    if not self.queue and self.flush_requested:
+                        self.flush_requested = False
+                        self.cond.notify_all()
+                    timeout = None
+                    if self.queue:
+                        timeout = max(self.oldest + self.max_latency - time.monotonic(), 0.0)
+                    self.cond.wait(timeout)
+                batch = [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))]
+                self.in_flight = len(batch)
+                if self.queue:
+                    self.oldest = time.monotonic()
+                # Gir plass til produsentar som ventar
+                self.cond.notify_all()
+
+            started = time.perf_counter()
+            written = self.repo.add_measurements(batch)
+            if not written:
+                # Gruppa vart rulla tilbake: radene vert skrivne éin og éin, så berre
+                # dei som sjølv feilar går tapt
+                written = sum(self.repo.add_measurements([reading]) for reading in batch)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            with self.cond:
+                self.in_flight = 0
+                self.flushes += 1
+                self.flushed_rows += written
+                self.failed_rows += len(batch) - written
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self.total_flush_ms += elapsed_ms
+                self.cond.notify_all()
+
+
+class StateCoalescer:
+    """
+    Collects actuator states and writes them in one transaction at most `window`
+    seconds after the first of them arrived. Repeated states for the same actuator
+    within the window collapse into the latest one
+    (see `SmartHouseRepository.enable_state_coalescing`).
+    """
+
+    def __init__(self, repo: SmartHouseRepository, window: float = 0.05) -> None:
+        self.repo = repo
+        self.window = window
+        self.pending: Dict[str, Optional[float]] = {}
+        self.cond = threading.Condition()
+        self.first = 0.0        # when the oldest pending state arrived (time.monotonic)
+        self.in_flight = False
+        self.flush_requested = False
+        self.closed = False
+        # Tellarar
+        self.received = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.flushes = 0
+        self.thread = threading.Thread(target=self._run, name="state-coalescer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, actuator_id: str, state: Optional[float]):
+        with self.cond:
+            if not self.pending:
+                self.first = time.monotonic()
+                self.cond.notify_all()
+            elif actuator_id in self.pending:
+                self.coalesced += 1
+            self.pending[actuator_id] = state
+            self.received += 1
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Writes the pending states now. Returns False if they were not written within `timeout` seconds.
+        """
+        with self.cond:
+            self.flush_requested = True
+            self.cond.notify_all()
+            return self.cond.wait_for(lambda: not self.pending and not self.in_flight, timeout)
+
+    def close(self) -> None:
+        """
+        Writes the pending states and stops the background thread.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        atexit.unregister(self.close)
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                "pending": len(self.pending),
+                "received": self.received,
+                "coalesced": self.coalesced,
+                "written": self.written,
+                "failed": self.failed,
+                "flushes": self.flushes,
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.flush_requested = False
+                    self.cond.notify_all()
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                    continue
+                remaining = self.first + self.window - time.monotonic()
+                if remaining > 0 and not (self.closed or self.flush_requested):
+                    self.cond.wait(remaining)
+                    continue
+                updates = [(state, actuator_id) for actuator_id, state in self.pending.items()]
+                self.pending = {}
+                self.in_flight = True
+
+            try:
+                written = self.repo.write_actuator_states(updates)
+            except Exception:
+                logger.exception("Writing %d actuator states failed", len(updates))
+                written = 0
+
+            with self.cond:
+                self.in_flight = False
+                self.flushes += 1
+                self.written += written
+                self.failed += len(updates) - written
+                self.cond.notify_all()
+
+
+class StateFollower:
+    """
+    Keeps the actuator states of an in-memory house up to date with changes made by
+    other processes (or connections) on the same database. Every `interval` seconds the
+    follower checks `PRAGMA data_version`, which only changes when another connection
+    committed, and then applies the new entries of the `state_log` table. Changes of
+    the in-memory state are passed to the listeners of the repository as `state` events;
+    changes this process made itself are already applied and are therefore not repeated.
+    For a `LazySmartHouse` only devices of loaded floors are updated (the others are read
+    from the database when their floor is loaded).
+    """
+
+    def __init__(self, repo: SmartHouseRepository, house: SmartHouse, interval: float = 0.1) -> None:
+        self.repo = repo
+        self.house = house
+        self.interval = interval
+        self.seq: Optional[int] = None
+        self.data_version: Optional[int] = None
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        # Tellarar
+        self.polls = 0
+        self.applied = 0
+        self.resyncs = 0
+
+    def poll(self) -> int:
+        """
+        Applies the state changes committed since the last poll. Returns the number of
+        actuators whose in-memory state changed.
+        """
+        self.polls += 1
+        cursor = self.repo.read_cursor()
+        try:
+            data_version = cursor.execute("PRAGMA data_version;").fetchone()[0]
+            if self.seq is not None and data_version == self.data_version:
+                return 0
+            self.data_version = data_version
+            if self.seq is not None:
+                rows = cursor.execute("SELECT seq, device, state FROM state_log WHERE seq > ? ORDER BY seq;",
+                                      (self.seq,)).fetchall()
+                # Ei luke i sekvensen betyr at loggen er kutta sidan siste gong: les alle tilstandane på nytt
+                if not rows or rows[0][0] == self.seq + 1:
+                    if rows:
+                        self.seq = rows[-1][0]
+                    return self._apply((device, state) for _, device, state in rows)
+            return self._resync(cursor)
+        finally:
+            cursor.close()
+
+    def _resync(self, cursor: sqlite3.Cursor) -> int:
+        self.resyncs += 1
+        cursor.execute("BEGIN;")
+        try:
+            self.seq = cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM state_log;").fetchone()[0]
+            rows = cursor.execute("SELECT device, state FROM states;").fetchall()
+        finally:
+            cursor.execute("COMMIT;")
+        return self._apply(rows)
+
+    def _apply(self, rows) -> int:
+        changed = 0
+        for device_id, state in rows:
+            device = self.house.devices_by_id.get(device_id)
+            if not isinstance(device, Actuator) or _state_value(device.state) == state:
+                continue
+            _apply_state(device, state)
+            changed += 1
+            self.repo._notify({"event": "state", "uuid": device_id, "state": state})
+        self.applied += changed
+        return changed
+
+    def start(self):
+        if self.thread is None:
+            self.poll()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="smarthouse-state-follower", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Following state changes failed")
 
+    def stats(self) -> dict:
+        return {"seq": self.seq or 0, "polls": self.polls, "applied": self.applied, "resyncs": self.resyncs}
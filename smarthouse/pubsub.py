@@ -0,0 +1,137 @@
+import asyncio
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+from smarthouse.domain import SmartHouse
+
+
+def parse_topic(topic: str) -> str:
+    """
+    Validates a subscription topic and returns it in normal form. Topics are
+    `device:<uuid>`, `room:<floor level>/<room name>` and `floor:<floor level>`.
+    Raises ValueError for anything else.
+    """
+    kind, sep, name = topic.partition(":")
+    if not sep or not name:
+        raise ValueError(f"Invalid topic: {topic}")
+    if kind == "device":
+        return topic
+    if kind == "floor":
+        return f"floor:{int(name)}"
+    if kind == "room":
+        level, sep, room_name = name.partition("/")
+        if not sep or not room_name:
+            raise ValueError(f"Invalid topic: {topic}")
+        return f"room:{int(level)}/{room_name}"
+    raise ValueError(f"Invalid topic: {topic}")
+
+
+class Subscription:
+    """
+    The events for one subscriber. Events are put into a bounded queue on the
+    subscriber's event loop; a subscriber whose queue is full is dropped, after
+    which `get` returns None.
+    """
+
+    def __init__(self, broker: "Broker", topics: Iterable[str], queue_size: int, loop: asyncio.AbstractEventLoop) -> None:
+        self.broker = broker
+        self.topics = frozenset(topics)
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.loop = loop
+        self.dropped = False
+
+    def offer(self, event: dict):
+        # Køyrer på event-loopen til abonnenten
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.drop()
+
+    def drop(self):
+        self.dropped = True
+        self.broker.unsubscribe(self)
+        self.broker.dropped += 1
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self) -> Optional[dict]:
+        """
+        Waits for the next event. Returns None if the subscriber was dropped for being too slow.
+        """
+        return await self.queue.get()
+
+
+class Broker:
+    """
+    In-process publish/subscribe of repository events (see
+    `SmartHouseRepository.add_listener`). An event about a device is delivered to
+    every subscriber of the device, its room or its floor. `publish` may be called
+    from any thread; `subscribe` has to be called on the event loop that consumes the events.
+    """
+
+    def __init__(self, house: SmartHouse, queue_size: int = 1024) -> None:
+        self.house = house
+        self.queue_size = queue_size
+        self.subscribers: Dict[str, Set[Subscription]] = {}
+        self.lock = threading.Lock()
+        # Tellarar
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def subscribe(self, topics: Iterable[str]) -> Subscription:
+        subscription = Subscription(self, topics, self.queue_size, asyncio.get_running_loop())
+        with self.lock:
+            for topic in subscription.topics:
+                self.subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            for topic in subscription.topics:
+                subscribers = self.subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[topic]
+
+    def topics_for(self, device_id: str) -> List[str]:
+        topics = [f"device:{device_id}"]
+        device = self.house.get_device_by_id(device_id)
+        if device is not None and device.room is not None:
+            level = device.room.floor.level
+            topics.append(f"room:{level}/{device.room.room_name}")
+            topics.append(f"floor:{level}")
+        return topics
+
+    def publish(self, event: dict):
+        """
+        Hands the event to the queues of all subscribers of the event's device, room and floor.
+        """
+        self.published += 1
+        if not self.subscribers:
+            return
+        topics = self.topics_for(event["uuid"])
+        receivers = set()
+        with self.lock:
+            for topic in topics:
+                receivers.update(self.subscribers.get(topic, ()))
+        for subscription in receivers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, event)
+                self.delivered += 1
+            except RuntimeError:
+                # Event-loopen er stengd
+                self.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "subscribers": len(set().union(*self.subscribers.values())) if self.subscribers else 0,
+                "topics": len(self.subscribers),
+                "published": self.published,
+                "delivered": self.delivered,
+                "dropped_subscribers": self.dropped,
+            }
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+from smarthouse.persistence import SmartHouseRepository
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """
+    How long the raw readings of a device are kept: readings older than `max_age`
+    and all but the newest `max_count` readings are deleted (either limit may be None).
+    Readings whose timestamp cannot be parsed count as the oldest and expire under both limits.
+    A policy applies to one device (`device`), to all devices of a kind (`kind`,
+    e.g. 'Temperature Sensor'), or, with neither, to all devices.
+    """
+
+    def __init__(self, max_age: Optional[timedelta] = None, max_count: Optional[int] = None,
+                 device: Optional[str] = None, kind: Optional[str] = None) -> None:
+        self.max_age = max_age
+        self.max_count = max_count
+        self.device = device
+        self.kind = kind
+
+
+class RetentionEngine:
+    """
+    Applies retention policies to the raw measurements. Deletion happens in batches
+    of `batch_size` readings, each in its own short transaction, so writers never wait
+    long for the database. The rollups are kept, i.e. statistics remain available after
+    the raw readings have expired. With `compact_after`, readings older than that are
+    then moved into the compressed cold tier (see `SmartHouseRepository.compact_readings`).
+    Afterwards up to `vacuum_pages` free pages are returned to the file system. `start`
+    runs the engine every `interval` seconds on a background thread; runs started from
+    other threads (e.g. on request) wait for a run in progress instead of racing it.
+    """
+
+    def __init__(self, repo: SmartHouseRepository, policies: List[RetentionPolicy], batch_size: int = 1000,
+                 interval: float = 3600, vacuum_pages: int = 1000, compact_after: Optional[timedelta] = None) -> None:
+        self.repo = repo
+        self.policies = policies
+        self.batch_size = batch_size
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self.compact_after = compact_after
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        # Éi køyring om gongen, og tellarane vert oppdaterte og lesne under stats_lock
+        self.lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        # Tellarar
+        self.runs = 0
+        self.deleted_rows = 0
+        self.compacted_rows = 0
+        self.vacuumed_pages = 0
+        self.last_run_ms = 0.0
+
+    def policy_for(self, device_id: str, kind: Optional[str]) -> Optional[RetentionPolicy]:
+        """
+        Returns the most specific policy for the device: by id before by kind before the default.
+        """
+        by_kind = default = None
+        for policy in self.policies:
+            if policy.device is not None:
+                if policy.device == device_id:
+                    return policy
+            elif policy.kind is not None:
+                if policy.kind == kind and by_kind is None:
+                    by_kind = policy
+            elif default is None:
+                default = policy
+        return by_kind or default
+
+    def run_once(self, now: Optional[datetime] = None) -> int:
+        """
+        Applies the policies to all devices once. Returns the number of deleted readings.
+        """
+        with self.lock:
+            return self._run_once(now)
+
+    def _run_once(self, now: Optional[datetime]) -> int:
+        started = time.perf_counter()
+        now = now or datetime.now()
+        cursor = self.repo.read_cursor()
+        try:
+            cursor.execute("SELECT id, kind FROM devices;")
+            devices = cursor.fetchall()
+        finally:
+            cursor.close()
+
+        deleted = 0
+        for device_id, kind in devices:
+            policy = self.policy_for(device_id, kind)
+            if policy is None:
+                continue
+            if policy.max_age is not None:
+                cutoff = (now - policy.max_age).strftime("%Y-%m-%d %H:%M:%S")
+                deleted += self._delete(device_id, cutoff)
+                deleted += self.repo.delete_cold_readings(device_id, before_ts=cutoff)
+            if policy.max_count is not None:
+                position = self.repo.reading_position(device_id, policy.max_count)
+                if position is not None:
+                    deleted += self._delete(device_id, *position)
+                deleted += self.repo.delete_cold_readings(device_id, keep=policy.max_count)
+            if self.stopping.is_set():
+                break
+
+        compacted = 0
+        if self.compact_after is not None and not self.stopping.is_set():
+            compacted = self.repo.compact_readings(now - self.compact_after)
+
+        vacuumed = self.repo.incremental_vacuum(self.vacuum_pages) if deleted or compacted else 0
+        with self.stats_lock:
+            self.runs += 1
+            self.deleted_rows += deleted
+            self.compacted_rows += compacted
+            self.vacuumed_pages += vacuumed
+            self.last_run_ms = (time.perf_counter() - started) * 1000
+        return deleted
+
+    def _delete(self, device_id: str, before_ts: str, before_rowid: Optional[int] = None) -> int:
+        deleted = 0
+        while not self.stopping.is_set():
+            batch = self.repo.delete_readings_batch(device_id, before_ts, before_rowid, self.batch_size)
+            deleted += batch
+            if batch < self.batch_size:
+                break
+            # Gjev andre skrivarar sjansen til å ta skrivelåsen mellom batchane
+            time.sleep(0)
+        return deleted
+
+    def start(self):
+        """
+        Runs the engine every `interval` seconds on a background thread until `stop` is called.
+        """
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="retention", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Retention run failed")
+            self.stopping.wait(self.interval)
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                "policies": len(self.policies),
+                "running": self.thread is not None,
+                "runs": self.runs,
+                "deleted_rows": self.deleted_rows,
+                "compacted_rows": self.compacted_rows,
+                "vacuumed_pages": self.vacuumed_pages,
+                "last_run_ms": self.last_run_ms,
+            }
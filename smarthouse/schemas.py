@@ -0,0 +1,58 @@
+"""
+Response schemas of the REST API in `smarthouse.api`.
+
+The schemas are plain `TypedDict`s: the endpoints build ordinary dicts and lists,
+and the schemas only describe them (in the OpenAPI documentation and for type checkers).
+Endpoints on hot paths return an `ORJSONResponse` directly, which skips FastAPI's
+validation of the response against these schemas.
+"""
+from typing import List, Optional
+from typing_extensions import TypedDict
+
+# Nøklane inneheld mellomrom, difor den funksjonelle skrivemåten
+
+HouseInfo = TypedDict("HouseInfo", {
+    "no_rooms": int,
+    "no_floors": int,
+    "registered_devices": int,
+    "area": float,
+})
+
+FloorInfo = TypedDict("FloorInfo", {
+    "floor level": int,
+})
+
+RoomInfo = TypedDict("RoomInfo", {
+    "Floor Level": int,
+    "room name": Optional[str],
+    "room size": float,
+})
+
+DeviceInfo = TypedDict("DeviceInfo", {
+    "Device id": str,
+    "Model Name": str,
+    "Supplier": str,
+    "Device In Room": Optional[str],
+})
+
+CurrentReading = TypedDict("CurrentReading", {
+    "Verdi": float,
+    "Unit": Optional[str],
+    "Tid": str,
+})
+
+SensorReading = TypedDict("SensorReading", {
+    "SensorNavn": str,
+    "Verdi": float,
+    "Unit": Optional[str],
+    "Tid": str,
+})
+
+
+class ReadingColumns(TypedDict):
+    """
+    The readings of a sensor column by column (see `MeasurementSeries.to_columns`).
+    """
+    timestamps: List[int]
+    values: List[float]
+    units: List[Optional[str]]
@@ -0,0 +1,45 @@
+"""
+Runs the REST API (`smarthouse.api`) in one or more worker processes:
+
+    python -m smarthouse.serve --workers 4 --port 8000
+
+With more than one worker the structure of the house is read from the database
+once, here, and written to a snapshot file next to the database. Every worker
+builds its house from the snapshot (`SmartHouseRepository.load_smarthouse_snapshot`)
+instead of querying the database, and follows the actuator state changes of the
+other workers through the `state_log` table (`StateFollower`). The cache of latest
+readings is switched off by default in this mode, since a worker would not see
+readings stored by the others.
+"""
+import argparse
+import os
+import uvicorn
+from pathlib import Path
+from smarthouse.persistence import SmartHouseRepository
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        db_file = os.environ.get("SMARTHOUSE_DB") or str(Path(__file__).parent.parent / "data" / "db.sql")
+        snapshot = db_file + ".snapshot"
+        # Opninga køyrer migreringane éin gong før arbeidarane startar
+        repo = SmartHouseRepository(db_file)
+        try:
+            repo.export_snapshot(snapshot)
+        finally:
+            repo.close()
+        os.environ["SMARTHOUSE_SNAPSHOT"] = snapshot
+        os.environ["SMARTHOUSE_FOLLOW_STATES"] = "1"
+        os.environ.setdefault("SMARTHOUSE_LATEST_CACHE_SIZE", "0")
+
+    uvicorn.run("smarthouse.api:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
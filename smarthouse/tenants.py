@@ -0,0 +1,263 @@
+"""
+Serving many houses from one process: every house (tenant) has its own SQLite
+database, a shard `<directory>/<house_id>.sql` with the schema of `data/db.sql`.
+Shards are provisioned outside of this module (e.g. by copying a template
+database); `TenantRegistry` only opens, caches and closes them.
+
+Houses can be spread over several processes: with `shards=N`, process `shard=i`
+serves exactly the houses for which `shard_for(house_id, N) == i`. A proxy in
+front of the processes uses the same function to route requests.
+
+The API serves the houses under `/houses/{house_id}/smarthouse` with the same
+endpoints as the house of the process (see `smarthouse.api.house_context`). The
+process-wide services are not per house: real-time events (`/smarthouse/events`,
+`/smarthouse/subscribe`) and the retention engine only cover the house of the
+process, so the shards are to be expired by a separate job. Repository metrics
+include the houses if the API instruments their repositories in `on_open`.
+"""
+import logging
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Union
+from smarthouse.persistence import SmartHouseRepository
+
+logger = logging.getLogger(__name__)
+
+HOUSE_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def shard_for(house_id: str, shards: int) -> int:
+    """
+    Returns the shard (process) in `range(shards)` responsible for the house.
+    The hash is stable across processes and restarts.
+    """
+    return zlib.crc32(house_id.encode()) % shards
+
+
+class WrongShard(Exception):
+    """
+    Raised for a house that is served by another shard (`owner`).
+    """
+
+    def __init__(self, house_id: str, owner: int) -> None:
+        super().__init__(f"House {house_id} is served by shard {owner}")
+        self.house_id = house_id
+        self.owner = owner
+
+
+class Tenant:
+    """
+    An open house: its repository, its (lazily loaded) object graph and the
+    cached responses of the API for it.
+    """
+
+    __slots__ = ("house_id", "repo", "house", "structure_cache", "users", "last_used", "evicted")
+
+    def __init__(self, house_id: str, repo: SmartHouseRepository, house) -> None:
+        self.house_id = house_id
+        self.repo = repo
+        self.house = house
+        self.structure_cache: Dict[tuple, tuple] = {}
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.evicted = False
+
+
+class TenantRegistry:
+    """
+    Opens the shards of the houses on first use and keeps at most `capacity` of them open,
+    closing the least recently used one beyond that. Houses that have not been used for
+    `idle_timeout` seconds are closed as well (by `evict_idle`, which `start` runs every
+    `sweep_interval` seconds on a background thread), so their object graphs do not stay
+    in memory. A house is used through `lease`; a house that is evicted while leased is
+    closed when the last lease ends.
+
+    `repo_options` are passed on to `SmartHouseRepository`; the defaults keep the page
+    cache of each connection small and give every house a pool of at most two reader
+    connections (`max_readers`), since many shards are open at the same time and
+    thread-local readers would add one connection per thread and house. `on_open` is
+    called with the repository of every house that is opened, before it is used.
+    """
+
+    def __init__(self, directory: Union[str, Path], capacity: int = 64, idle_timeout: float = 600,
+                 sweep_interval: float = 60, lazy: bool = True, floor_cache_size: int = 8,
+                 shard: int = 0, shards: int = 1,
+                 on_open: Optional[Callable[[SmartHouseRepository], None]] = None, **repo_options) -> None:
+        self.directory = Path(directory)
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.lazy = lazy
+        self.floor_cache_size = floor_cache_size
+        self.shard = shard
+        self.shards = shards
+        self.on_open = on_open
+        self.repo_options = {"cache_size_kib": 2048, "max_readers": 2, **repo_options}
+        self.lock = threading.Lock()
+        self.tenants: "OrderedDict[str, Tenant]" = OrderedDict()
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        # Tellarar
+        self.opened = 0
+        self.evicted = 0
+        self.hits = 0
+
+    def path_for(self, house_id: str) -> Path:
+        """
+        Returns the shard file of the house. Raises ValueError for an invalid id,
+        `WrongShard` for a house of another shard and KeyError for an unknown house.
+        """
+        if not HOUSE_ID_PATTERN.match(house_id):
+            raise ValueError(f"Invalid house id: {house_id!r}")
+        if self.shards > 1:
+            owner = shard_for(house_id, self.shards)
+            if owner != self.shard:
+                raise WrongShard(house_id, owner)
+        path = self.directory / f"{house_id}.sql"
+        if not path.is_file():
+            raise KeyError(house_id)
+        return path
+
+    @contextmanager
+    def lease(self, house_id: str) -> Iterator[Tenant]:
+        """
+        Provides the open house for the duration of the `with` block, opening it if necessary.
+        """
+        tenant = self.acquire(house_id)
+        try:
+            yield tenant
+        finally:
+            self.release(tenant)
+
+    def acquire(self, house_id: str) -> Tenant:
+        with self.lock:
+            tenant = self.tenants.get(house_id)
+            if tenant is not None:
+                self.tenants.move_to_end(house_id)
+                tenant.users += 1
+                tenant.last_used = time.monotonic()
+                self.hits += 1
+                return tenant
+
+        # Opninga (med migreringar) skjer utanfor låsen, så andre hus ikkje ventar
+        opened = self._open(house_id)
+        evicted = []
+        with self.lock:
+            tenant = self.tenants.get(house_id)
+            if tenant is None:
+                tenant = self.tenants[house_id] = opened
+                self.opened += 1
+                while len(self.tenants) > self.capacity:
+                    evicted.append(self.tenants.popitem(last=False)[1])
+            else:
+                # Ein annan tråd opna huset samstundes, vår kopi vert ikkje brukt
+                self.tenants.move_to_end(house_id)
+            tenant.users += 1
+            tenant.last_used = time.monotonic()
+        if tenant is not opened:
+            opened.repo.close()
+        for old in evicted:
+            self._retire(old)
+        return tenant
+
+    def retain(self, tenant: Tenant):
+        """
+        Takes another lease on a house that is already leased; it ends with `release`.
+        """
+        with self.lock:
+            tenant.users += 1
+            tenant.last_used = time.monotonic()
+
+    def release(self, tenant: Tenant):
+        with self.lock:
+            tenant.users -= 1
+            tenant.last_used = time.monotonic()
+            close = tenant.evicted and tenant.users == 0
+        if close:
+            tenant.repo.close()
+
+    def _open(self, house_id: str) -> Tenant:
+        repo = SmartHouseRepository(str(self.path_for(house_id)), **self.repo_options)
+        try:
+            if self.on_open is not None:
+                self.on_open(repo)
+            house = repo.load_smarthouse_lazy(self.floor_cache_size) if self.lazy else repo.load_smarthouse_deep()
+        except Exception:
+            repo.close()
+            raise
+        return Tenant(house_id, repo, house)
+
+    def _retire(self, tenant: Tenant):
+        # Eit hus som er i bruk vert stengt når det siste lånet er over (sjå release)
+        with self.lock:
+            tenant.evicted = True
+            self.evicted += 1
+            close = tenant.users == 0
+        if close:
+            tenant.repo.close()
+
+    def evict(self, house_id: str) -> bool:
+        """
+        Closes the house if it is open. Returns whether it was.
+        """
+        with self.lock:
+            tenant = self.tenants.pop(house_id, None)
+        if tenant is None:
+            return False
+        self._retire(tenant)
+        return True
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """
+        Closes all houses that have not been used for `idle_timeout` seconds. Returns their number.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            idle = [house_id for house_id, tenant in self.tenants.items()
+                    if tenant.users == 0 and now - tenant.last_used >= self.idle_timeout]
+        return sum(self.evict(house_id) for house_id in idle)
+
+    def close(self):
+        self.stop()
+        with self.lock:
+            house_ids = list(self.tenants)
+        for house_id in house_ids:
+            self.evict(house_id)
+
+    def start(self):
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="smarthouse-tenants", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopping.wait(self.sweep_interval):
+            try:
+                self.evict_idle()
+            except Exception:
+                logger.exception("Evicting idle houses failed")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "open": len(self.tenants),
+                "leased": sum(1 for tenant in self.tenants.values() if tenant.users),
+                "capacity": self.capacity,
+                "opened": self.opened,
+                "evicted": self.evicted,
+                "hits": self.hits,
+                "shard": self.shard,
+                "shards": self.shards,
+            }
+
@@ -1,5 +1,7 @@
 from unittest import TestCase, main
-from smarthouse.domain import SmartHouse
+from smarthouse.analytics import HOUR_MS, DAY_MS, correlation, degree_days, exceedance_by_hour, percentiles, rolling_mean, scope_report
+from smarthouse.compression import decode_chunk, encode_chunk
+from smarthouse.domain import Actuator, MeasurementSeries, SmartHouse, epoch_ms_to_timestamp, parse_timestamp, timestamp_to_epoch_ms
 from demo_house import DEMO_HOUSE as h
 
 class TestPartA(TestCase):
@@ -94,6 +96,127 @@ class TestPartA(TestCase):
         self.assertEqual(len(dresser.devices), 1)
         self.assertEqual(len(gr2.devices), 0)
 
+    def test_zadvanced_indexed_lookups(self):
+        # floors are ordered by level, even when registered out of order
+        house = SmartHouse()
+        first = house.register_floor(2)
+        ground = house.register_floor(1)
+        self.assertEqual([ground, first], house.get_floors())
+        self.assertIs(first, house.get_floor(2))
+        self.assertIsNone(house.get_floor(3))
+        kitchen = house.register_room(ground, 20.5, "Kitchen")
+        office = house.register_room(first, 10, "Office")
+        self.assertIs(kitchen, house.get_room(1, "Kitchen"))
+        self.assertIsNone(house.get_room(2, "Kitchen"))
+        self.assertEqual(30.5, house.get_area())
+        # the device index follows registrations and moves
+        lamp = h.get_device_by_id("6b1c5f6b-37f6-4e3d-9145-1cfbe2f1fc28")
+        self.assertIsNotNone(h.get_room(lamp.room.floor.level, lamp.room.room_name))
+        plug = Actuator("0b6f0d9a-6c0c-4a2b-9d55-1b8a1f6d7d11", "Plug", "Supplier", "Smart Plug")
+        house.register_device(kitchen, plug)
+        house.register_device(office, plug)
+        self.assertEqual([plug], house.get_devices())
+        self.assertIs(plug, house.get_device_by_id(plug.id))
+        self.assertEqual(office, plug.room)
+        # the devices are listed room by room, and the list belongs to the caller
+        oven = Actuator("f1f7e1a4-0a5e-4c5d-9a4b-3a3c2b1d0e9f", "Oven", "Supplier", "Smart Oven")
+        house.register_device(kitchen, oven)
+        devices = house.get_devices()
+        self.assertEqual([oven, plug], devices)
+        devices.clear()
+        self.assertEqual([oven, plug], house.get_devices())
+
+    def test_zadvanced_structure_version(self):
+        house = SmartHouse()
+        versions = [house.version]
+        floor = house.register_floor(1)
+        versions.append(house.version)
+        hall = house.register_room(floor, 6.5, "Hall")
+        versions.append(house.version)
+        plug = Actuator("0b6f0d9a-6c0c-4a2b-9d55-1b8a1f6d7d11", "Plug", "Supplier", "Smart Plug")
+        house.register_device(hall, plug)
+        versions.append(house.version)
+        # queries and state changes leave the version as it is
+        house.get_devices()
+        plug.turn_on()
+        self.assertEqual(versions[-1], house.version)
+        # moving a device is a change of structure
+        house.register_device(house.register_room(floor, 10, "Office"), plug)
+        versions.append(house.version)
+        self.assertEqual(sorted(set(versions)), versions)
+
+    def test_zadvanced_compact_objects(self):
+        temp = h.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        self.assertFalse(hasattr(temp, "__dict__"))
+        self.assertFalse(hasattr(temp.room, "__dict__"))
+        self.assertFalse(hasattr(temp.last_measurement(), "__dict__"))
+        series = MeasurementSeries()
+        series.append(timestamp_to_epoch_ms("2024-01-28 23:00:00"), 13.7, "kWh")
+        series.append(timestamp_to_epoch_ms("2024-01-29 00:00:00"), 14.2, "kWh")
+        self.assertEqual(2, len(series))
+        self.assertEqual("2024-01-28 23:00:00", series[0].timestamp)
+        self.assertEqual([13.7, 14.2], [m.value for m in series])
+        self.assertEqual(3600000, series.timestamps[1] - series.timestamps[0])
+        self.assertEqual({"timestamps": [1706482800000, 1706486400000], "values": [13.7, 14.2], "units": ["kWh", "kWh"]},
+                         series.to_columns())
+
+    def test_zadvanced_parse_timestamp(self):
+        self.assertEqual(1706482800000, parse_timestamp("2024-01-28 23:00:00"))
+        self.assertEqual(timestamp_to_epoch_ms("1969-12-31 23:59:59"), parse_timestamp("1969-12-31 23:59:59"))
+        # the milliseconds survive the round trip, and whole seconds keep the format of the database
+        for timestamp in ("2024-01-28 23:00:00", "2024-01-28 23:00:00.250", "1969-12-31 23:59:59.999"):
+            self.assertEqual(timestamp, epoch_ms_to_timestamp(timestamp_to_epoch_ms(timestamp)))
+        for invalid in ("2024-01-28T23:00:00", "2024-01-28 23:00", "2024-02-30 12:00:00", "28.01.2024 23:00:00"):
+            with self.assertRaises(ValueError):
+                parse_timestamp(invalid)
+
+    def test_zadvanced_compression(self):
+        timestamps = [1706482800000 + i * 60000 for i in range(500)]
+        values = [20.0 + (i % 7) * 0.25 for i in range(500)]
+        data = encode_chunk(timestamps, values)
+        # readings at a fixed interval take a couple of bytes each
+        self.assertLess(len(data), 2 * len(timestamps))
+        self.assertEqual((timestamps, values), tuple(a.tolist() for a in decode_chunk(data)))
+        # irregular gaps, duplicate timestamps and special values survive the round trip
+        timestamps = [-5000, 0, 0, 1, 1000, 2 ** 40, 2 ** 40 + 7, 2 ** 62]
+        values = [0.0, -0.0, float("inf"), 1e-300, 12.5, 12.5, -3.75, float("nan")]
+        decoded_ts, decoded_values = decode_chunk(encode_chunk(timestamps, values))
+        self.assertEqual(timestamps, decoded_ts.tolist())
+        self.assertEqual([repr(v) for v in values], [repr(v) for v in decoded_values])
+        self.assertEqual(([], []), tuple(a.tolist() for a in decode_chunk(encode_chunk([], []))))
+        for truncated in (b"", data[:3], data[:len(data) // 2]):
+            with self.assertRaises(ValueError):
+                decode_chunk(truncated)
+
+    def test_zadvanced_analytics(self):
+        timestamps = [i * HOUR_MS // 2 for i in range(8)]
+        values = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0]
+        # the one hour window holds the reading itself and the one half an hour before
+        self.assertEqual([1.0, 1.5, 2.5, 3.5, 4.5, 5.5, 6.5, 7.5], rolling_mean(timestamps, values, HOUR_MS).tolist())
+        self.assertEqual([1.0, 4.5, 8.0, 1.35], percentiles(values, [0, 50, 100, 5]).tolist())
+        hours, counts = exceedance_by_hour(timestamps, values, 2.5)
+        self.assertEqual([0, HOUR_MS, 2 * HOUR_MS, 3 * HOUR_MS], hours.tolist())
+        self.assertEqual([0, 2, 2, 2], counts.tolist())
+        days, heating = degree_days([0, HOUR_MS, DAY_MS], [10.0, 14.0, 20.0], base=17.0)
+        self.assertEqual(([0, DAY_MS], [5.0, 0.0]), (days.tolist(), heating.tolist()))
+        self.assertAlmostEqual(1.0, correlation((timestamps, values), (timestamps, [2 * v for v in values])))
+        self.assertAlmostEqual(-1.0, correlation((timestamps, values), (timestamps, [-v for v in values])))
+        self.assertIsNone(correlation((timestamps, values), (timestamps, [1.0] * 8)))
+
+    def test_zadvanced_scope_report_by_unit(self):
+        mixed = MeasurementSeries()
+        mixed.extend([(0, 10.0, "°C"), (HOUR_MS, 1000.0, "kWh"), (2 * HOUR_MS, 12.0, "°C"), (DAY_MS, 2000.0, "kWh")])
+        humidity = MeasurementSeries()
+        humidity.extend([(0, 40.0, "%")])
+        report = scope_report({"mixed": mixed, "humidity": humidity, "empty": MeasurementSeries()}, base=17.0)
+        # every device is reported per unit, and the statistics only cover readings in that unit
+        self.assertEqual([("mixed", "°C", 2, 11.0), ("mixed", "kWh", 2, 1500.0), ("humidity", "%", 1, 40.0)],
+                         [(e["device"], e["unit"], e["count"], e["mean"]) for e in report["devices"]])
+        # the degree-days only use the readings in °C
+        self.assertEqual([0], report["degree_days"]["days"])
+        self.assertEqual([6.0], report["degree_days"]["values"])
+        self.assertEqual(3, len(report["correlations"]["matrix"]))
+
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,26 @@
+import asyncio
+import importlib
+import itertools
+import orjson
+import os
+import threading
 import unittest
-from smarthouse.persistence import SmartHouseRepository
+import shutil
+import sqlite3
+import tempfile
+import time
+from smarthouse import persistence
+from smarthouse.aio import AsyncSmartHouseRepository
+from smarthouse.metrics import Metrics, instrument
+from smarthouse.persistence import SmartHouseRepository, StateFollower, EPOCH_MS_SQL, SCHEMA_MIGRATIONS
+from smarthouse.pubsub import Broker, parse_topic
+from smarthouse.retention import RetentionEngine, RetentionPolicy
+from smarthouse.tenants import TenantRegistry, WrongShard, shard_for
+from datetime import datetime, timedelta
+from fastapi import WebSocketDisconnect
+from fastapi.testclient import TestClient
 from pathlib import Path
+from unittest import mock
 
 class SmartHouseTest(unittest.TestCase):
     file = Path(__file__).parent / "../data/db.sql"
@@ -138,6 +158,1011 @@ class SmartHouseTest(unittest.TestCase):
 
 
 
+    def test_basic_devices_in_right_rooms(self):
+        h = self.repo.load_smarthouse_deep()
+        c = self.repo.cursor()
+        c.execute("SELECT d.id, r.floor, r.name FROM devices d JOIN rooms r ON r.id = d.room")
+        rows = c.fetchall()
+        c.close()
+        self.assertEqual(len(rows), len(h.get_devices()))
+        for device_id, floor, name in rows:
+            device = h.get_device_by_id(device_id)
+            self.assertEqual((floor, name), (device.room.floor.level, device.room.room_name))
+
+    def test_lazy_house(self):
+        h = self.repo.load_smarthouse_lazy(cache_size=1)
+        # nothing but the floors is loaded up front
+        self.assertEqual(0, h.cache_info()["resident_devices"])
+        self.assertEqual([1, 2], [f.level for f in h.get_floors()])
+        self.assertEqual(12, h.count_rooms())
+        self.assertEqual(14, h.count_devices())
+        self.assertEqual(156.55, h.get_area())
+        # looking up a device loads its floor
+        oven = h.get_device_by_id("8d4e4c98-21a9-4d1e-bf18-523285ad90f6")
+        self.assertEqual("Guest Room 1", oven.room.room_name)
+        self.assertEqual(1, h.cache_info()["resident_floors"])
+        # accessing the other floor evicts the first one
+        self.assertIsNotNone(h.get_room(2, "Office"))
+        self.assertEqual(1, h.cache_info()["resident_floors"])
+        self.assertEqual(1, h.cache_info()["evictions"])
+        self.assertEqual(7, len(h.get_floor(2).rooms))
+        self.assertIsNone(h.get_device_by_id("00000000-0000-0000-0000-000000000000"))
+        self.assertEqual(14, len(h.get_devices()))
+        self.assertEqual(12, len(h.get_rooms()))
+        # loading and evicting floors is not a change of the house's structure
+        self.assertEqual(0, h.version)
+
+    def test_readings_series(self):
+        h = self.repo.load_smarthouse_deep()
+        temp = h.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        readings = self.repo.get_all_readings(temp, 1000000)
+        series = self.repo.get_readings_series(temp)
+        self.assertEqual(len(readings), len(series))
+        self.assertEqual(readings[0].timestamp, series[-1].timestamp)
+        self.assertEqual(readings[0].value, series[-1].value)
+        self.assertEqual(list(series.timestamps), sorted(series.timestamps))
+        self.assertEqual(24 * len(series), series.nbytes())
+        day = self.repo.get_readings_series(temp, "2024-01-27 00:00:00", "2024-01-27 23:59:59")
+        self.assertTrue(0 < len(day) < len(series))
+        self.assertTrue(all(m.timestamp.startswith("2024-01-27") for m in day))
+
+    def test_downsampled_readings(self):
+        h = self.repo.load_smarthouse_deep()
+        temp = h.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        readings = self.repo.get_all_readings(temp, 1000000)
+        buckets = self.repo.get_downsampled_readings(temp, 5)
+        self.assertLessEqual(len(buckets), 5)
+        self.assertEqual(len(readings), sum(b["count"] for b in buckets))
+        self.assertEqual(min(r.value for r in readings), min(b["min"] for b in buckets))
+        self.assertEqual(max(r.value for r in readings), max(b["max"] for b in buckets))
+        self.assertEqual(readings[-1].timestamp, buckets[0]["timestamp"])
+        self.assertEqual(readings[0].value, buckets[-1]["last"])
+        points = self.repo.get_downsampled_readings(temp, 5, method="lttb")
+        self.assertEqual(5, len(points))
+        self.assertEqual((readings[-1].timestamp, readings[0].timestamp), (points[0]["timestamp"], points[-1]["timestamp"]))
+        # the points are raw readings in chronological order
+        raw = {(r.timestamp, r.value) for r in readings}
+        self.assertTrue(all((p["timestamp"], p["value"]) in raw for p in points))
+        self.assertEqual(sorted(p["timestamp"] for p in points), [p["timestamp"] for p in points])
+        self.assertEqual(len(readings), len(self.repo.get_downsampled_readings(temp, 100000, method="lttb")))
+        self.assertEqual([], self.repo.get_downsampled_readings(temp, 10, from_ts="2030-01-01"))
+        # readings in different units are not mixed in one bucket
+        mixed = h.get_device_by_id("a2f8690f-2b3a-43cd-90b8-9deea98b42a7")
+        humidity = [r.value for r in self.repo.get_all_readings(mixed, 1000000) if r.unit == "%"]
+        buckets = self.repo.get_downsampled_readings(mixed, 5, unit="%")
+        self.assertEqual(len(humidity), sum(b["count"] for b in buckets))
+        self.assertEqual((min(humidity), max(humidity)), (min(b["min"] for b in buckets), max(b["max"] for b in buckets)))
+        self.assertEqual(len(humidity), len(self.repo.get_downsampled_readings(mixed, 100, method="lttb", unit="%")))
+        latest = self.repo.get_latest_reading(mixed).unit
+        self.assertEqual(sum(1 for r in self.repo.get_all_readings(mixed, 1000000) if r.unit == latest),
+                         sum(b["count"] for b in self.repo.get_downsampled_readings(mixed, 5)))
+
+    def test_series_for_devices(self):
+        room = self.repo.load_smarthouse_deep().get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e").room
+        series = self.repo.get_series_for_devices(room.devices)
+        self.assertEqual({d.id for d in room.devices}, set(series))
+        for device in room.devices:
+            expected = self.repo.get_readings_series(device)
+            self.assertEqual(expected.timestamps, series[device.id].timestamps)
+            self.assertEqual(expected.values, series[device.id].values)
+        celsius = self.repo.get_series_for_devices(room.devices, unit="°C")
+        self.assertTrue(all(unit == "°C" for s in celsius.values() for unit in s.units))
+
+    def test_iter_readings_resume(self):
+        h = self.repo.load_smarthouse_deep()
+        humidity = h.get_device_by_id("3d87e5c0-8716-4b0b-9c67-087eaaed7b45")
+        everything = list(self.repo.iter_readings(humidity, batch_size=7))
+        self.assertEqual(len(self.repo.get_readings_series(humidity)), len(everything))
+        self.assertEqual(sorted(pos for pos, _ in everything), [pos for pos, _ in everything])
+        # resuming after any position continues with the next reading
+        resumed = list(self.repo.iter_readings(humidity, after=everything[9][0], batch_size=5))
+        self.assertEqual([pos for pos, _ in everything[10:]], [pos for pos, _ in resumed])
+        day = list(self.repo.iter_readings(humidity, "2024-01-27 00:00:00", "2024-01-27 23:59:59"))
+        self.assertTrue(day)
+        self.assertTrue(all(m.timestamp.startswith("2024-01-27") for _, m in day))
+
+    def test_schema_migrated(self):
+        self.assertEqual(len(SCHEMA_MIGRATIONS), self.repo.schema_version())
+        # running the migrations again is a no-op
+        self.assertEqual(len(SCHEMA_MIGRATIONS), self.repo.migrate())
+
+    def test_latest_reading_uses_index(self):
+        c = self.repo.cursor()
+        c.execute("EXPLAIN QUERY PLAN SELECT value, ts, unit FROM measurements WHERE device = ? ORDER BY ts_ms DESC, ts DESC LIMIT 1",
+                  ("a2f8690f-2b3a-43cd-90b8-9deea98b42a7",))
+        plan = " ".join(str(row[-1]) for row in c.fetchall())
+        c.close()
+        self.assertIn("COVERING INDEX measurements_device_ts_ms", plan)
+        self.assertNotIn("TEMP B-TREE", plan)
+
+
+class SmartHouseWriteTest(unittest.TestCase):
+    """
+    Tests that modify the database work on a temporary copy of it.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        file = Path(self.tmp.name) / "db.sql"
+        shutil.copy(Path(__file__).parent / "../data/db.sql", file)
+        self.repo = SmartHouseRepository(str(file))
+        self.house = self.repo.load_smarthouse_deep()
+
+    def tearDown(self):
+        self.repo.close()
+        self.tmp.cleanup()
+
+    def count_readings(self, device_id: str) -> int:
+        c = self.repo.cursor()
+        c.execute("SELECT COUNT(*) FROM measurements WHERE device = ?", (device_id,))
+        result = c.fetchone()[0]
+        c.close()
+        return result
+
+    def test_structure_reads_committed_data(self):
+        # a write transaction that is still open is not visible when floors are loaded
+        c = self.repo.cursor()
+        with self.repo.lock:
+            c.execute("INSERT INTO rooms (id, floor, area, name) VALUES (99, 2, 10.0, 'Attic');")
+            c.execute("INSERT INTO devices VALUES ('attic-sensor', 99, 'Temperature Sensor', 'sensor', 'ACME', 'T1');")
+            lazy = self.repo.load_smarthouse_lazy()
+            self.assertEqual(12, lazy.count_rooms())
+            self.assertIsNone(lazy.get_device_by_id("attic-sensor"))
+            self.assertEqual(7, len(lazy.get_floor(2).rooms))
+            self.assertIsNone(self.repo.load_smarthouse_deep().get_device_by_id("attic-sensor"))
+            self.repo.conn.commit()
+        c.close()
+        lazy = self.repo.load_smarthouse_lazy()
+        self.assertEqual("Attic", lazy.get_device_by_id("attic-sensor").room.room_name)
+        self.assertEqual(8, len(lazy.get_floor(2).rooms))
+
+    def test_temperature_averages_by_room(self):
+        bedroom = next(r for r in self.house.get_rooms() if r.room_name == "Master Bedroom")
+        everything = self.repo.calc_avg_temperatures_in_room(bedroom)
+        # a room with the same name on the other floor is not included
+        c = self.repo.cursor()
+        c.execute("INSERT INTO rooms (id, floor, area, name) VALUES (99, 1, 10.0, 'Master Bedroom');")
+        c.execute("INSERT INTO devices VALUES ('copy-sensor', 99, 'Temperature Sensor', 'sensor', 'ACME', 'T1');")
+        self.repo.conn.commit()
+        c.close()
+        self.repo.add_measurements([("copy-sensor", "2024-01-27 12:00:00", 50.0, "°C"),
+                                    ("copy-sensor", "2024-02-10 12:00:00", 50.0, "°C")])
+        self.assertEqual(everything, self.repo.calc_avg_temperatures_in_room(bedroom))
+        self.assertEqual(["2024-01-27"], list(self.repo.calc_avg_temperatures_in_room(bedroom, "2024-01-27", "2024-01-27")))
+
+    def test_remove_oldest_reading(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        before = self.count_readings(temp.id)
+        oldest = self.repo.get_all_readings(temp, before)[-1]
+        self.assertTrue(self.repo.removing_oldest_reading_from_database(temp))
+        self.assertEqual(before - 1, self.count_readings(temp.id))
+        self.assertNotEqual(oldest.timestamp, self.repo.get_all_readings(temp, before)[-1].timestamp)
+        motion = self.house.get_device_by_id("cd5be4e8-0e6b-4cb5-a21f-819d06cf5fc5")
+        self.assertFalse(self.repo.removing_oldest_reading_from_database(motion))
+
+    def test_add_measurements_batch(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        humidity_id = "3d87e5c0-8716-4b0b-9c67-087eaaed7b45"
+        temp_before = self.count_readings(temp_id)
+        humidity_before = self.count_readings(humidity_id)
+        readings = [(temp_id, f"2024-02-01 10:00:{i:02d}", 20.0 + i, "°C") for i in range(50)]
+        readings.append((humidity_id, "2024-02-01 10:00:00", 55.0, "%"))
+        self.assertEqual(51, self.repo.add_measurements(readings))
+        self.assertEqual(temp_before + 50, self.count_readings(temp_id))
+        self.assertEqual(humidity_before + 1, self.count_readings(humidity_id))
+        latest = self.repo.get_latest_reading(self.house.get_device_by_id(temp_id))
+        self.assertEqual("2024-02-01 10:00:49", latest.timestamp)
+        self.assertEqual(69.0, latest.value)
+        self.assertEqual(0, self.repo.add_measurements([]))
+
+    def test_integer_timestamps(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        self.repo.add_measurements([(temp_id, "2024-02-01 10:00:00", 20.0, "°C"),
+                                    (temp_id, datetime(2024, 2, 1, 10, 0, 1, 250000), 21.0, "°C")])
+        # rows from other writers get ts_ms from the trigger
+        self.repo.conn.execute("INSERT INTO measurements(device, value, ts, unit) VALUES (?, 22.0, '2024-02-01 10:00:02', '°C')",
+                               (temp_id,))
+        self.repo.conn.commit()
+        c = self.repo.cursor()
+        c.execute("SELECT ts_ms FROM measurements WHERE device = ? AND ts >= '2024-02-01 10' ORDER BY ts", (temp_id,))
+        self.assertEqual([1706781600000, 1706781601250, 1706781602000], [row[0] for row in c.fetchall()])
+        c.execute(f"SELECT COUNT(*) FROM measurements WHERE ts_ms IS NOT {EPOCH_MS_SQL}")
+        self.assertEqual(0, c.fetchone()[0])
+        c.close()
+        temp = self.house.get_device_by_id(temp_id)
+        self.assertEqual([20.0, 21.0, 22.0], self.repo.get_readings_series(temp, "2024-02-01 10:00:00", "2024-02-01 10:00:02").values.tolist())
+        self.assertEqual(22.0, self.repo.get_latest_reading(temp).value)
+
+    def test_write_behind(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        before = self.count_readings(temp_id)
+        buffer = self.repo.enable_write_behind(max_batch=10, max_latency=10.0, capacity=100)
+        for i in range(25):
+            self.assertTrue(self.repo.add_measurment(temp_id, f"2024-02-02 10:00:{i:02d}", 20.0, "°C"))
+        self.assertTrue(buffer.flush(5.0))
+        self.assertEqual(before + 25, self.count_readings(temp_id))
+        stats = buffer.stats()
+        self.assertEqual(0, stats["queue_depth"])
+        self.assertEqual(25, stats["flushed_rows"])
+        self.assertGreaterEqual(stats["flushes"], 3)
+        # a reading that cannot be stored does not take the rest of its group with it
+        for i in range(5):
+            self.assertTrue(buffer.put((temp_id, f"2024-02-02 10:01:{i:02d}", [20.0] if i == 2 else 20.0, "°C")))
+        self.assertTrue(buffer.flush(5.0))
+        self.assertEqual(before + 29, self.count_readings(temp_id))
+        self.assertEqual((29, 1), (buffer.stats()["flushed_rows"], buffer.stats()["failed_rows"]))
+        before += 4
+        # readings that are still queued are written when the buffer is closed
+        self.repo.add_measurment(temp_id, "2024-02-02 11:00:00", 20.0, "°C")
+        buffer.close()
+        self.repo.write_buffer = None
+        self.assertEqual(before + 26, self.count_readings(temp_id))
+        self.assertFalse(buffer.put((temp_id, "2024-02-02 12:00:00", 20.0, "°C")))
+
+    def test_rollups_follow_inserts(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        self.repo.add_measurment(temp.id, "2024-03-01 10:15:00", 20.0, "°C")
+        self.repo.add_measurements([(temp.id, "2024-03-01 10:45:00", 24.0, "°C"),
+                                    (temp.id, "2024-03-01 11:05:00", 19.0, "°C")])
+        hours = self.repo.get_device_rollups(temp, "hour", "2024-03-01", "2024-03-01")
+        self.assertEqual(["2024-03-01 10", "2024-03-01 11"], [r["bucket"] for r in hours])
+        self.assertEqual((2, 20.0, 24.0, 22.0), (hours[0]["count"], hours[0]["min"], hours[0]["max"], hours[0]["avg"]))
+        day = self.repo.get_room_rollups(temp.room, "day", "°C", "2024-03-01", "2024-03-01")
+        self.assertEqual(1, len(day))
+        self.assertEqual(3, day[0]["count"])
+        self.assertAlmostEqual(21.0, day[0]["avg"])
+        # rebuilding from the raw data gives the same aggregates
+        before = self.repo.get_device_rollups(temp, "minute")
+        self.repo.rebuild_rollups()
+        self.assertEqual(before, self.repo.get_device_rollups(temp, "minute"))
+        with self.assertRaises(ValueError):
+            self.repo.get_room_rollups(temp.room, "minute")
+
+    def states(self) -> dict:
+        c = self.repo.cursor()
+        c.execute("SELECT device, state FROM states")
+        result = dict(c.fetchall())
+        c.close()
+        return result
+
+    def test_actuator_states_batch(self):
+        actuators = [d for d in self.house.get_devices() if d.is_actuator()]
+        for actuator in actuators:
+            actuator.turn_on(12.5)
+        # sensors are skipped
+        self.assertEqual(len(actuators), self.repo.update_actuator_states(self.house.get_devices()))
+        self.assertEqual({a.id: 12.5 for a in actuators}, {k: v for k, v in self.states().items() if k in {a.id for a in actuators}})
+        actuators[0].turn_off()
+        self.repo.update_actuator_state(actuators[0])
+        self.assertIsNone(self.states()[actuators[0].id])
+
+    def test_state_coalescing(self):
+        oven = self.house.get_device_by_id("8d4e4c98-21a9-4d1e-bf18-523285ad90f6")
+        events = []
+        self.repo.add_listener(events.append)
+        coalescer = self.repo.enable_state_coalescing(window=10)
+        for target in range(1, 51):
+            oven.turn_on(float(target))
+            self.repo.update_actuator_state(oven)
+        # nothing is written before the window has passed ...
+        self.assertNotEqual(50.0, self.states()[oven.id])
+        # ... and then only the latest state
+        self.assertTrue(coalescer.flush(timeout=5))
+        self.assertEqual(50.0, self.states()[oven.id])
+        self.assertEqual([{"event": "state", "uuid": oven.id, "state": 50.0}], events)
+        stats = coalescer.stats()
+        self.assertEqual((50, 49, 1, 1), (stats["received"], stats["coalesced"], stats["written"], stats["flushes"]))
+        oven.turn_off()
+        self.repo.update_actuator_state(oven)
+        # closing the repository writes the pending states
+        self.repo.close()
+        self.repo = SmartHouseRepository(self.repo.file)
+        self.assertIsNone(self.states()[oven.id])
+
+    def test_retention(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        humidity = self.house.get_device_by_id("a2f8690f-2b3a-43cd-90b8-9deea98b42a7")
+        self.repo.enable_latest_cache()
+        # readings whose timestamp cannot be parsed count as the oldest
+        c = self.repo.cursor()
+        c.executemany("INSERT INTO measurements (device, value, ts, unit) VALUES (?, 1.0, '0000-00-00 00:00:00', NULL)",
+                      [(temp.id,), (temp.id,), (temp.id,), (humidity.id,)])
+        self.repo.conn.commit()
+        # they count towards the limit of a batch
+        self.assertEqual(2, self.repo.delete_readings_batch(temp.id, "2000-01-01 00:00:00", limit=2))
+        c.execute("SELECT COUNT(*) FROM measurements WHERE ts_ms IS NULL")
+        self.assertEqual(2, c.fetchone()[0])
+        rollups = self.repo.get_device_rollups(temp, "day")
+        humidity_days = [r["bucket"] for r in self.repo.get_device_rollups(humidity, "day")]
+        self.repo.add_measurements([(temp.id, f"2024-04-01 00:{i // 60:02d}:{i % 60:02d}", 20.0, "°C") for i in range(2500)])
+        engine = RetentionEngine(self.repo, [
+            RetentionPolicy(max_count=100, device=temp.id),
+            RetentionPolicy(max_age=timedelta(days=1), kind=humidity.device_type),
+            RetentionPolicy(max_age=timedelta(days=1000)),
+        ], batch_size=500)
+        self.assertIs(engine.policies[0], engine.policy_for(temp.id, temp.device_type))
+        self.assertIs(engine.policies[2], engine.policy_for("other", "Smart Lock"))
+        now = datetime.fromisoformat(humidity_days[-1]) + timedelta(hours=12)
+        # a run started while another is in progress waits for it
+        results = []
+        with engine.lock:
+            runner = threading.Thread(target=lambda: results.append(engine.run_once(now)))
+            runner.start()
+            runner.join(timeout=0.2)
+            self.assertEqual([], results)
+        runner.join()
+        deleted = results[0]
+        # the newest 100 readings of the temperature sensor are kept
+        self.assertEqual(100, self.count_readings(temp.id))
+        self.assertEqual("2024-04-01 00:41:39", self.repo.get_latest_reading(temp).timestamp)
+        self.assertEqual("2024-04-01 00:40:00", self.repo.get_all_readings(temp, 1000)[-1].timestamp)
+        # the humidity sensor keeps the last day only
+        self.assertTrue(all(r.timestamp >= humidity_days[-1] for r in self.repo.get_all_readings(humidity, 1000)))
+        self.assertEqual(deleted, engine.stats()["deleted_rows"])
+        c.execute("SELECT COUNT(*) FROM measurements WHERE ts_ms IS NULL")
+        self.assertEqual(0, c.fetchone()[0])
+        c.close()
+        # rollups outlive the raw readings
+        self.assertEqual(rollups, self.repo.get_device_rollups(temp, "day")[:len(rollups)])
+        self.assertEqual(humidity_days, [r["bucket"] for r in self.repo.get_device_rollups(humidity, "day")])
+        self.assertEqual(0, engine.run_once(now))
+        # the freed pages were given back to the file system
+        self.assertGreater(engine.stats()["vacuumed_pages"], 0)
+
+    def test_vacuum_migration_is_limited_by_size(self):
+        self.assertIn(persistence._enable_incremental_vacuum, SCHEMA_MIGRATIONS)
+        # data/db.sql may already be migrated by other tests, so the copy is switched back first
+        self.repo.conn.execute("PRAGMA auto_vacuum = 0")
+        self.repo.conn.execute("VACUUM")
+        # above the limit the migration leaves the VACUUM to a maintenance command
+        with mock.patch.object(persistence, "AUTO_VACUUM_MAX_BYTES", 0), \
+                self.assertLogs("smarthouse.persistence", "WARNING") as logs:
+            self.assertFalse(persistence._enable_incremental_vacuum(self.repo.conn))
+        self.assertIn("smarthouse.maintenance vacuum", logs.output[0])
+        self.assertEqual(0, self.repo.conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+        self.assertTrue(self.repo.enable_incremental_vacuum())
+        self.assertEqual(2, self.repo.conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+        self.assertFalse(self.repo.enable_incremental_vacuum())
+        # below the limit it is done right away
+        self.repo.conn.execute("PRAGMA auto_vacuum = 0")
+        self.repo.conn.execute("VACUUM")
+        self.assertTrue(persistence._enable_incremental_vacuum(self.repo.conn))
+        self.assertEqual(2, self.repo.conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+
+    def test_concurrent_migrations(self):
+        # processes that open a new database at the same time apply every migration once
+        calls = []
+        migrations = ["CREATE TABLE a (x);", calls.append, "ALTER TABLE a ADD COLUMN y; INSERT INTO a VALUES (1, 2);"]
+        file = str(Path(self.tmp.name) / "new.sql")
+        barrier = threading.Barrier(8)
+        repos, errors = [], []
+
+        def open_repo():
+            barrier.wait()
+            try:
+                repos.append(SmartHouseRepository(file))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch.object(persistence, "SCHEMA_MIGRATIONS", migrations):
+            threads = [threading.Thread(target=open_repo) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual([3] * 8, [repo.schema_version() for repo in repos])
+        self.assertEqual([(1, 2)], repos[0].conn.execute("SELECT * FROM a").fetchall())
+        self.assertGreaterEqual(len(calls), 1)
+        for repo in repos:
+            repo.close()
+
+    def test_cold_tier_compaction(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        humidity = self.house.get_device_by_id("a2f8690f-2b3a-43cd-90b8-9deea98b42a7")
+        bath = next(r for r in self.house.get_rooms() if r.room_name == humidity.room.room_name)
+
+        def snapshot(sensor):
+            series = self.repo.get_readings_series(sensor)
+            return ((series.timestamps.tolist(), series.values.tolist()),
+                    [(m.timestamp, m.value, m.unit) for m in self.repo.get_all_readings(sensor, 100000)],
+                    [(m.timestamp, m.value) for _, m in self.repo.iter_readings(sensor, batch_size=7)],
+                    self.repo.get_downsampled_readings(sensor, 5),
+                    self.repo.get_latest_reading(sensor).timestamp)
+
+        before = snapshot(temp)
+        hours = self.repo.calc_hours_with_humidity_above(bath, "2024-01-27")
+        total = self.count_readings(temp.id)
+        # a stream that is consumed while the readings behind its position are compacted
+        stream = self.repo.iter_readings(temp, batch_size=7)
+        streamed = [(m.timestamp, m.value) for _, m in itertools.islice(stream, 10)]
+        compacted = self.repo.compact_readings("2024-01-28 12:00:00", temp.id, chunk_size=16)
+        streamed += [(m.timestamp, m.value) for _, m in stream]
+        self.assertEqual(before[2], streamed)
+        self.assertGreater(compacted, 16)
+        self.assertEqual(total - compacted, self.count_readings(temp.id))
+        self.assertEqual(before, snapshot(temp))
+        # compacting the rest keeps the newest reading in the hot table, also during a stream
+        stream = self.repo.iter_readings(temp, batch_size=7)
+        streamed = [(m.timestamp, m.value) for _, m in itertools.islice(stream, 30)]
+        compacted += self.repo.compact_readings("2030-01-01 00:00:00", chunk_size=16)
+        streamed += [(m.timestamp, m.value) for _, m in stream]
+        self.assertEqual(before[2], streamed)
+        self.assertEqual(1, self.count_readings(temp.id))
+        self.assertEqual(before, snapshot(temp))
+        self.assertEqual(hours, self.repo.calc_hours_with_humidity_above(bath, "2024-01-27"))
+        # paging resumes inside the chunks
+        everything = list(self.repo.iter_readings(temp, batch_size=5))
+        resumed = list(self.repo.iter_readings(temp, after=everything[20][0], batch_size=5))
+        self.assertEqual([m.timestamp for _, m in everything[21:]], [m.timestamp for _, m in resumed])
+        # deletions reach into the cold tier
+        oldest = before[1][-1][0]
+        self.assertTrue(self.repo.removing_oldest_reading_from_database(temp))
+        self.assertNotEqual(oldest, self.repo.get_all_readings(temp, 100000)[-1].timestamp)
+        self.assertEqual(total - 1, len(self.repo.get_readings_series(temp)))
+        self.assertEqual(total - 11, self.repo.delete_cold_readings(temp.id, keep=10))
+        self.assertEqual(10, len(self.repo.get_all_readings(temp, 100000)))
+        self.assertEqual(before[1][:10], [(m.timestamp, m.value, m.unit) for m in self.repo.get_all_readings(temp, 100)])
+        # the retention engine compacts what is older than `compact_after` and expires cold readings
+        self.repo.add_measurements([(humidity.id, f"2024-02-01 10:{i:02d}:00", 50.0 + i, "%") for i in range(20)])
+        humidity_total = len(self.repo.get_readings_series(humidity))
+        engine = RetentionEngine(self.repo, [RetentionPolicy(max_count=50, device=humidity.id)],
+                                 compact_after=timedelta(days=1))
+        engine.run_once(datetime(2024, 2, 5))
+        self.assertEqual(humidity_total - 50, engine.stats()["deleted_rows"])
+        # the new readings but the newest, and the row that was the newest before them
+        self.assertEqual(20, engine.stats()["compacted_rows"])
+        # readings with a date only as timestamp stay in the hot table
+        self.assertEqual(3, self.count_readings(humidity.id))
+        self.assertEqual(50, len(self.repo.get_readings_series(humidity)))
+
+    def test_failed_cold_tier_writes_are_rolled_back(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        total = self.count_readings(temp.id)
+        # a failure partway through the deletes of the first chunk
+        fifth_oldest = self.repo.get_all_readings(temp, 100000)[-5].timestamp
+        cursor = self.repo.cursor()
+        cursor.execute(f"""
+            CREATE TRIGGER fail_delete BEFORE DELETE ON measurements WHEN OLD.ts = '{fifth_oldest}'
+            BEGIN SELECT RAISE(ABORT, 'delete failed'); END;
+        """)
+        self.repo.conn.commit()
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.repo.compact_readings("2030-01-01 00:00:00", temp.id, chunk_size=16)
+        self.assertFalse(self.repo.conn.in_transaction)
+        self.assertEqual(total, self.count_readings(temp.id))
+        cursor.execute("SELECT COUNT(*) FROM measurement_chunks;")
+        self.assertEqual(0, cursor.fetchone()[0])
+        # a failure after some chunks are deleted, and when trimming a chunk
+        cursor.execute("DROP TRIGGER fail_delete;")
+        self.repo.conn.commit()
+        self.repo.compact_readings("2030-01-01 00:00:00", temp.id, chunk_size=16)
+        cursor.execute("SELECT COUNT(*), MIN(id) FROM measurement_chunks;")
+        chunks, first = cursor.fetchone()
+        cursor.execute(f"""
+            CREATE TRIGGER fail_chunk BEFORE DELETE ON measurement_chunks WHEN OLD.id = {first}
+            BEGIN SELECT RAISE(ABORT, 'delete failed'); END;
+        """)
+        cursor.execute("""
+            CREATE TRIGGER fail_trim BEFORE UPDATE ON measurement_chunks
+            BEGIN SELECT RAISE(ABORT, 'update failed'); END;
+        """)
+        self.repo.conn.commit()
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.repo.delete_cold_readings(temp.id, keep=0)
+        self.assertFalse(self.repo.conn.in_transaction)
+        self.assertFalse(self.repo.removing_oldest_reading_from_database(temp))
+        self.assertFalse(self.repo.conn.in_transaction)
+        cursor.execute("SELECT COUNT(*) FROM measurement_chunks;")
+        self.assertEqual(chunks, cursor.fetchone()[0])
+        cursor.close()
+        self.assertEqual(total, len(self.repo.get_readings_series(temp)))
+
+    def test_async_repository(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        before = self.count_readings(temp.id)
+        arepo = AsyncSmartHouseRepository(self.repo, readers=4)
+
+        async def run():
+            writes = [arepo.add_measurment(temp.id, f"2024-04-01 00:00:{i:02d}", float(i), "°C") for i in range(20)]
+            reads = [arepo.get_latest_reading(temp) for _ in range(20)]
+            return await asyncio.gather(*writes, *reads)
+
+        results = asyncio.run(run())
+        arepo.close()
+        self.assertTrue(all(results[:20]))
+        self.assertTrue(all(r is not None for r in results[20:]))
+        self.assertEqual(before + 20, self.count_readings(temp.id))
+        # the reader threads used their own connections
+        self.assertGreaterEqual(len(self.repo.pool.readers), 1)
+        self.assertEqual(19.0, self.repo.get_latest_reading(temp).value)
+
+    def test_latest_reading_cache(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        bulb = self.house.get_device_by_id("6b1c5f6b-37f6-4e3d-9145-1cfbe2f1fc28")
+        latest = self.repo.get_latest_reading(temp)
+        cache = self.repo.enable_latest_cache(capacity=100)
+        # filled up front, including devices without readings
+        self.assertEqual(self.house.count_devices(), cache.stats()["size"])
+        self.assertEqual(latest.timestamp, self.repo.get_latest_reading(temp).timestamp)
+        self.assertIsNone(self.repo.get_latest_reading(bulb))
+        self.assertEqual(0, cache.stats()["misses"])
+        # write-through on inserts, older readings do not replace newer ones
+        self.assertTrue(self.repo.add_measurment(temp.id, "2024-05-01 00:00:00", 42, "°C"))
+        self.repo.add_measurements([(temp.id, "2000-01-01 00:00:00", 1.0, "°C")])
+        reading = self.repo.get_latest_reading(temp)
+        self.assertEqual(("2024-05-01 00:00:00", 42.0), (reading.timestamp, reading.value))
+        # changes behind the cache's back need an explicit invalidation
+        c = self.repo.cursor()
+        c.execute("DELETE FROM measurements WHERE device = ? AND ts = ?", (temp.id, "2024-05-01 00:00:00"))
+        self.repo.conn.commit()
+        c.close()
+        self.assertEqual("2024-05-01 00:00:00", self.repo.get_latest_reading(temp).timestamp)
+        self.repo.invalidate_latest_cache(temp.id)
+        self.assertEqual(latest.timestamp, self.repo.get_latest_reading(temp).timestamp)
+        self.assertEqual(1, cache.stats()["misses"])
+        # recency is decided by the time, not by the text of the timestamp
+        self.repo.add_measurements([(temp.id, "2024-06-01 01:00:00", 1.0, "°C")])
+        self.repo.add_measurements([(temp.id, "2024-06-01T02:00:00+02:00", 2.0, "°C")])
+        self.assertEqual(1.0, self.repo.get_latest_reading(temp).value)
+        self.assertEqual(1.0, self.repo._query_latest_reading(temp).value)
+        # the cache is filled with the same reading the query gives, also for readings at the same time
+        other = SmartHouseRepository(self.repo.file)
+        queried = {d.id: other._query_latest_reading(d) for d in self.house.get_devices()}
+        other.enable_latest_cache()
+        self.assertEqual({i: (m.timestamp, m.value, m.unit) for i, m in queried.items() if m},
+                         {i: (m.timestamp, m.value, m.unit) for i, m in
+                          ((d.id, other.get_latest_reading(d)) for d in self.house.get_devices()) if m})
+        other.close()
+        # the bound holds
+        other = SmartHouseRepository(self.repo.file)
+        self.assertEqual(2, other.enable_latest_cache(capacity=2).stats()["size"])
+        other.close()
+
+    def test_push_events(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        oven = self.house.get_device_by_id("8d4e4c98-21a9-4d1e-bf18-523285ad90f6")
+        broker = Broker(self.house, queue_size=3)
+        self.repo.add_listener(broker.publish)
+        self.assertEqual("room:1/Garage", parse_topic("room:01/Garage"))
+        self.assertRaises(ValueError, parse_topic, "house:1")
+
+        async def run():
+            device = broker.subscribe([f"device:{temp.id}"])
+            floor = broker.subscribe([f"floor:{oven.room.floor.level}"])
+            # the writes happen on another thread, like the writer thread of the API
+            await asyncio.to_thread(self.repo.add_measurment, temp.id, "2024-05-01 00:00:00", 21.5, "°C")
+            oven.turn_on(2.5)
+            await asyncio.to_thread(self.repo.update_actuator_state, oven)
+            received = [await device.get()]
+            if temp.room.floor is oven.room.floor:
+                received.append(await floor.get())
+            received.append(await floor.get())
+            # a subscriber that does not keep up is dropped
+            await asyncio.to_thread(self.repo.add_measurements, [(temp.id, f"2024-05-02 00:00:0{i}", 1.0, "°C") for i in range(5)])
+            received.append(await device.get())
+            return received, broker.stats()
+
+        received, stats = asyncio.run(run())
+        self.assertEqual({"event": "measurement", "uuid": temp.id, "timestamp": "2024-05-01 00:00:00", "value": 21.5, "unit": "°C"}, received[0])
+        self.assertEqual({"event": "state", "uuid": oven.id, "state": 2.5}, received[-2])
+        self.assertIsNone(received[-1])
+        self.assertEqual(1, stats["dropped_subscribers"])
+
+    def test_connection_pool(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        self.assertEqual("wal", self.repo.pool.stats()["journal_mode"])
+        # a reader sees committed data while a write transaction is open on the writer
+        latest = self.repo.get_latest_reading(temp)
+        c = self.repo.cursor()
+        c.execute("BEGIN")
+        c.execute("INSERT INTO measurements (device, ts, value, unit) VALUES (?, ?, ?, ?)",
+                  (temp.id, "2024-05-01 00:00:00", 1.0, "°C"))
+        results = []
+        reader = threading.Thread(target=lambda: results.append(self.repo.get_latest_reading(temp)))
+        reader.start()
+        reader.join(timeout=2)
+        self.assertEqual(latest.timestamp, results[0].timestamp)
+        self.repo.conn.commit()
+        c.close()
+        self.assertEqual("2024-05-01 00:00:00", self.repo.get_latest_reading(temp).timestamp)
+        with self.repo.lock:
+            pass
+        stats = self.repo.pool.stats()
+        self.assertGreaterEqual(stats["readers_opened"], 2)
+        self.assertGreaterEqual(stats["writes"], 1)
+
+    def test_snapshot_and_state_follower(self):
+        snapshot = str(Path(self.tmp.name) / "house.snapshot")
+        self.assertGreater(self.repo.export_snapshot(snapshot), 0)
+        house = SmartHouseRepository.load_smarthouse_snapshot(snapshot)
+        self.assertEqual(self.house.get_area(), house.get_area())
+        self.assertEqual([d.id for d in self.house.get_devices()], [d.id for d in house.get_devices()])
+        bulb_id = "6b1c5f6b-37f6-4e3d-9145-1cfbe2f1fc28"
+        self.assertEqual(self.house.get_device_by_id(bulb_id).state, house.get_device_by_id(bulb_id).state)
+
+        # another process changes states through its own connection
+        other = SmartHouseRepository(str(Path(self.tmp.name) / "db.sql"))
+        self.addCleanup(other.close)
+        events = []
+        self.repo.add_listener(events.append)
+        follower = StateFollower(self.repo, house)
+        # the first poll reads all states, which the snapshot already has
+        self.assertEqual(0, follower.poll())
+        self.assertEqual(1, follower.resyncs)
+        self.assertEqual(0, follower.poll())
+        bulb = other.load_smarthouse_deep().get_device_by_id(bulb_id)
+        bulb.turn_on(19.5)
+        other.update_actuator_state(bulb)
+        self.assertEqual(1, follower.poll())
+        self.assertEqual(19.5, house.get_device_by_id(bulb_id).state)
+        self.assertEqual([{"event": "state", "uuid": bulb_id, "state": 19.5}], events)
+        # writing the same state again is not logged
+        other.update_actuator_state(bulb)
+        self.assertEqual(0, follower.poll())
+        # a gap in the log (pruned entries) makes the follower read all states again
+        bulb.turn_off()
+        other.update_actuator_state(bulb)
+        c = other.cursor()
+        c.execute("DELETE FROM state_log;")
+        other.conn.commit()
+        c.close()
+        resyncs = follower.resyncs
+        bulb.turn_on()
+        other.update_actuator_state(bulb)
+        self.assertEqual(1, follower.poll())
+        self.assertEqual(resyncs + 1, follower.resyncs)
+        self.assertTrue(house.get_device_by_id(bulb_id).state is True)
+
+    def test_metrics(self):
+        temp = self.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+        metrics = Metrics(slow_threshold=0.0)
+        instrument(self.repo, metrics)
+        self.assertEqual(3, len(self.repo.get_all_readings(temp, 3)))
+        self.repo.add_measurements([(temp.id, "2024-05-01 00:00:00", 20.0, "°C")])
+        with self.assertRaises(ValueError):
+            self.repo.get_downsampled_readings(temp, method="unknown")
+        text = metrics.render()
+        self.assertIn('smarthouse_repository_call_duration_seconds_count{method="get_all_readings"} 1', text)
+        self.assertIn('smarthouse_repository_call_duration_seconds_bucket{method="get_all_readings",le="+Inf"} 1', text)
+        self.assertIn('smarthouse_repository_rows_total{method="get_all_readings"} 3', text)
+        self.assertIn('smarthouse_repository_rows_total{method="add_measurements"} 1', text)
+        self.assertIn('smarthouse_repository_errors_total{method="get_downsampled_readings"} 1', text)
+        self.assertIn("smarthouse_repository_commit_duration_seconds_count 1", text)
+        # with a threshold of 0 every call is logged as slow
+        self.assertEqual(["get_all_readings", "add_measurements", "get_downsampled_readings"],
+                         [entry["method"] for entry in metrics.slow_queries])
+        self.assertEqual("Sensor(4d8b1d62-7921-4917-9b70-bbd31f6e2e8e)", metrics.slow_queries[0]["args"][0])
+        # generators are timed while they are read, and observed once they are exhausted or closed
+        readings = self.repo.iter_readings(temp, batch_size=5)
+        self.assertNotIn('method="iter_readings"', metrics.render())
+        self.assertEqual(12, len([next(readings) for _ in range(12)]))
+        readings.close()
+        rows = len(list(self.repo.iter_readings(temp, "2024-01-28", batch_size=5)))
+        self.assertGreater(rows, 5)
+        text = metrics.render()
+        self.assertIn('smarthouse_repository_call_duration_seconds_count{method="iter_readings"} 2', text)
+        self.assertIn(f'smarthouse_repository_rows_total{{method="iter_readings"}} {12 + rows}', text)
+        self.assertNotIn('smarthouse_repository_errors_total{method="iter_readings"}', text)
+        # commits on the new writer connection are timed after a reconnect
+        self.repo.reconnect()
+        self.repo.add_measurements([(temp.id, "2024-05-01 00:01:00", 20.5, "°C")])
+        self.assertIn("smarthouse_repository_commit_duration_seconds_count 2", metrics.render())
+
+
+class TenantRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for house_id in ("alpha", "beta"):
+            shutil.copy(Path(__file__).parent / "../data/db.sql", Path(self.tmp.name) / f"{house_id}.sql")
+        self.registry = TenantRegistry(self.tmp.name, capacity=1, idle_timeout=60)
+
+    def tearDown(self):
+        self.registry.close()
+        self.tmp.cleanup()
+
+    def test_lru_and_idle_eviction(self):
+        with self.registry.lease("alpha") as alpha:
+            self.assertEqual(12, alpha.house.count_rooms())
+            # opening a second house evicts the first, which stays usable until the lease ends
+            with self.registry.lease("beta") as beta:
+                self.assertEqual(["beta"], list(self.registry.tenants))
+                self.assertTrue(alpha.evicted)
+                temp = alpha.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+                self.assertIsNotNone(alpha.repo.get_latest_reading(temp))
+        with self.assertRaises(sqlite3.ProgrammingError):
+            alpha.repo.cursor()
+        with self.registry.lease("beta") as again:
+            self.assertIs(beta, again)
+        self.assertEqual(0, self.registry.evict_idle())
+        self.assertEqual(1, self.registry.evict_idle(beta.last_used + 60))
+        self.assertEqual({"open": 0, "opened": 2, "evicted": 2, "hits": 1},
+                         {k: v for k, v in self.registry.stats().items() if k in ("open", "opened", "evicted", "hits")})
+
+    def test_bounded_readers(self):
+        opened = []
+        registry = TenantRegistry(self.tmp.name, on_open=opened.append)
+        try:
+            with registry.lease("alpha") as alpha:
+                self.assertEqual([alpha.repo], opened)
+                temp = alpha.house.get_device_by_id("4d8b1d62-7921-4917-9b70-bbd31f6e2e8e")
+                expected = len(alpha.repo.get_readings_series(temp))
+                results = []
+                threads = [threading.Thread(target=lambda: results.append(len(alpha.repo.get_readings_series(temp))))
+                           for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual([expected] * 8, results)
+                # a thread reuses the connection it leases, and closing the cursors returns it
+                outer = alpha.repo.read_cursor()
+                inner = alpha.repo.read_cursor()
+                self.assertIs(outer.connection, inner.connection)
+                inner.close()
+                outer.close()
+                stats = alpha.repo.pool.stats()
+                self.assertLessEqual(stats["open_readers"], 2)
+                self.assertEqual(stats["open_readers"], len(alpha.repo.pool.idle_readers))
+        finally:
+            registry.close()
+        # all connections of the house are closed with it
+        self.assertEqual(0, alpha.repo.pool.stats()["open_readers"])
+
+    def test_unknown_and_foreign_houses(self):
+        with self.assertRaises(KeyError):
+            self.registry.acquire("gamma")
+        with self.assertRaises(ValueError):
+            self.registry.acquire("../alpha")
+        sharded = TenantRegistry(self.tmp.name, shard=1 - shard_for("alpha", 2), shards=2)
+        with self.assertRaises(WrongShard) as raised:
+            sharded.acquire("alpha")
+        self.assertEqual(shard_for("alpha", 2), raised.exception.owner)
+
+
+class SmartHouseApiTest(unittest.TestCase):
+    """
+    Tests of the REST API. `smarthouse.api` opens its database when it is imported,
+    so it is imported once for all tests, on a temporary copy of the database.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        file = Path(cls.tmp.name) / "db.sql"
+        shutil.copy(Path(__file__).parent / "../data/db.sql", file)
+        tenants_dir = Path(cls.tmp.name) / "houses"
+        tenants_dir.mkdir()
+        shutil.copy(Path(__file__).parent / "../data/db.sql", tenants_dir / "alpha.sql")
+        os.environ["SMARTHOUSE_DB"] = str(file)
+        os.environ["SMARTHOUSE_TENANTS_DIR"] = str(tenants_dir)
+        try:
+            cls.api = importlib.import_module("smarthouse.api")
+        finally:
+            del os.environ["SMARTHOUSE_DB"]
+            del os.environ["SMARTHOUSE_TENANTS_DIR"]
+        cls.client = TestClient(cls.api.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.api.flush_measurements()
+        cls.api.repo.close()
+        cls.tmp.cleanup()
+
+    def test_values_stream_rejects_invalid_range(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        for params in ({"from": "garbage"}, {"until": "2024-13-01"}, {"from": "2024-01-28", "until": "28.01.2024"}):
+            response = self.client.get(f"/smarthouse/sensor/{temp_id}/values", params=params)
+            self.assertEqual(400, response.status_code)
+            self.assertEqual({"detail": "Invalid date format"}, response.json())
+        response = self.client.get(f"/smarthouse/sensor/{temp_id}/values", params={"from": "2024-01-28"})
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.text.endswith("\n"))
+
+    def test_batch_ingest(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        temp = self.api.smarthouse.get_device_by_id(temp_id)
+        before = len(self.api.repo.get_readings_series(temp))
+        response = self.client.post("/smarthouse/measurements/batch", json=[
+            {"uuid": temp_id, "timestamp": "2024-06-01 10:00:00", "value": 21.5, "unit": "°C"},
+            {"uuid": "unknown", "timestamp": "2024-06-01 10:00:00", "value": 21.5, "unit": "°C"},
+            {"uuid": temp_id, "timestamp": "01.06.2024", "value": 21.5, "unit": "°C"},
+        ])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"accepted": 1, "rejected": 2, "results": [
+            {"index": 0, "accepted": True},
+            {"index": 1, "accepted": False, "reason": "Sensor not found"},
+            {"index": 2, "accepted": False, "reason": "Invalid date format"},
+        ]}, response.json())
+        # NDJSON, with a line that is not JSON
+        body = (b'{"uuid": "%s", "timestamp": "2024-06-01 10:01:00", "value": 22, "unit": "\xc2\xb0C"}\n'
+                b'not json\n'
+                b'{"uuid": "%s", "timestamp": "2024-06-01 10:02:00", "value": true}' % (temp_id.encode(), temp_id.encode()))
+        response = self.client.post("/smarthouse/measurements/batch", content=body,
+                                    headers={"Content-Type": "application/x-ndjson"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([True, False, False], [result["accepted"] for result in response.json()["results"]])
+        self.assertEqual(["Invalid measurement object", "Invalid value"],
+                         [result["reason"] for result in response.json()["results"][1:]])
+        self.assertEqual(before + 2, len(self.api.repo.get_readings_series(temp)))
+        # a body that is not a JSON array is rejected as a whole
+        for body in (b"[{", b'{"uuid": "x"}'):
+            response = self.client.post("/smarthouse/measurements/batch", content=body,
+                                        headers={"Content-Type": "application/json"})
+            self.assertEqual(400, response.status_code)
+        self.assertEqual(before + 2, len(self.api.repo.get_readings_series(temp)))
+
+    def test_values_stream_pages(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        url = f"/smarthouse/sensor/{temp_id}/values"
+        params = {"from": "2024-01-27", "until": "2024-01-28"}
+        response = self.client.get(url, params=params)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/x-ndjson", response.headers["content-type"])
+        everything = [orjson.loads(line) for line in response.text.splitlines()]
+        self.assertGreater(len(everything), 10)
+        # pages of a JSON response, each continuing at the cursor of the previous one
+        pages, cursor = [], None
+        while True:
+            page = self.client.get(url, params={**params, "format": "json", "limit": 4,
+                                                **({"cursor": cursor} if cursor else {})}).json()
+            pages.extend(page["readings"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(everything, pages)
+        # an NDJSON stream resumes after the cursor of any reading
+        response = self.client.get(url, params={**params, "cursor": everything[6]["cursor"]})
+        self.assertEqual(everything[7:], [orjson.loads(line) for line in response.text.splitlines()])
+        # invalid cursors, limits and sensors are rejected before the stream starts
+        self.assertEqual(400, self.client.get(url, params={"cursor": "not a cursor"}).status_code)
+        self.assertEqual(422, self.client.get(url, params={"limit": 0}).status_code)
+        self.assertEqual(404, self.client.get("/smarthouse/sensor/unknown/values").status_code)
+
+    def test_structure_etags(self):
+        response = self.client.get("/smarthouse/floor/2/room")
+        self.assertEqual(200, response.status_code)
+        etag = response.headers["etag"]
+        self.assertEqual(7, len(response.json()))
+        # a matching If-None-Match (also as a weak tag or in a list) gives 304 without a body
+        for tag in (etag, f"W/{etag}", f'"other", {etag}', "*"):
+            response = self.client.get("/smarthouse/floor/2/room", headers={"If-None-Match": tag})
+            self.assertEqual(304, response.status_code)
+            self.assertEqual(etag, response.headers["etag"])
+            self.assertEqual(b"", response.content)
+        # a stale tag gets the full response
+        response = self.client.get("/smarthouse/floor/2/room", headers={"If-None-Match": '"stale"'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(7, len(response.json()))
+        self.assertEqual(404, self.client.get("/smarthouse/floor/9/room", headers={"If-None-Match": "*"}).status_code)
+        # a change of the structure changes the tag of the affected responses
+        floors = self.client.get("/smarthouse/floor")
+        house = self.api.smarthouse
+        house.register_room(house.register_floor(3), 20.0, "Attic")
+        response = self.client.get("/smarthouse/floor", headers={"If-None-Match": floors.headers["etag"]})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(floors.headers["etag"], response.headers["etag"])
+        self.assertEqual(len(floors.json()) + 1, len(response.json()))
+        self.assertEqual(304, self.client.get("/smarthouse/floor/2/room", headers={"If-None-Match": etag}).status_code)
+
+    def wait_for_subscribers(self, n: int):
+        deadline = time.monotonic() + 5
+        while self.api.broker.stats()["subscribers"] != n:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_websocket_subscription(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        with self.client.websocket_connect(f"/smarthouse/subscribe?topic=device:{temp_id}") as websocket:
+            self.wait_for_subscribers(1)
+            response = self.client.post(f"/smarthouse/sensor/{temp_id}/current",
+                                        params={"measurment_time": "2024-06-02 10:00:00", "value": 19.5, "unit": "°C"})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({"event": "measurement", "uuid": temp_id, "timestamp": "2024-06-02 10:00:00",
+                              "value": 19.5, "unit": "°C"}, websocket.receive_json())
+        self.wait_for_subscribers(0)
+        # an invalid topic closes the socket before it is accepted
+        with self.assertRaises(WebSocketDisconnect) as context:
+            with self.client.websocket_connect("/smarthouse/subscribe?topic=floor:first") as websocket:
+                websocket.receive_json()
+        self.assertEqual(1008, context.exception.code)
+
+    def test_event_stream(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        event = {"event": "measurement", "uuid": temp_id, "timestamp": "2024-06-02 11:00:00", "value": 19.0, "unit": "°C"}
+
+        # The stream only ends when the subscriber is dropped, so after the first event the
+        # publisher sends more than the queue of the subscriber holds
+        def publish():
+            self.wait_for_subscribers(1)
+            self.api.broker.publish(event)
+            time.sleep(0.2)
+            for _ in range(50):
+                self.api.broker.publish(event)
+
+        broker = self.api.broker
+        broker.queue_size, queue_size = 2, broker.queue_size
+        publisher = threading.Thread(target=publish)
+        publisher.start()
+        try:
+            response = self.client.get("/smarthouse/events", params=[("topic", "room:1/Living Room / Kitchen"),
+                                                                     ("topic", f"device:{temp_id}")])
+        finally:
+            broker.queue_size = queue_size
+            publisher.join()
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        messages = response.text.split("\n\n")
+        self.assertEqual("event: measurement\ndata: " + orjson.dumps(event).decode(), messages[0])
+        self.assertEqual("event: dropped\ndata: {}", messages[-2])
+        self.wait_for_subscribers(0)
+        self.assertEqual(400, self.client.get("/smarthouse/events?topic=attic").status_code)
+
+    def test_actuator_commands(self):
+        oven_id = "8d4e4c98-21a9-4d1e-bf18-523285ad90f6"
+        door_id = "9a54c1ec-0cb5-45a7-b20d-2a7349f1b132"
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+
+        def stored(device_id):
+            c = self.api.repo.cursor()
+            c.execute("SELECT state FROM states WHERE device = ?", (device_id,))
+            state = c.fetchone()[0]
+            c.close()
+            return state
+
+        response = self.client.post("/smarthouse/actuators/command",
+                                    json={"action": "on", "target": 22.5, "devices": [oven_id, "unknown", temp_id]})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"updated": 1, "devices": [{"uuid": oven_id, "state": 22.5}], "not_found": ["unknown", temp_id]},
+                         response.json())
+        self.assertEqual(22.5, stored(oven_id))
+        self.assertEqual({"uuid": oven_id, "state": 22.5}, self.client.get(f"/smarthouse/actuator/{oven_id}/current").json())
+        # a room, and a floor limited to one kind of actuator
+        response = self.client.post("/smarthouse/actuators/command", json={"action": "on", "floor": 1, "room": "Garage"})
+        self.assertEqual([{"uuid": door_id, "state": True}], response.json()["devices"])
+        response = self.client.post("/smarthouse/actuators/command", json={"action": "off", "floor": 1, "kind": "Smart Oven"})
+        self.assertEqual([{"uuid": oven_id, "state": False}], response.json()["devices"])
+        self.assertEqual(0.0, self.client.get(f"/smarthouse/actuator/{oven_id}/current").json()["state"])
+        # invalid commands change nothing
+        for command, status in (({"action": "toggle", "devices": [door_id]}, 400),
+                                ({"action": "off", "target": "warm", "devices": [door_id]}, 400),
+                                ({"action": "off", "devices": door_id}, 400),
+                                ({"action": "off"}, 400),
+                                ({"action": "off", "floor": 9}, 404),
+                                ({"action": "off", "floor": True}, 404),
+                                ({"action": "off", "floor": 1, "room": "Attic"}, 404)):
+            self.assertEqual(status, self.client.post("/smarthouse/actuators/command", json=command).status_code)
+        self.assertTrue(self.api.smarthouse.get_device_by_id(door_id).is_active())
+        self.client.post("/smarthouse/actuators/command", json={"action": "off", "devices": [door_id]})
+        self.assertFalse(self.api.smarthouse.get_device_by_id(door_id).is_active())
+
+
+    def test_tenant_houses(self):
+        temp_id = "4d8b1d62-7921-4917-9b70-bbd31f6e2e8e"
+        response = self.client.get("/houses/alpha/smarthouse")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"no_rooms": 12, "no_floors": 2, "registered_devices": 14, "area": 156.55}, response.json())
+        revalidated = self.client.get("/houses/alpha/smarthouse", headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(304, revalidated.status_code)
+        devices = [self.client.get(path).json() for path in ("/smarthouse/device", "/houses/alpha/smarthouse/device")]
+        self.assertEqual(*(sorted(listed, key=lambda device: device["Device id"]) for listed in devices))
+
+        # writes go to the shard of the house only
+        response = self.client.post("/houses/alpha/smarthouse/measurements/batch", json=[
+            {"uuid": temp_id, "timestamp": "2024-07-01 10:00:00", "value": 19.5, "unit": "°C"}])
+        self.assertEqual(1, response.json()["accepted"])
+        response = self.client.get(f"/houses/alpha/smarthouse/sensor/{temp_id}/values", params={"from": "2024-07-01"})
+        self.assertEqual([19.5], [orjson.loads(line)["Verdi"] for line in response.text.splitlines()])
+        response = self.client.get(f"/smarthouse/sensor/{temp_id}/values", params={"from": "2024-07-01"})
+        self.assertEqual("", response.text)
+        # the lease taken for the stream ends with it
+        self.assertEqual(0, self.api.tenants.tenants["alpha"].users)
+
+        self.assertEqual(404, self.client.get("/houses/gamma/smarthouse/device").status_code)
+        self.assertEqual(400, self.client.get("/houses/al.pha/smarthouse/device").status_code)
+        self.assertEqual(404, self.client.get("/houses/alpha/smarthouse/floor/9/room").status_code)
+
 
 if __name__ == '__main__':
     unittest.main()